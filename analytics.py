@@ -0,0 +1,323 @@
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from flask import Flask
+
+import user_counts
+from cache import Counters
+from database import get_db
+from tasks import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = ('hour', 'day', 'month')
+
+# Dashboard growth keys and the snapshotted metric each one tracks
+GROWTH_METRICS = {
+    'users_growth': 'total_users',
+    'farmers_growth': 'active_farmers',
+    'ambassadors_growth': 'data_ambassadors',
+}
+
+GROWTH_PERIOD_DAYS = 30
+
+
+def create_schema(cursor: sqlite3.Cursor) -> None:
+    """Create the analytics_rollups table: one row per metric, resolution and bucket"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollups (
+            metric_name TEXT NOT NULL,
+            resolution TEXT NOT NULL,  -- hour, day or month
+            bucket_start INTEGER NOT NULL,  -- epoch seconds, UTC
+            sample_count INTEGER NOT NULL,
+            value_sum REAL NOT NULL,
+            value_min REAL NOT NULL,
+            value_max REAL NOT NULL,
+            last_value REAL NOT NULL,
+            last_at INTEGER NOT NULL,
+            PRIMARY KEY (metric_name, resolution, bucket_start)
+        ) WITHOUT ROWID
+    ''')
+
+
+def bucket_start(resolution: str, at: float) -> int:
+    """Start (epoch seconds, UTC) of the bucket containing at"""
+    moment = datetime.datetime.fromtimestamp(at, datetime.timezone.utc)
+    if resolution == 'hour':
+        moment = moment.replace(minute=0, second=0, microsecond=0)
+    elif resolution == 'day':
+        moment = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif resolution == 'month':
+        moment = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        raise ValueError(f'Unknown resolution: {resolution}')
+    return int(moment.timestamp())
+
+
+def format_growth(percent: Optional[float]) -> str:
+    """Dashboard wording for a month-over-month change"""
+    if percent is None:
+        return 'No data from last month'
+    return f'{percent:+.0f}% from last month'
+
+
+class AnalyticsRollups:
+    """Scheduled metric snapshots downsampled into hourly, daily and monthly buckets"""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.retention_days: Dict[str, Optional[float]] = {'raw': 2, 'hour': 14, 'day': 400,
+                                                           'month': None}
+        self.snapshotter: Optional[PeriodicTask] = None
+        self.counters = Counters('snapshots', 'samples', 'raw_pruned', 'buckets_pruned')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Read snapshot cadence and retention from the app config"""
+        app.config.setdefault('ANALYTICS_SNAPSHOT_INTERVAL', 300)
+        # Days kept per tier; monthly buckets are kept indefinitely (None)
+        app.config.setdefault('ANALYTICS_RAW_RETENTION_DAYS', 2)
+        app.config.setdefault('ANALYTICS_HOURLY_RETENTION_DAYS', 14)
+        app.config.setdefault('ANALYTICS_DAILY_RETENTION_DAYS', 400)
+        app.config.setdefault('ANALYTICS_MONTHLY_RETENTION_DAYS', None)
+
+        self.retention_days = {
+            'raw': app.config['ANALYTICS_RAW_RETENTION_DAYS'],
+            'hour': app.config['ANALYTICS_HOURLY_RETENTION_DAYS'],
+            'day': app.config['ANALYTICS_DAILY_RETENTION_DAYS'],
+            'month': app.config['ANALYTICS_MONTHLY_RETENTION_DAYS'],
+        }
+        self.snapshotter = PeriodicTask('analytics-snapshot', app.config['ANALYTICS_SNAPSHOT_INTERVAL'],
+                                        lambda: self.snapshot(get_db()), app=app)
+
+    def snapshot(self, conn: sqlite3.Connection, now: Optional[float] = None) -> Dict[str, int]:
+        """Record the current platform metrics, fold them into the rollups and apply retention"""
+        now = time.time() if now is None else now
+        metrics = user_counts.dashboard_counts(conn)
+        self.record(conn, metrics.items(), now)
+        self.prune(conn, now)
+        self.counters.incr('snapshots')
+        return metrics
+
+    def record(self, conn: sqlite3.Connection, samples: Iterable[Tuple[str, float]],
+               now: float) -> None:
+        """Append raw samples to analytics and upsert every resolution's bucket"""
+        samples = list(samples)
+        recorded_at = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        conn.executemany('INSERT INTO analytics (metric_name, metric_value, recorded_at) VALUES (?, ?, ?)',
+                         [(name, value, recorded_at) for name, value in samples])
+        conn.executemany('''
+            INSERT INTO analytics_rollups (metric_name, resolution, bucket_start, sample_count,
+                                           value_sum, value_min, value_max, last_value, last_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)
+            ON CONFLICT (metric_name, resolution, bucket_start) DO UPDATE SET
+                sample_count = sample_count + 1,
+                value_sum = value_sum + excluded.value_sum,
+                value_min = MIN(value_min, excluded.value_min),
+                value_max = MAX(value_max, excluded.value_max),
+                last_value = CASE WHEN excluded.last_at >= last_at THEN excluded.last_value ELSE last_value END,
+                last_at = MAX(last_at, excluded.last_at)
+        ''', [(name, resolution, bucket_start(resolution, now), value, value, value, value, int(now))
+              for name, value in samples for resolution in RESOLUTIONS])
+        conn.commit()
+        self.counters.incr('samples', len(samples))
+
+    def prune(self, conn: sqlite3.Connection, now: float) -> Dict[str, int]:
+        """Drop raw samples and buckets older than their tier's retention.
+        The newest raw row per metric is always kept."""
+        pruned = {}
+        raw_days = self.retention_days.get('raw')
+        if raw_days is not None:
+            cutoff = datetime.datetime.fromtimestamp(now - raw_days * 86400, datetime.timezone.utc)
+            pruned['raw'] = conn.execute('''
+                DELETE FROM analytics
+                WHERE recorded_at < ? AND id NOT IN (SELECT MAX(id) FROM analytics GROUP BY metric_name)
+            ''', (cutoff.strftime('%Y-%m-%d %H:%M:%S'),)).rowcount
+        for resolution in RESOLUTIONS:
+            days = self.retention_days.get(resolution)
+            if days is not None:
+                pruned[resolution] = conn.execute(
+                    'DELETE FROM analytics_rollups WHERE resolution = ? AND bucket_start < ?',
+                    (resolution, int(now - days * 86400))).rowcount
+        conn.commit()
+        self.counters.incr('raw_pruned', pruned.get('raw', 0))
+        self.counters.incr('buckets_pruned', sum(v for k, v in pruned.items() if k != 'raw'))
+        return pruned
+
+    def value_at(self, conn: sqlite3.Connection, metric: str, at: float) -> Optional[float]:
+        """Last value recorded at or before a moment, from the finest tier still covering it"""
+        for resolution in RESOLUTIONS:
+            row = conn.execute('''
+                SELECT last_value FROM analytics_rollups
+                WHERE metric_name = ? AND resolution = ? AND bucket_start <= ? AND last_at <= ?
+                ORDER BY bucket_start DESC LIMIT 1
+            ''', (metric, resolution, bucket_start(resolution, at), int(at))).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def growth(self, conn: sqlite3.Connection, metric: str, current: float,
+               now: Optional[float] = None, days: int = GROWTH_PERIOD_DAYS) -> Optional[float]:
+        """Percent change of current against the metric's value days ago"""
+        now = time.time() if now is None else now
+        previous = self.value_at(conn, metric, now - days * 86400)
+        if not previous:
+            return None
+        return round((current - previous) / previous * 100, 1)
+
+    def growth_metrics(self, conn: sqlite3.Connection, current: Dict[str, float],
+                       now: Optional[float] = None) -> Dict[str, Optional[float]]:
+        """Month-over-month growth per dashboard key"""
+        return {key: self.growth(conn, metric, current[metric], now)
+                for key, metric in GROWTH_METRICS.items()}
+
+    def start(self) -> None:
+        if self.snapshotter is not None:
+            self.snapshotter.start()
+
+    def stop(self) -> None:
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot, sample and pruning counters"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['retention_days'] = dict(self.retention_days)
+        if self.snapshotter is not None:
+            stats['snapshotter'] = self.snapshotter.stats()
+        return stats
+
+
+class AnalyticsBuffer:
+    """Write-behind buffer for counter and gauge events.
+
+    Handlers enqueue without blocking; a full queue drops the event and counts it.
+    A flush thread coalesces queued events (counters summed, gauges last-wins) and
+    writes them through the rollups in one transaction once flush_batch events are
+    waiting or flush_interval seconds have passed."""
+
+    COUNTER, GAUGE = 'counter', 'gauge'
+
+    def __init__(self, rollups: AnalyticsRollups, app: Optional[Flask] = None):
+        self.rollups = rollups
+        self.app = None
+        self.flush_interval = 5.0
+        self.flush_batch = 500
+        self.counters = Counters('accepted', 'dropped', 'flushed_events', 'flushed_rows',
+                                 'flushes', 'flush_failures')
+        self._queue: 'queue.Queue[Tuple[str, str, float]]' = queue.Queue(maxsize=10000)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Read queue bound and flush thresholds from the app config"""
+        app.config.setdefault('ANALYTICS_BUFFER_SIZE', 10000)
+        app.config.setdefault('ANALYTICS_FLUSH_INTERVAL', 5)
+        app.config.setdefault('ANALYTICS_FLUSH_BATCH', 500)
+        self.app = app
+        self.flush_interval = app.config['ANALYTICS_FLUSH_INTERVAL']
+        self.flush_batch = app.config['ANALYTICS_FLUSH_BATCH']
+        self._queue = queue.Queue(maxsize=app.config['ANALYTICS_BUFFER_SIZE'])
+
+    def incr(self, name: str, amount: float = 1) -> bool:
+        """Queue a counter increment; False if it was dropped"""
+        return self._offer((self.COUNTER, name, amount))
+
+    def gauge(self, name: str, value: float) -> bool:
+        """Queue a gauge reading; False if it was dropped"""
+        return self._offer((self.GAUGE, name, value))
+
+    def _offer(self, event: Tuple[str, str, float]) -> bool:
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.counters.incr('dropped')
+            return False
+        self.counters.incr('accepted')
+        if self._queue.qsize() >= self.flush_batch:
+            self._wakeup.set()
+        return True
+
+    def flush(self, conn: sqlite3.Connection) -> int:
+        """Drain the queue and write the coalesced samples; returns events written"""
+        with self._flush_lock:
+            counts: Dict[str, float] = {}
+            gauges: Dict[str, float] = {}
+            drained = 0
+            while True:
+                try:
+                    kind, name, value = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                drained += 1
+                if kind == self.COUNTER:
+                    counts[name] = counts.get(name, 0) + value
+                else:
+                    gauges[name] = value
+            if not drained:
+                return 0
+            samples = list(counts.items()) + list(gauges.items())
+            try:
+                self.rollups.record(conn, samples, time.time())
+            except Exception:
+                conn.rollback()
+                self.counters.incr('flush_failures')
+                self.counters.incr('dropped', drained)
+                raise
+            self.counters.incr('flushes')
+            self.counters.incr('flushed_events', drained)
+            self.counters.incr('flushed_rows', len(samples))
+            return drained
+
+    def _flush_in_context(self) -> None:
+        try:
+            with self.app.app_context():
+                self.flush(get_db())
+        except Exception:
+            logger.exception('Analytics event flush failed')
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            while self._queue.qsize() < self.flush_batch and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._wakeup.wait(remaining)
+                self._wakeup.clear()
+            self._flush_in_context()
+
+    def start(self) -> None:
+        """Start the flush thread (no-op if already running)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='analytics-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Stop the flush thread, writing whatever is still queued"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.app is not None:
+            self._flush_in_context()
+
+    def stats(self) -> Dict[str, Any]:
+        """Accepted, dropped and flushed event counts plus current queue depth"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['queued'] = self._queue.qsize()
+        stats['capacity'] = self._queue.maxsize
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
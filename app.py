@@ -1,20 +1,92 @@
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 from flask_cors import CORS
-import sqlite3
-import hashlib
 import jwt
 import datetime
-import requests
+import logging
+import math
 import os
+import sqlite3
+import atexit
+import threading
+import uuid
 from functools import wraps
 
+import analytics
+import auth
+import export
+import migrations
+import database
+import user_counts
+import users
+from analytics import AnalyticsBuffer, AnalyticsRollups, format_growth
+from auth import LastLoginBuffer, TokenVerifier, UserAccess
+from database import PoolExhausted, get_db
+from export import EXPORTS, FORMATS as EXPORT_FORMATS, ChangeLog, export_response
+from passwords import PasswordService, PasswordServiceBusy
+from user_counts import UserCounts
+from weather import (WEATHER_VIEWS, WeatherService, WeatherUnavailable, batch_response,
+                     forecast_response)
+
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 app.config['SECRET_KEY'] = 'harvestnet-secret-key-2024'
+app.config['DATABASE'] = os.environ.get('HARVESTNET_DB', 'harvestnet.db')
+app.config['EXPORT_CHUNK_ROWS'] = 500
+app.config['USERS_PAGE_SIZE'] = 50
+app.config['USERS_MAX_PAGE_SIZE'] = 500
+# Start the flushers, syncers and cache workers with the first request
+app.config['BACKGROUND_TASKS'] = True
+database.init_app(app)
+weather_service = WeatherService(app)
+user_counter = UserCounts(app)
+analytics_rollups = AnalyticsRollups(app)
+analytics_events = AnalyticsBuffer(analytics_rollups, app)
+last_logins = LastLoginBuffer(app)
+password_service = PasswordService(app)
+token_verifier = TokenVerifier(app)
+user_access = UserAccess(app)
+change_log = ChangeLog(app)
 
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('harvestnet.db')
+    with database.connection(app) as conn:
+        migrate_db(conn)
+
+def migrate_db(conn):
+    # Applies whatever MIGRATIONS the database has not seen; a no-op SELECT when current
+    return migrations.migrate(conn, MIGRATIONS)
+
+def _baseline_schema(conn):
+    # Everything up to the introduction of schema_version. Idempotent, so databases
+    # created by earlier releases are adopted by running it over them.
+    #
+    # This is migration 1, so it must not change. The module helpers it calls
+    # (users.create_indexes and create_search_index, user_counts, auth, analytics
+    # and export create_schema) are part of it: leave them as they are and make
+    # any later schema change, including a new tracked table in EXPORTS, a new
+    # numbered migration.
+    _enable_incremental_vacuum(conn)
+    _create_schema(conn)
+
+# Change-captured tables and columns as of the baseline; frozen here rather than
+# read from EXPORTS so adding an export cannot alter migration 1
+_BASELINE_TRACKED = {
+    'users': ('email', 'name', 'role', 'location', 'phone', 'last_login', 'is_active'),
+    'weather_cache': ('latitude', 'longitude', 'weather_data', 'cached_at', 'expires_at',
+                      'last_modified', 'summary'),
+    'analytics': ('metric_name', 'metric_value', 'recorded_at'),
+}
+
+def _enable_incremental_vacuum(conn):
+    # Lets cache maintenance hand freed pages back to the OS without a full VACUUM.
+    # Switching an existing database needs one VACUUM; on a fresh file it is instant.
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+def _create_schema(conn):
     cursor = conn.cursor()
     
     # Users table
@@ -32,6 +104,14 @@ def init_db():
             is_active BOOLEAN DEFAULT 1
         )
     ''')
+    users.create_indexes(cursor)
+    # Full-text index over name, email and location for /api/users/search
+    users.create_search_index(cursor)
+    
+    # Per role/activity user counts kept current by triggers on users
+    user_counts.create_schema(cursor)
+    # Token revocations and the log of user access changes read by token_required
+    auth.create_schema(cursor)
     
     # Weather cache table
     cursor.execute('''
@@ -39,10 +119,30 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             latitude REAL NOT NULL,
             longitude REAL NOT NULL,
-            weather_data TEXT NOT NULL,
-            cached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            weather_data BLOB NOT NULL,  -- gzip JSON; older rows hold plain JSON text
+            cached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at INTEGER,
+            last_modified TEXT,
+            last_accessed INTEGER,
+            summary BLOB  -- compact JSON daily summary of weather_data
         )
     ''')
+    _add_missing_columns(cursor, 'weather_cache', {'expires_at': 'INTEGER',
+                                                   'last_modified': 'TEXT',
+                                                   'last_accessed': 'INTEGER',
+                                                   'summary': 'BLOB'})
+    
+    # One row per forecast cell; older releases appended a row on every fetch
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_weather_cache_location'")
+    if cursor.fetchone() is None:
+        cursor.execute('''
+            DELETE FROM weather_cache WHERE id NOT IN (
+                SELECT MAX(id) FROM weather_cache GROUP BY latitude, longitude
+            )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX idx_weather_cache_location ON weather_cache (latitude, longitude)')
+    
+    _create_weather_rtree(cursor)
     
     # Platform analytics table
     cursor.execute('''
@@ -53,28 +153,109 @@ def init_db():
             recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    analytics.create_schema(cursor)
     
-    # Insert default admin user
-    admin_password = hashlib.sha256('password123'.encode()).hexdigest()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (email, password_hash, name, role)
-        VALUES (?, ?, ?, ?)
-    ''', ('admin@harvestnet.com', admin_password, 'Admin User', 'administrator'))
+    # Trigger-fed log of row changes behind incremental exports
+    export.create_schema(cursor, _BASELINE_TRACKED)
     
-    # Insert default farmer user
-    farmer_password = hashlib.sha256('password123'.encode()).hexdigest()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (email, password_hash, name, role)
-        VALUES (?, ?, ?, ?)
-    ''', ('farmer@harvestnet.com', farmer_password, 'Farmer User', 'farmer'))
+    # Insert default admin and farmer users (the KDF only runs when one is missing)
+    for email, name, role in (('admin@harvestnet.com', 'Admin User', 'administrator'),
+                              ('farmer@harvestnet.com', 'Farmer User', 'farmer')):
+        cursor.execute('SELECT 1 FROM users WHERE email = ?', (email,))
+        if cursor.fetchone() is None:
+            cursor.execute('''
+                INSERT INTO users (email, password_hash, name, role)
+                VALUES (?, ?, ?, ?)
+            ''', (email, password_service.hasher.encode('password123'), name, role))
     
-    # Insert sample analytics data
-    cursor.execute('INSERT OR IGNORE INTO analytics (metric_name, metric_value) VALUES (?, ?)', ('total_users', 1247))
-    cursor.execute('INSERT OR IGNORE INTO analytics (metric_name, metric_value) VALUES (?, ?)', ('active_farmers', 892))
-    cursor.execute('INSERT OR IGNORE INTO analytics (metric_name, metric_value) VALUES (?, ?)', ('data_ambassadors', 45))
+    # Insert sample analytics data (analytics has no unique key, so check first)
+    cursor.executemany('''
+        INSERT INTO analytics (metric_name, metric_value)
+        SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM analytics WHERE metric_name = ?)
+    ''', [(name, value, name) for name, value in ANALYTICS_SEEDS])
     
     conn.commit()
-    conn.close()
+
+def _create_weather_rtree(cursor):
+    # Spatial index over cached forecast locations for nearest-cell lookups,
+    # kept in step with weather_cache by triggers. Skipped on SQLite builds without R*Tree.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'weather_cache_rtree'")
+    if cursor.fetchone() is not None:
+        return
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE weather_cache_rtree
+            USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        ''')
+    except sqlite3.OperationalError:
+        return
+    cursor.executescript('''
+        CREATE TRIGGER weather_cache_rtree_insert AFTER INSERT ON weather_cache BEGIN
+            INSERT INTO weather_cache_rtree
+            VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END;
+        CREATE TRIGGER weather_cache_rtree_move AFTER UPDATE OF latitude, longitude ON weather_cache BEGIN
+            UPDATE weather_cache_rtree
+            SET min_lat = new.latitude, max_lat = new.latitude,
+                min_lon = new.longitude, max_lon = new.longitude
+            WHERE id = old.id;
+        END;
+        CREATE TRIGGER weather_cache_rtree_delete AFTER DELETE ON weather_cache BEGIN
+            DELETE FROM weather_cache_rtree WHERE id = old.id;
+        END;
+    ''')
+    cursor.execute('''
+        INSERT INTO weather_cache_rtree
+        SELECT id, latitude, latitude, longitude, longitude FROM weather_cache
+    ''')
+
+def _add_hot_query_indexes(conn):
+    conn.executescript('''
+        -- /api/users filtered by role and status, newest first
+        CREATE INDEX IF NOT EXISTS idx_users_role_active ON users (role, is_active, created_at);
+        -- Age-based cleanup of cached forecasts
+        CREATE INDEX IF NOT EXISTS idx_weather_cache_cached_at ON weather_cache (cached_at);
+        -- Raw samples per metric, and keeping the newest of each when pruning
+        CREATE INDEX IF NOT EXISTS idx_analytics_metric_recorded ON analytics (metric_name, recorded_at);
+    ''')
+
+def _dedupe_analytics_seeds(conn):
+    # Releases before schema_version appended the sample rows again on every start
+    conn.executemany('''
+        DELETE FROM analytics
+        WHERE metric_name = ? AND metric_value = ? AND id > (
+            SELECT MIN(id) FROM analytics WHERE metric_name = ? AND metric_value = ?
+        )
+    ''', [(name, value, name, value) for name, value in ANALYTICS_SEEDS])
+
+def _drop_redundant_users_index(conn):
+    # idx_users_role_created_at already serves role + is_active lists without a sort,
+    # checking is_active per row; (role, is_active, created_at) could not serve
+    # role-only lists without one, so keep the former and drop this overlap
+    conn.execute('DROP INDEX IF EXISTS idx_users_role_active')
+
+def _add_missing_columns(cursor, table, columns):
+    # Bring tables created by older releases up to the current layout
+    existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    for name, ddl in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+
+ANALYTICS_SEEDS = (('total_users', 1247), ('active_farmers', 892), ('data_ambassadors', 45))
+
+# Applied in order by migrate_db and recorded in schema_version. Append new ones;
+# never edit or renumber one that has shipped (nor the module helpers they call).
+MIGRATIONS = [
+    migrations.Migration(1, 'baseline schema', _baseline_schema),
+    migrations.Migration(2, 'indexes for hot queries', _add_hot_query_indexes),
+    migrations.Migration(3, 'remove duplicated analytics seed rows', _dedupe_analytics_seeds),
+    migrations.Migration(4, 'drop index overlapping idx_users_role_created_at', _drop_redundant_users_index),
+]
+
+@app.errorhandler(PoolExhausted)
+def database_busy(error):
+    # Every pooled connection stayed checked out for the whole pool timeout
+    return jsonify({'message': 'Database is busy, retry shortly'}), 503, {'Retry-After': '1'}
 
 # Authentication decorator
 def token_required(f):
@@ -87,11 +268,22 @@ def token_required(f):
         try:
             if token.startswith('Bearer '):
                 token = token[7:]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            # Repeat requests with the same token skip signature verification
+            data = token_verifier.decode(token)
             current_user_id = data['user_id']
         except:
             return jsonify({'message': 'Token is invalid'}), 401
         
+        # Deactivated accounts and revoked tokens, answered from memory; get_db is
+        # only called (borrowing a connection) when the in-memory view cannot answer
+        denied = user_access.check(get_db, data)
+        # Handlers borrow again only if they use the database, so a slow one (an
+        # upstream weather fetch) does not sit on a pooled connection meanwhile
+        database.release_db()
+        if denied:
+            return jsonify({'message': denied}), 401
+        
+        g.token_claims = data
         return f(current_user_id, *args, **kwargs)
     return decorated
 
@@ -100,17 +292,20 @@ def token_required(f):
 def health_check():
     try:
         # Check database connectivity
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
+        cursor = get_db().cursor()
         cursor.execute('SELECT 1')
-        conn.close()
         
+        # Unauthenticated: only what a load balancer or uptime check needs
         return jsonify({
             'status': 'healthy',
             'database': 'connected',
+            'pool': database.get_pool().stats(),
+            'weather_upstream': weather_service.client.breaker.stats(),
             'timestamp': datetime.datetime.now().isoformat(),
             'version': '1.0.0'
         }), 200
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({
             'status': 'unhealthy',
@@ -118,6 +313,22 @@ def health_check():
             'timestamp': datetime.datetime.now().isoformat()
         }), 500
 
+@app.route('/api/health/details', methods=['GET'])
+@token_required
+def health_details(current_user_id):
+    return jsonify({
+        'schema_version': migrations.current_version(get_db()),
+        'user_counts': user_counter.stats(),
+        'analytics_rollups': analytics_rollups.stats(),
+        'analytics_events': analytics_events.stats(),
+        'last_login_buffer': last_logins.stats(),
+        'passwords': password_service.stats(),
+        'jwt_cache': token_verifier.stats(),
+        'user_access': user_access.stats(),
+        'change_log': change_log.stats(),
+        'timestamp': datetime.datetime.now().isoformat()
+    }), 200
+
 # Authentication endpoints
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -129,34 +340,38 @@ def login():
         if not email or not password:
             return jsonify({'message': 'Email and password required'}), 400
         
-        # Hash the provided password
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
-        
         # Check user credentials
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, email, name, role FROM users 
-            WHERE email = ? AND password_hash = ? AND is_active = 1
-        ''', (email, password_hash))
+        with database.connection() as conn:
+            user = conn.execute('''
+                SELECT id, email, name, role, password_hash FROM users 
+                WHERE email = ? AND is_active = 1
+            ''', (email,)).fetchone()
+        # KDF work runs on the password worker pool, not this request thread, and
+        # no pooled connection is held while it does
+        matches, new_hash = password_service.check(password, user[4] if user else None)
         
-        user = cursor.fetchone()
-        
-        if user:
-            # Update last login
-            cursor.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user[0],))
-            conn.commit()
+        if matches:
+            if new_hash is not None:
+                # Stored with an older algorithm or cost: upgrade it now that we know the password
+                with database.connection() as conn:
+                    conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                                 (new_hash, user[0], user[4]))
+                    conn.commit()
+            
+            # Written behind in batches so logins never queue on the write lock
+            last_logins.record(user[0])
+            
+            analytics_events.incr('logins')
             
             # Generate JWT token
             token = jwt.encode({
+                'jti': uuid.uuid4().hex,
                 'user_id': user[0],
                 'email': user[1],
                 'role': user[3],
                 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
             }, app.config['SECRET_KEY'], algorithm='HS256')
             
-            conn.close()
-            
             return jsonify({
                 'token': token,
                 'user': {
@@ -167,75 +382,104 @@ def login():
                 }
             }), 200
         else:
-            conn.close()
+            analytics_events.incr('failed_logins')
             return jsonify({'message': 'Invalid credentials'}), 401
             
+    except PasswordServiceBusy:
+        return jsonify({'message': 'Too many logins in progress, retry shortly'}), 503, {'Retry-After': '1'}
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({'message': 'Login failed', 'error': str(e)}), 500
 
+@app.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user_id):
+    if not user_access.revoke(get_db(), g.token_claims):
+        return jsonify({'message': 'Token cannot be revoked'}), 400
+    return jsonify({'message': 'Logged out'}), 200
+
 # User management endpoints
+def _user_dicts(fields, rows):
+    # (id, *fields) rows as JSON objects, with logins still waiting to be flushed applied
+    result = []
+    for user_id, *values in rows:
+        user = dict(zip(fields, values))
+        if 'last_login' in user:
+            user['last_login'] = last_logins.latest(user_id, user['last_login'])
+        if 'is_active' in user:
+            user['is_active'] = bool(user['is_active'])
+        result.append(user)
+    return result
+
 @app.route('/api/users', methods=['GET'])
 @token_required
 def get_users(current_user_id):
     try:
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, email, name, role, location, phone, created_at, last_login, is_active
-            FROM users ORDER BY created_at DESC
-        ''')
-        
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                'id': row[0],
-                'email': row[1],
-                'name': row[2],
-                'role': row[3],
-                'location': row[4],
-                'phone': row[5],
-                'created_at': row[6],
-                'last_login': row[7],
-                'is_active': bool(row[8])
-            })
+        try:
+            fields = users.parse_fields(request.args.get('fields'))
+            filters = users.parse_filters(request.args)
+            after = users.decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+            limit = int(request.args.get('limit', app.config['USERS_PAGE_SIZE']))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        limit = max(1, min(limit, app.config['USERS_MAX_PAGE_SIZE']))
         
-        conn.close()
-        return jsonify({'users': users}), 200
+        # Keyset pages on (created_at, id), newest first
+        rows, next_cursor = users.list_users(get_db(), fields, filters, limit, after)
+        return jsonify({'users': _user_dicts(fields, rows), 'next_cursor': next_cursor}), 200
         
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({'message': 'Failed to fetch users', 'error': str(e)}), 500
 
+@app.route('/api/users/search', methods=['GET'])
+@token_required
+def search_users(current_user_id):
+    try:
+        query = request.args.get('q', '').strip()
+        if len(query) < users.MIN_SEARCH_LENGTH:
+            return jsonify({'message': f'q must be at least {users.MIN_SEARCH_LENGTH} characters'}), 400
+        try:
+            fields = users.parse_fields(request.args.get('fields'))
+            filters = users.parse_filters(request.args)
+            limit = int(request.args.get('limit', app.config['USERS_PAGE_SIZE']))
+            offset = max(0, int(request.args.get('offset', 0)))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        limit = max(1, min(limit, app.config['USERS_MAX_PAGE_SIZE']))
+        
+        # Ranked by bm25 over the trigram index, so substrings of any word match
+        rows, next_offset = users.search_users(get_db(), query, fields, filters, limit, offset)
+        return jsonify({'users': _user_dicts(fields, rows), 'next_offset': next_offset}), 200
+        
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        return jsonify({'message': 'Failed to search users', 'error': str(e)}), 500
+
 # Analytics endpoints
 @app.route('/api/analytics/dashboard', methods=['GET'])
 @token_required
 def get_dashboard_analytics(current_user_id):
     try:
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
-        
-        # Get user counts
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "farmer" AND is_active = 1')
-        active_farmers = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "data_ambassador" AND is_active = 1')
-        data_ambassadors = cursor.fetchone()[0]
-        
-        conn.close()
+        conn = get_db()
+        # Trigger-maintained counters instead of scanning users on every load
+        counts = user_counts.dashboard_counts(conn)
+        # Month-over-month change against the rolled-up snapshot history
+        growth = analytics_rollups.growth_metrics(conn, counts)
         
         return jsonify({
-            'total_users': total_users,
-            'active_farmers': active_farmers,
-            'data_ambassadors': data_ambassadors,
-            'growth_metrics': {
-                'users_growth': '+12% from last month',
-                'farmers_growth': '+8% from last month',
-                'ambassadors_growth': '+15% from last month'
-            }
+            'total_users': counts['total_users'],
+            'active_farmers': counts['active_farmers'],
+            'data_ambassadors': counts['data_ambassadors'],
+            'growth_metrics': {key: format_growth(percent) for key, percent in growth.items()},
+            'growth_percent': growth
         }), 200
         
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({'message': 'Failed to fetch analytics', 'error': str(e)}), 500
 
@@ -246,81 +490,161 @@ def get_weather(current_user_id):
     try:
         lat = request.args.get('lat', '-1.2921')  # Default to Nairobi
         lon = request.args.get('lon', '36.8219')
+        view = request.args.get('view', 'full')
+        if view not in WEATHER_VIEWS:
+            return jsonify({'message': f"view must be one of: {', '.join(WEATHER_VIEWS)}"}), 400
         
-        # Check cache first
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT weather_data FROM weather_cache 
-            WHERE latitude = ? AND longitude = ? 
-            AND datetime(cached_at) > datetime('now', '-1 hour')
-        ''', (float(lat), float(lon)))
+        entry, cell, source = weather_service.get_forecast(float(lat), float(lon))
+        response = forecast_response(entry, request.headers,
+                                     app.config['WEATHER_GZIP_MIN_BYTES'], view=view)
+        response.headers['X-Cache'] = source
+        analytics_events.incr('weather_requests')
+        response.headers['X-Weather-Cell'] = cell.key
+        response.headers['X-Weather-Cell-Center'] = f'{cell.latitude},{cell.longitude}'
+        if (entry.latitude, entry.longitude) != (cell.latitude, cell.longitude):
+            # Served from the nearest cached forecast rather than this cell's own
+            response.headers['X-Weather-Forecast-Location'] = f'{entry.latitude},{entry.longitude}'
+        return response
         
-        cached_data = cursor.fetchone()
+    except ValueError as e:
+        return jsonify({'message': 'Invalid coordinates', 'error': str(e)}), 400
+    except WeatherUnavailable:
+        return jsonify({'message': 'Weather service unavailable'}), 503
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        return jsonify({'message': 'Failed to fetch weather data', 'error': str(e)}), 500
+
+@app.route('/api/weather/batch', methods=['POST'])
+@token_required
+def get_weather_batch(current_user_id):
+    try:
+        # silent: a missing or malformed body gets the 400 below, not a 500
+        data = request.get_json(silent=True)
+        view = request.args.get('view', 'full')
+        if view not in WEATHER_VIEWS:
+            return jsonify({'message': f"view must be one of: {', '.join(WEATHER_VIEWS)}"}), 400
+        locations = data.get('locations') if isinstance(data, dict) else None
+        if not isinstance(locations, list) or not locations:
+            return jsonify({'message': 'A non-empty locations list is required'}), 400
         
-        if cached_data:
-            conn.close()
-            import json
-            return jsonify(json.loads(cached_data[0])), 200
+        max_locations = app.config['WEATHER_BATCH_MAX_LOCATIONS']
+        if len(locations) > max_locations:
+            return jsonify({'message': f'At most {max_locations} locations per batch'}), 400
         
-        # Fetch from Norwegian Meteorological Institute API
-        headers = {
-            'User-Agent': 'HarvestNet/1.0 (contact@harvestnet.com)'
-        }
+        try:
+            points = [(float(location['lat']), float(location['lon'])) for location in locations]
+        except (TypeError, KeyError, ValueError):
+            return jsonify({'message': 'Each location needs numeric lat and lon'}), 400
+        # NaN and Infinity parse as floats but would be echoed back as invalid JSON
+        if not all(math.isfinite(lat) and math.isfinite(lon) for lat, lon in points):
+            return jsonify({'message': 'Each location needs numeric lat and lon'}), 400
         
-        url = f'https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat}&lon={lon}'
-        response = requests.get(url, headers=headers, timeout=10)
+        results = weather_service.get_forecasts(points, timeout=app.config['WEATHER_BATCH_TIMEOUT'])
+        analytics_events.incr('weather_batch_locations', len(points))
+        return batch_response(results, view=view)
         
-        if response.status_code == 200:
-            weather_data = response.json()
-            
-            # Cache the data
-            import json
-            cursor.execute('''
-                INSERT INTO weather_cache (latitude, longitude, weather_data)
-                VALUES (?, ?, ?)
-            ''', (float(lat), float(lon), json.dumps(weather_data)))
-            conn.commit()
-            conn.close()
-            
-            return jsonify(weather_data), 200
-        else:
-            conn.close()
-            return jsonify({'message': 'Weather service unavailable'}), 503
-            
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({'message': 'Failed to fetch weather data', 'error': str(e)}), 500
 
+@app.route('/api/weather/cache', methods=['GET'])
+@token_required
+def get_weather_cache_stats(current_user_id):
+    stats = weather_service.stats()
+    stats['table'] = weather_service.table_stats(get_db())
+    return jsonify(stats), 200
+
 # Data management endpoints
 @app.route('/api/data/export', methods=['GET'])
 @token_required
 def export_data(current_user_id):
     try:
         data_type = request.args.get('type', 'users')
+        fmt = request.args.get('format', 'json')
+        if data_type not in EXPORTS:
+            return jsonify({'message': f"type must be one of: {', '.join(EXPORTS)}"}), 400
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'message': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
         
-        conn = sqlite3.connect('harvestnet.db')
-        cursor = conn.cursor()
+        # Tracked tables report the change_log position the export covers; passing it
+        # back as since= returns only rows changed after it, deletes as tombstones
+        spec = EXPORTS[data_type]
+        cursor = export.current_cursor(get_db()) if spec.tracked else None
+        since = request.args.get('since')
+        if since is not None:
+            if not spec.tracked:
+                return jsonify({'message': f'{data_type} does not support incremental export'}), 400
+            if not since.isdigit():
+                return jsonify({'message': 'since must be a cursor returned by an earlier export'}), 400
+            since = int(since)
+            if since < export.oldest_cursor(get_db()):
+                return jsonify({'message': 'Cursor has expired; run a full export to resync',
+                                'cursor': cursor}), 410
         
-        if data_type == 'users':
-            cursor.execute('SELECT * FROM users')
-            columns = [description[0] for description in cursor.description]
-            rows = cursor.fetchall()
-            
-            data = []
-            for row in rows:
-                data.append(dict(zip(columns, row)))
-        
-        conn.close()
-        
-        return jsonify({
-            'type': data_type,
-            'data': data,
-            'exported_at': datetime.datetime.now().isoformat()
-        }), 200
+        analytics_events.incr('exports')
+        # Streamed in fetchmany chunks, so memory stays flat whatever the table size,
+        # from a connection of its own rather than the request's pooled one
+        database.release_db()
+        return export_response(database.get_pool().open_dedicated, data_type, fmt, request.headers,
+                               chunk_rows=app.config['EXPORT_CHUNK_ROWS'], cursor=cursor, since=since)
         
+    except PoolExhausted:
+        raise
     except Exception as e:
         return jsonify({'message': 'Data export failed', 'error': str(e)}), 500
 
+# Background workers (cache prefetch and maintenance)
+def warm_caches():
+    # Warm start: forecasts still servable from the table go into the memory tier,
+    # and account states into the access bitsets, before the first request needs them
+    with database.connection(app) as conn:
+        weather_service.warm(conn)
+        user_access.load(conn)
+
+def start_background_tasks():
+    weather_service.start()
+    user_counter.start()
+    analytics_rollups.start()
+    analytics_events.start()
+    last_logins.start()
+    user_access.start()
+    change_log.start()
+
+def stop_background_tasks():
+    change_log.stop()
+    user_access.stop()
+    last_logins.stop()
+    analytics_events.stop()
+    analytics_rollups.stop()
+    user_counter.stop()
+    weather_service.stop()
+    password_service.stop()
+
+_background_started = False
+_background_lock = threading.Lock()
+
+@app.before_request
+def _ensure_background_tasks():
+    # Started by the first request in whichever process serves the app (python app.py,
+    # flask run or a WSGI server), so the reloader's parent process and plain imports
+    # stay idle. Buffered logins and events are flushed by the atexit hook.
+    global _background_started
+    if _background_started or not app.config['BACKGROUND_TASKS']:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        try:
+            warm_caches()
+        except Exception:
+            # A cold cache only costs the first lookups; still serve and start the workers
+            logger.exception('Warming caches failed')
+        start_background_tasks()
+        atexit.register(stop_background_tasks)
+        _background_started = True
+
 if __name__ == '__main__':
     init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,393 @@
+import datetime
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import jwt
+from flask import Flask
+
+from cache import Counters, LRUCache
+from database import get_db
+from tasks import PeriodicTask
+
+
+def _sql_timestamp(epoch: float) -> str:
+    """Epoch seconds in the UTC 'YYYY-MM-DD HH:MM:SS' form CURRENT_TIMESTAMP writes"""
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def create_schema(cursor: sqlite3.Cursor) -> None:
+    """Tables behind UserAccess: persisted token revocations and a trigger-fed log
+    of users whose access may have changed"""
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            expires_at INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS user_access_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        );
+
+        CREATE TRIGGER IF NOT EXISTS user_access_insert AFTER INSERT ON users BEGIN
+            INSERT INTO user_access_log (user_id) VALUES (new.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS user_access_update AFTER UPDATE OF is_active ON users
+        WHEN old.is_active IS NOT new.is_active BEGIN
+            INSERT INTO user_access_log (user_id) VALUES (new.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS user_access_delete AFTER DELETE ON users BEGIN
+            INSERT INTO user_access_log (user_id) VALUES (old.id);
+        END;
+    ''')
+
+
+class Bitset:
+    """Growable bit array indexed by non-negative integers (one bit per id)"""
+
+    def __init__(self, size: int = 0):
+        self._bits = bytearray((size + 7) // 8)
+
+    def __contains__(self, index: int) -> bool:
+        byte = index >> 3
+        return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << (index & 7)))
+
+    def set(self, index: int, value: bool = True) -> None:
+        byte = index >> 3
+        if byte >= len(self._bits):
+            # Grow geometrically so a run of new ids does not reallocate each time
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        if value:
+            self._bits[byte] |= 1 << (index & 7)
+        else:
+            self._bits[byte] &= ~(1 << (index & 7)) & 0xFF
+
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+
+class UserAccess:
+    """In-memory view of which users may use their tokens and which tokens were revoked.
+
+    Two bitsets over user ids (known, active) cost 2 bits per user. They are loaded
+    once, then kept current from user_access_log, which triggers append to whenever
+    a user is created, deleted or has is_active changed. Ids not yet seen are looked
+    up once. Revoked token ids are held until their exp passes.
+
+    The background syncer normally applies the log; if it falls more than
+    max_staleness seconds behind (or is not running), check catches up inline."""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.known = Bitset()
+        self.active = Bitset()
+        self.loaded = False
+        self.last_seq = 0
+        self.synced_at = 0.0
+        self.max_staleness = 10.0
+        self.log_retention = 86400
+        self.syncer: Optional[PeriodicTask] = None
+        self.counters = Counters('checks', 'denied_inactive', 'denied_revoked', 'lookups',
+                                 'synced_changes', 'inline_syncs', 'revocations')
+        self._revoked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Poll the change log every USER_ACCESS_SYNC_INTERVAL seconds"""
+        app.config.setdefault('USER_ACCESS_SYNC_INTERVAL', 5)
+        # Oldest the in-memory view may get before a check applies the log itself
+        app.config.setdefault('USER_ACCESS_MAX_STALENESS', 10)
+        app.config.setdefault('USER_ACCESS_LOG_RETENTION', 86400)
+        self.max_staleness = app.config['USER_ACCESS_MAX_STALENESS']
+        self.log_retention = app.config['USER_ACCESS_LOG_RETENTION']
+        self.syncer = PeriodicTask('user-access-sync', app.config['USER_ACCESS_SYNC_INTERVAL'],
+                                   lambda: self._sync_and_prune(get_db()), app=app)
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        """Build both bitsets and the revoked set from scratch"""
+        with self._lock:
+            self.last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM user_access_log').fetchone()[0]
+            max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+            known, active = Bitset(max_id + 1), Bitset(max_id + 1)
+            for user_id, is_active in conn.execute('SELECT id, is_active FROM users'):
+                known.set(user_id)
+                active.set(user_id, is_active == 1)
+            self.known, self.active = known, active
+            self._revoked = dict(conn.execute('SELECT jti, expires_at FROM revoked_tokens WHERE expires_at > ?',
+                                              (int(time.time()),)))
+            self.synced_at = time.monotonic()
+            self.loaded = True
+
+    def sync(self, conn: sqlite3.Connection) -> int:
+        """Apply users changed since the last sync (read-only); returns how many were refreshed"""
+        if not self.loaded:
+            self.load(conn)
+            return 0
+        started = time.monotonic()
+        changes = conn.execute('SELECT seq, user_id FROM user_access_log WHERE seq > ? ORDER BY seq',
+                               (self.last_seq,)).fetchall()
+        if changes:
+            user_ids = sorted({user_id for _seq, user_id in changes})
+            placeholders = ', '.join('?' * len(user_ids))
+            states = dict(conn.execute(f'SELECT id, is_active FROM users WHERE id IN ({placeholders})',
+                                       user_ids))
+            with self._lock:
+                for user_id in user_ids:
+                    self.known.set(user_id)
+                    # Deleted users stay known and inactive
+                    self.active.set(user_id, states.get(user_id) == 1)
+                self.last_seq = changes[-1][0]
+            self.counters.incr('synced_changes', len(user_ids))
+
+        now = time.time()
+        with self._lock:
+            self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        self.synced_at = started
+        return len(changes)
+
+    def prune(self, conn: sqlite3.Connection) -> None:
+        """Drop log entries past retention and revocations past their exp"""
+        now = time.time()
+        conn.execute('DELETE FROM user_access_log WHERE changed_at < ?', (int(now - self.log_retention),))
+        conn.execute('DELETE FROM revoked_tokens WHERE expires_at <= ?', (int(now),))
+        conn.commit()
+
+    def _sync_and_prune(self, conn: sqlite3.Connection) -> None:
+        with self._sync_lock:
+            self.sync(conn)
+        self.prune(conn)
+
+    def _catch_up(self, conn: sqlite3.Connection) -> None:
+        """Apply the log on the request path when the syncer has not kept up"""
+        with self._sync_lock:
+            if time.monotonic() - self.synced_at > self.max_staleness:
+                self.counters.incr('inline_syncs')
+                self.sync(conn)
+
+    def check(self, get_conn: Callable[[], sqlite3.Connection], claims: Dict[str, Any]) -> Optional[str]:
+        """None if the token may be used, otherwise the reason it may not. get_conn is
+        only called when the answer is not already in memory (first load, a stale
+        view or an unseen user id), so most checks borrow no connection at all."""
+        self.counters.incr('checks')
+        if not self.loaded:
+            self.load(get_conn())
+        elif time.monotonic() - self.synced_at > self.max_staleness:
+            self._catch_up(get_conn())
+        jti = claims.get('jti')
+        if jti is not None and jti in self._revoked:
+            self.counters.incr('denied_revoked')
+            return 'Token has been revoked'
+        user_id = claims['user_id']
+        if user_id not in self.known:
+            # Created since the last sync: one primary-key lookup, then cached
+            self.counters.incr('lookups')
+            row = get_conn().execute('SELECT is_active FROM users WHERE id = ?', (user_id,)).fetchone()
+            with self._lock:
+                self.known.set(user_id)
+                self.active.set(user_id, row is not None and row[0] == 1)
+        if user_id not in self.active:
+            self.counters.incr('denied_inactive')
+            return 'Account is inactive'
+        return None
+
+    def revoke(self, conn: sqlite3.Connection, claims: Dict[str, Any]) -> bool:
+        """Revoke one token by its jti until it would have expired anyway"""
+        jti = claims.get('jti')
+        if jti is None:
+            return False
+        expires_at = claims.get('exp', time.time() + 86400)
+        conn.execute('INSERT OR REPLACE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)',
+                     (jti, int(expires_at)))
+        conn.commit()
+        with self._lock:
+            self._revoked[jti] = expires_at
+        self.counters.incr('revocations')
+        return True
+
+    def start(self) -> None:
+        if self.syncer is not None:
+            self.syncer.start()
+
+    def stop(self) -> None:
+        if self.syncer is not None:
+            self.syncer.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        """Check and denial counts plus the memory held by the sets"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        with self._lock:
+            stats['revoked_tokens'] = len(self._revoked)
+            stats['bitset_bytes'] = self.known.nbytes() + self.active.nbytes()
+        stats['last_seq'] = self.last_seq
+        stats['staleness_seconds'] = round(time.monotonic() - self.synced_at, 1) if self.loaded else None
+        if self.syncer is not None:
+            stats['syncer'] = self.syncer.stats()
+        return stats
+
+
+class TokenVerifier:
+    """jwt.decode behind a bounded LRU of already-verified tokens.
+
+    Entries are keyed by a digest of the token keyed with the signing secret, so a
+    changed SECRET_KEY can never hit tokens verified under the old one, and each
+    entry expires with the token's exp claim (capped at JWT_CACHE_MAX_TTL)."""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.app = None
+        self.algorithms = ['HS256']
+        self.max_ttl = 300.0
+        self.cache = LRUCache(max_size=4096)
+        self._secret: Any = None
+        self._digest_key = b''
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Size the cache from JWT_CACHE_SIZE and JWT_CACHE_MAX_TTL"""
+        app.config.setdefault('JWT_CACHE_SIZE', 4096)
+        # Upper bound on how long a verified token is trusted without re-checking it
+        app.config.setdefault('JWT_CACHE_MAX_TTL', 300)
+        self.app = app
+        self.max_ttl = app.config['JWT_CACHE_MAX_TTL']
+        self.cache = LRUCache(max_size=app.config['JWT_CACHE_SIZE'])
+
+    def _key(self, token: str) -> bytes:
+        secret = self.app.config['SECRET_KEY']
+        with self._lock:
+            if secret is not self._secret:
+                # SECRET_KEY was changed in place: nothing verified before can match
+                self._secret = secret
+                self._digest_key = hashlib.sha256(str(secret).encode('utf-8')).digest()
+                self.cache.clear()
+            digest_key = self._digest_key
+        return hashlib.blake2b(token.encode('utf-8'), digest_size=16, key=digest_key).digest()
+
+    def decode(self, token: str) -> Dict[str, Any]:
+        """Verified claims of a token; raises jwt.InvalidTokenError like jwt.decode"""
+        key = self._key(token)
+        claims = self.cache.get(key)
+        if claims is not None:
+            if 'exp' not in claims or claims['exp'] > time.time():
+                return claims
+            self.cache.pop(key)
+            raise jwt.ExpiredSignatureError('Signature has expired')
+
+        claims = jwt.decode(token, self.app.config['SECRET_KEY'], algorithms=self.algorithms)
+        ttl = self.max_ttl
+        if 'exp' in claims:
+            ttl = min(ttl, claims['exp'] - time.time())
+        if ttl > 0:
+            self.cache.set(key, claims, ttl=ttl)
+        return claims
+
+    def rotate_secret(self, secret: str) -> None:
+        """Switch the signing secret and drop every cached verification"""
+        self.app.config['SECRET_KEY'] = secret
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Forget all verified tokens"""
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache hit rate and occupancy"""
+        stats = self.cache.stats()
+        stats['max_ttl_seconds'] = self.max_ttl
+        return stats
+
+
+class LastLoginBuffer:
+    """Write-behind users.last_login: logins record in memory, a background task
+    writes them in one batched transaction. Pending entries are coalesced per user,
+    so the buffer is bounded by the number of distinct users logging in."""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self._pending: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flusher: Optional[PeriodicTask] = None
+        self.counters = Counters('recorded', 'flushes', 'flushed_rows', 'flush_failures')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Flush every LAST_LOGIN_FLUSH_INTERVAL seconds"""
+        app.config.setdefault('LAST_LOGIN_FLUSH_INTERVAL', 5)
+        self.flusher = PeriodicTask('last-login-flush', app.config['LAST_LOGIN_FLUSH_INTERVAL'],
+                                    lambda: self.flush(get_db()), app=app)
+
+    def record(self, user_id: int, at: Optional[float] = None) -> None:
+        """Note a login; never touches the database"""
+        at = time.time() if at is None else at
+        with self._lock:
+            if at > self._pending.get(user_id, 0):
+                self._pending[user_id] = at
+        self.counters.incr('recorded')
+
+    def latest(self, user_id: int, stored: Optional[str]) -> Optional[str]:
+        """The user's last_login including a login not yet flushed"""
+        with self._lock:
+            pending = self._pending.get(user_id)
+        if pending is None:
+            return stored
+        pending_text = _sql_timestamp(pending)
+        return pending_text if stored is None or pending_text > stored else stored
+
+    def flush(self, conn: sqlite3.Connection) -> int:
+        """Write all pending logins in one transaction; returns the number of users written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            rows = [(text, user_id, text) for user_id, text in
+                    ((user_id, _sql_timestamp(at)) for user_id, at in pending.items())]
+            try:
+                conn.executemany('''
+                    UPDATE users SET last_login = ?
+                    WHERE id = ? AND (last_login IS NULL OR last_login < ?)
+                ''', rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                self.counters.incr('flush_failures')
+                # Put them back for the next attempt, keeping any newer logins
+                with self._lock:
+                    for user_id, at in pending.items():
+                        if at > self._pending.get(user_id, 0):
+                            self._pending[user_id] = at
+                raise
+            self.counters.incr('flushes')
+            self.counters.incr('flushed_rows', len(rows))
+            return len(rows)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def start(self) -> None:
+        if self.flusher is not None:
+            self.flusher.start()
+
+    def stop(self) -> None:
+        """Stop the flush task and write whatever is still pending"""
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher.run_once()
+
+    def stats(self) -> Dict[str, Any]:
+        """Recorded and flushed login counts plus the current backlog"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['pending'] = self.pending()
+        if self.flusher is not None:
+            stats['flusher'] = self.flusher.stats()
+        return stats
@@ -0,0 +1,337 @@
+"""Micro-benchmarks for HarvestNet backend hot paths.
+
+Usage: python benchmark.py [name ...] [--iterations N]
+Run without names to execute every benchmark.
+"""
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import jwt
+from flask import jsonify
+
+import user_counts
+from analytics import AnalyticsBuffer, AnalyticsRollups
+from passwords import Pbkdf2Hasher, PasswordService, ScryptHasher
+from app import app, migrate_db, token_verifier, weather_service
+from weather import (WeatherEntry, encode_payload, encode_summary, forecast_response,
+                     payload_kwargs)
+
+
+def sample_forecast(hours: int = 90) -> Dict[str, Any]:
+    """A met.no compact document shaped like a real 9-day Nairobi forecast"""
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    timeseries = []
+    for hour in range(hours):
+        instant = {
+            'air_pressure_at_sea_level': 1012.4 + hour % 7 * 0.3,
+            'air_temperature': 14.5 + (hour % 24) * 0.55,
+            'cloud_area_fraction': float(hour * 13 % 100),
+            'relative_humidity': 55.0 + hour % 30,
+            'wind_from_direction': float(hour * 37 % 360),
+            'wind_speed': 1.5 + hour % 9 * 0.4,
+        }
+        summary = {'summary': {'symbol_code': 'partlycloudy_day'},
+                   'details': {'precipitation_amount': round(hour % 5 * 0.2, 1)}}
+        timeseries.append({
+            'time': (start + datetime.timedelta(hours=hour)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'data': {'instant': {'details': instant},
+                     'next_1_hours': summary, 'next_6_hours': summary, 'next_12_hours': summary},
+        })
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [36.82, -1.29, 1661]},
+        'properties': {
+            'meta': {'updated_at': '2024-01-01T00:00:00Z',
+                     'units': {'air_temperature': 'celsius', 'precipitation_amount': 'mm',
+                               'wind_speed': 'm/s'}},
+            'timeseries': timeseries,
+        },
+    }
+
+
+def _time_per_call(fn: Callable[[], Any], iterations: int) -> Dict[str, float]:
+    """Wall and CPU microseconds per call"""
+    fn()  # warm-up
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(iterations):
+        fn()
+    return {
+        'wall_us': (time.perf_counter() - wall) / iterations * 1e6,
+        'cpu_us': (time.process_time() - cpu) / iterations * 1e6,
+    }
+
+
+def _report(title: str, results: Dict[str, Dict[str, float]], baseline: str) -> None:
+    print(f'\n== {title}')
+    base_cpu = results[baseline]['cpu_us']
+    for name, result in results.items():
+        saved = base_cpu - result['cpu_us']
+        print(f"  {name:<34} {result['cpu_us']:>10.1f} us cpu  {result['wall_us']:>10.1f} us wall"
+              f"  saved {saved:>9.1f} us/hit")
+
+
+def bench_weather_hit(iterations: int) -> None:
+    """CPU cost of serving a weather cache hit: parse + jsonify vs stored bytes"""
+    text = json.dumps(sample_forecast())
+    entry = WeatherEntry(-1.29, 36.82, text.encode('utf-8'), expires_at=time.time() + 3600)
+    entry.gzip_body  # compressed once at cache-fill time, as in production
+
+    plain = {}
+    gzipped = {'Accept-Encoding': 'gzip'}
+    with app.test_request_context():
+        results = {
+            'json.loads + jsonify': _time_per_call(
+                lambda: jsonify(json.loads(text)).get_data(), iterations),
+            'pre-serialized bytes': _time_per_call(
+                lambda: forecast_response(entry, plain).get_data(), iterations),
+            'pre-serialized gzip': _time_per_call(
+                lambda: forecast_response(entry, gzipped).get_data(), iterations),
+        }
+    print(f'\nForecast payload: {len(entry.body)} bytes, {len(entry.gzip_body)} bytes gzipped')
+    _report('weather cache hit', results, baseline='json.loads + jsonify')
+
+
+def bench_weather_storage(iterations: int) -> None:
+    """Disk use and read cost of weather_cache rows: JSON text vs gzip blobs"""
+    rows = 500
+    text = json.dumps(sample_forecast())
+    entry = WeatherEntry(-1.29, 36.82, text.encode('utf-8'), expires_at=time.time() + 3600)
+    layouts = {'json text (legacy)': text, 'gzip blob': encode_payload(entry)}
+
+    print(f'\n== weather_cache disk use ({rows} rows)')
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, value in layouts.items():
+            path = os.path.join(tmp, f'{len(results)}.db')
+            conn = sqlite3.connect(path)
+            conn.execute('''CREATE TABLE weather_cache (id INTEGER PRIMARY KEY, latitude REAL,
+                            longitude REAL, weather_data BLOB NOT NULL)''')
+            conn.executemany('INSERT INTO weather_cache (latitude, longitude, weather_data) VALUES (?, ?, ?)',
+                             [(-1.29 + i * 0.01, 36.82, value) for i in range(rows)])
+            conn.commit()
+            conn.execute('VACUUM')
+            disk_bytes = os.path.getsize(path)
+
+            def read_row(i=[0], plain=True):
+                i[0] = (i[0] + 1) % rows
+                stored = conn.execute('SELECT weather_data FROM weather_cache WHERE id = ?',
+                                      (i[0] + 1,)).fetchone()[0]
+                loaded = WeatherEntry(-1.29, 36.82, expires_at=0, **payload_kwargs(stored))
+                return loaded.body if plain else loaded.gzip_body
+
+            results[name] = _time_per_call(read_row, iterations)
+            results[name + ' -> gzip client'] = _time_per_call(lambda: read_row(plain=False), iterations)
+            print(f'  {name:<34} {disk_bytes / rows:>10.0f} bytes/row on disk')
+            conn.close()
+
+    _report('weather_cache row read', results, baseline='json text (legacy)')
+
+
+def bench_weather_summary(iterations: int) -> None:
+    """Bytes on the wire and serving cost of view=summary vs the full forecast"""
+    document = sample_forecast(hours=216)
+    text = json.dumps(document)
+    entry = WeatherEntry(-1.29, 36.82, text.encode('utf-8'), expires_at=time.time() + 3600,
+                         summary=encode_summary(document))
+    entry.gzip_body
+
+    gzipped = {'Accept-Encoding': 'gzip'}
+    with app.test_request_context():
+        sizes = {view: len(forecast_response(entry, gzipped, view=view).get_data())
+                 for view in ('full', 'summary')}
+        results = {
+            'full (gzip)': _time_per_call(
+                lambda: forecast_response(entry, gzipped).get_data(), iterations),
+            'summary, computed per request': _time_per_call(
+                lambda: encode_summary(json.loads(entry.body)), iterations),
+            'summary, stored with entry': _time_per_call(
+                lambda: forecast_response(entry, gzipped, view='summary').get_data(), iterations),
+        }
+    print(f"\nWire bytes: full {sizes['full']}, summary {sizes['summary']} "
+          f"({sizes['summary'] / sizes['full']:.1%} of full)")
+    _report('weather summary', results, baseline='summary, computed per request')
+
+
+def bench_weather_nearest(iterations: int) -> None:
+    """Nearest-cached-forecast lookup over tens of thousands of cached cells"""
+    points = 50000
+    payload = encode_payload(WeatherEntry(0, 0, json.dumps(sample_forecast(hours=6)).encode('utf-8')))
+    expires_at = int(time.time()) + 3600
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'nearest.db'))
+        migrate_db(conn)
+        # A 0.02 degree lattice over Kenya: every other 0.01 grid cell cached
+        conn.executemany('INSERT INTO weather_cache (latitude, longitude, weather_data, expires_at) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(round(-4.0 + (i // 250) * 0.02, 4), round(34.0 + (i % 250) * 0.02, 4),
+                           payload, expires_at) for i in range(points)])
+        conn.commit()
+
+        probes = [(-1.2921 + i * 0.0037 % 2, 36.8219 - i * 0.0041 % 2) for i in range(64)]
+        results = {}
+        for name, radius in (('exact cell only (radius 0)', 0), ('R*Tree, 5 km radius', 5.0),
+                             ('R*Tree, 25 km radius', 25.0)):
+            weather_service.nearest_radius_km = radius
+
+            def lookup(i=[0]):
+                i[0] = (i[0] + 1) % len(probes)
+                lat, lon = probes[i[0]]
+                return (weather_service._load(conn, round(lat, 2), round(lon, 2))
+                        or weather_service._nearest(conn, lat, lon))
+
+            results[name] = _time_per_call(lookup, iterations)
+        conn.close()
+    weather_service.nearest_radius_km = app.config['WEATHER_NEAREST_RADIUS_KM']
+    print(f'\n{points} cached cells')
+    _report('weather nearest lookup', results, baseline='exact cell only (radius 0)')
+
+
+def bench_dashboard_counts(iterations: int) -> None:
+    """Dashboard user totals: three COUNT(*) scans vs the trigger-maintained counters"""
+    users = 100000
+    roles = ['farmer'] * 7 + ['buyer', 'data_ambassador', 'administrator']
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'counts.db'))
+        migrate_db(conn)
+        conn.executemany('INSERT INTO users (email, password_hash, name, role, is_active) VALUES (?, ?, ?, ?, ?)',
+                         [(f'user{i}@example.com', 'x', f'User {i}', roles[i % len(roles)], int(i % 13 != 0))
+                          for i in range(users)])
+        conn.commit()
+
+        def scans():
+            return [conn.execute(sql).fetchone()[0] for sql in (
+                'SELECT COUNT(*) FROM users WHERE is_active = 1',
+                "SELECT COUNT(*) FROM users WHERE role = 'farmer' AND is_active = 1",
+                "SELECT COUNT(*) FROM users WHERE role = 'data_ambassador' AND is_active = 1")]
+
+        results = {
+            'three COUNT(*) scans': _time_per_call(scans, max(1, iterations // 100)),
+            'user_counts table': _time_per_call(lambda: user_counts.dashboard_counts(conn), iterations),
+            'reconcile (one GROUP BY)': _time_per_call(lambda: user_counts.reconcile(conn),
+                                                       max(1, iterations // 100)),
+        }
+        conn.close()
+    print(f'\n{users} users')
+    _report('dashboard user counts', results, baseline='three COUNT(*) scans')
+
+
+def bench_analytics_ingest(iterations: int) -> None:
+    """Request-path cost of recording an analytics event: own commit vs write-behind buffer"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'analytics.db'))
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        migrate_db(conn)
+        events = AnalyticsBuffer(AnalyticsRollups())
+
+        def insert_and_commit():
+            conn.execute('INSERT INTO analytics (metric_name, metric_value) VALUES (?, ?)',
+                         ('weather_requests', 1))
+            conn.commit()
+
+        results = {
+            'INSERT + commit per event': _time_per_call(insert_and_commit, iterations),
+            'buffer.incr (request path)': _time_per_call(lambda: events.incr('weather_requests'),
+                                                         iterations),
+        }
+        flush_started = time.perf_counter()
+        flushed = events.flush(conn)
+        flush_ms = (time.perf_counter() - flush_started) * 1000
+        conn.close()
+    _report('analytics event ingest', results, baseline='INSERT + commit per event')
+    print(f'  background flush of {flushed} events: {flush_ms:.2f} ms, one transaction')
+
+
+PASSWORD_SETTINGS = [
+    ScryptHasher(n=2 ** 13), ScryptHasher(n=2 ** 14), ScryptHasher(n=2 ** 15),
+    Pbkdf2Hasher(iterations=200000), Pbkdf2Hasher(iterations=600000),
+]
+
+
+def _logins_per_second(service: PasswordService, encoded: str, logins: int, concurrency: int) -> float:
+    remaining = [logins]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            service.check('password123', encoded)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return logins / (time.perf_counter() - started)
+
+
+def bench_password_hash(iterations: int) -> None:
+    """Login verifications per second at each KDF cost setting, inline and on the worker pool"""
+    workers = os.cpu_count() or 1
+    logins = max(8, iterations // 100)
+    print(f'\n== password verification ({logins} logins per setting, {workers} worker process(es))')
+    print(f"  {'setting':<34} {'ms/verify':>10} {'inline/s':>10} {'pool/s':>10}")
+    for hasher in PASSWORD_SETTINGS:
+        encoded = hasher.encode('password123')
+        service = PasswordService()
+        service.hasher = hasher
+        service.max_pending = logins
+        service._slots = threading.BoundedSemaphore(logins)
+        inline = _logins_per_second(service, encoded, logins, concurrency=1)
+        service.workers = workers
+        service.check('password123', encoded)  # start the pool
+        pooled = _logins_per_second(service, encoded, logins, concurrency=2 * workers)
+        service.stop()
+        label = hasher.encode_prefix().rstrip('$')
+        print(f'  {label:<34} {1000 / inline:>10.1f} {inline:>10.1f} {pooled:>10.1f}')
+
+
+def bench_jwt_verify(iterations: int) -> None:
+    """token_required cost per request: jwt.decode every time vs the verified-token cache"""
+    token = jwt.encode({'user_id': 1, 'email': 'admin@harvestnet.com', 'role': 'administrator',
+                        'exp': int(time.time()) + 3600}, app.config['SECRET_KEY'], algorithm='HS256')
+    results = {
+        'jwt.decode': _time_per_call(
+            lambda: jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256']), iterations),
+        'TokenVerifier (cached)': _time_per_call(lambda: token_verifier.decode(token), iterations),
+    }
+    _report('JWT verification', results, baseline='jwt.decode')
+
+
+BENCHMARKS: Dict[str, Callable[[int], None]] = {
+    'weather-hit': bench_weather_hit,
+    'weather-storage': bench_weather_storage,
+    'weather-summary': bench_weather_summary,
+    'weather-nearest': bench_weather_nearest,
+    'dashboard-counts': bench_dashboard_counts,
+    'analytics-ingest': bench_analytics_ingest,
+    'password-hash': bench_password_hash,
+    'jwt-verify': bench_jwt_verify,
+}
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', help=f"any of: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args.iterations)
+
+
+if __name__ == '__main__':
+    main()
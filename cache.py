@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Hashable, Optional, Tuple
+
+
+class Counters:
+    """Thread-safe named counters for cache and service metrics"""
+
+    def __init__(self, *names: str):
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = {name: 0 for name in names}
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        """Add amount to the named counter"""
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name: str) -> int:
+        """Current value of the named counter"""
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        """Copy of all counters"""
+        with self._lock:
+            return dict(self._values)
+
+
+class LRUCache:
+    """Bounded in-process LRU cache with per-entry TTL expiry"""
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counters('hits', 'misses', 'evictions', 'expirations')
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value and mark it most recently used"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.counters.incr('misses')
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.counters.incr('expirations')
+                self.counters.incr('misses')
+                return default
+            self._data.move_to_end(key)
+            self.counters.incr('hits')
+            return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Return an unexpired value without touching recency or counters"""
+        with self._lock:
+            item = self._data.get(key)
+        if item is None or (item[1] is not None and item[1] <= time.monotonic()):
+            return default
+        return item[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Insert or replace a value, evicting the least recently used on overflow"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.counters.incr('evictions')
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a key, returning its value if present"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        """Drop every entry; counters are kept"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[1] is None or item[1] > time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters plus current occupancy"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['size'] = len(self)
+        stats['max_size'] = self.max_size
+        return stats
+
+
+class _Flight:
+    """One in-progress call that other callers can wait on"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.counters = Counters('executions', 'coalesced')
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[Any, bool]:
+        """Run fn once per key at a time; returns (result, shared) where shared
+        is True for callers that waited on another caller's execution.
+        Errors raised by the executing call are re-raised in every waiter."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            self.counters.incr('coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        self.counters.incr('executions')
+        try:
+            flight.result = fn(*args, **kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def in_flight(self) -> int:
+        """Number of keys currently executing"""
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self) -> Dict[str, Any]:
+        """Execution and coalesced-caller counters"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['in_flight'] = self.in_flight()
+        return stats
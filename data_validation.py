@@ -1,8 +1,16 @@
 import sqlite3
 import re
 import datetime
+import time
 from typing import Dict, List, Tuple, Any
 
+import user_counts
+import users
+from analytics import AnalyticsRollups
+
+# Name fragments that mark an account as test data
+DUMMY_NAME_TERMS = ('test', 'dummy', 'sample')
+
 class DataValidator:
     """Data validation and quality assurance for HarvestNet platform"""
     
@@ -106,34 +114,27 @@ class DataValidator:
             'weather_cache_cleared': 0
         }
         
-        # Remove test/dummy users (keep admin and farmer demo accounts)
-        cursor.execute('''
+        # Remove test/dummy users (keep admin and farmer demo accounts); the name
+        # match goes through the users_fts index rather than scanning with LIKE
+        condition, params = users.match_condition(conn, DUMMY_NAME_TERMS, columns=('name',))
+        cursor.execute(f'''
             DELETE FROM users 
             WHERE email NOT IN ('admin@harvestnet.com', 'farmer@harvestnet.com')
-            AND (name LIKE '%test%' OR name LIKE '%dummy%' OR name LIKE '%sample%')
-        ''')
+            AND {condition}
+        ''', params)
         cleanup_results['dummy_users_removed'] = cursor.rowcount
         
-        # Update analytics with real calculated values
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "farmer" AND is_active = 1')
-        active_farmers = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "data_ambassador" AND is_active = 1')
-        data_ambassadors = cursor.fetchone()[0]
-        
-        # Update analytics table with real values
-        cursor.execute('UPDATE analytics SET metric_value = ? WHERE metric_name = "total_users"', (total_users,))
-        cursor.execute('UPDATE analytics SET metric_value = ? WHERE metric_name = "active_farmers"', (active_farmers,))
-        cursor.execute('UPDATE analytics SET metric_value = ? WHERE metric_name = "data_ambassadors"', (data_ambassadors,))
-        cleanup_results['dummy_analytics_updated'] = 3
+        # Record the real values as a new sample; analytics keeps the history, so the
+        # earlier rows stay as they were. The delete above already moved the counters.
+        counts = user_counts.dashboard_counts(conn)
+        AnalyticsRollups().record(conn, counts.items(), time.time())
+        cleanup_results['dummy_analytics_updated'] = len(counts)
         
-        # Clear old weather cache (older than 1 hour)
+        # Clear old weather cache (older than 1 hour); cached_at is compared as stored
+        # so idx_weather_cache_cached_at can serve the range
         cursor.execute('''
             DELETE FROM weather_cache 
-            WHERE datetime(cached_at) < datetime('now', '-1 hour')
+            WHERE cached_at < datetime('now', '-1 hour')
         ''')
         cleanup_results['weather_cache_cleared'] = cursor.rowcount
         
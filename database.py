@@ -0,0 +1,213 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional
+
+from flask import Flask, g, current_app
+
+# Pragmas applied to every pooled connection. WAL lets readers keep going
+# while a writer holds the lock, and busy_timeout makes writers queue for the
+# lock instead of failing immediately with "database is locked".
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'foreign_keys': 'ON',
+    'temp_store': 'MEMORY',
+    'cache_size': -8000,          # ~8 MB page cache per connection
+    'mmap_size': 64 * 1024 * 1024,
+}
+
+
+class PoolExhausted(Exception):
+    """Raised when no pooled connection becomes free within the pool timeout"""
+
+
+class ConnectionPool:
+    """Bounded pool of reusable SQLite connections for one database file"""
+
+    def __init__(self, db_path: str, max_size: int = 8, timeout: float = 5.0,
+                 pragmas: Optional[Dict[str, Any]] = None):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+
+        self._idle: List[sqlite3.Connection] = []
+        self._closed = False
+        self._created = 0
+        self._in_use = 0
+        self._waits = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection and apply the tuned pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.pragmas['busy_timeout'] / 1000.0,
+            check_same_thread=False,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, opening one if the pool is below its size limit"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._created < self.max_size:
+                    self._created += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        f'No database connection available after {self.timeout}s')
+                self._waits += 1
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """Return a connection to the pool, rolling back any open transaction"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # A broken connection is dropped rather than handed out again
+            conn.close()
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._in_use -= 1
+            if not self._closed:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+            self._created -= 1
+        conn.close()
+
+    def open_dedicated(self) -> sqlite3.Connection:
+        """A connection outside the pool with the same pragmas, for long-lived readers
+        such as streamed exports; the caller closes it"""
+        return self._connect()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection for the duration of a with-block"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self) -> None:
+        """Close every idle connection; checked-out ones are closed on release"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool occupancy counters for the health endpoint"""
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'open': self._created,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waits': self._waits,
+            }
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(app: Optional[Flask] = None) -> ConnectionPool:
+    """Pool for the app's configured DATABASE, created on first use"""
+    app = app or current_app
+    db_path = app.config['DATABASE']
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = ConnectionPool(
+                    db_path,
+                    max_size=app.config.get('DB_POOL_SIZE', 8),
+                    timeout=app.config.get('DB_POOL_TIMEOUT', 5.0),
+                    pragmas={'busy_timeout': app.config.get('DB_BUSY_TIMEOUT_MS', 5000)},
+                )
+                _pools[db_path] = pool
+    return pool
+
+
+def get_db() -> sqlite3.Connection:
+    """Connection bound to the current app context, released on teardown or by release_db"""
+    if 'db' not in g:
+        pool = get_pool()
+        g.db = pool.acquire()
+        g.db_pool = pool
+    return g.db
+
+
+def release_db() -> None:
+    """Hand the context's connection back early; a later get_db borrows another"""
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if conn is not None and pool is not None:
+        pool.release(conn)
+
+
+@contextmanager
+def connection(app: Optional[Flask] = None) -> Iterator[sqlite3.Connection]:
+    """Borrow a pooled connection outside of a request (startup, background jobs)"""
+    with get_pool(app).connection() as conn:
+        yield conn
+
+
+def close_db(exception: Optional[BaseException] = None) -> None:
+    """Teardown hook: hand the context's connection back to its pool"""
+    release_db()
+
+
+def close_pools() -> None:
+    """Close idle connections in every pool (used by tests and shutdown)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+def init_app(app: Flask) -> None:
+    """Register default configuration and the connection teardown hook"""
+    app.config.setdefault('DATABASE', 'harvestnet.db')
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_POOL_TIMEOUT', 5.0)
+    app.config.setdefault('DB_BUSY_TIMEOUT_MS', 5000)
+    app.teardown_appcontext(close_db)
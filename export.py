@@ -0,0 +1,299 @@
+import csv
+import datetime
+import io
+import json
+import sqlite3
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from flask import Flask, Response
+
+from cache import Counters
+from database import get_db
+from tasks import PeriodicTask
+from weather import decode_payload
+
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class ExportSpec:
+    """One exportable table: the columns read, their order, which columns hold JSON
+    that is spliced in as-is, and which columns' updates are change-captured"""
+
+    def __init__(self, table: str, columns: Sequence[str], order_by: str = 'id',
+                 raw_json: Optional[Dict[str, Callable[[Any], bytes]]] = None,
+                 tracked: Sequence[str] = ()):
+        self.table = table
+        self.columns = tuple(columns)
+        self.order_by = order_by
+        self.raw_json = raw_json or {}
+        # Empty for tables without change capture (they only support full exports)
+        self.tracked = tuple(tracked)
+
+    def select_sql(self) -> str:
+        return f"SELECT {', '.join(self.columns)} FROM {self.table} ORDER BY {self.order_by}"
+
+    def changes_sql(self) -> str:
+        """Rows changed in a (since, until] cursor range, latest state first to last.
+        Rows that no longer exist come back as tombstones: deleted = 1, id only."""
+        columns = ', '.join(f't.{name}' for name in self.columns if name != 'id')
+        return f'''
+            SELECT changes.row_id AS id, {columns}, changes.seq AS change_seq, t.id IS NULL AS deleted
+            FROM (
+                SELECT row_id, MAX(seq) AS seq FROM change_log
+                WHERE table_name = ? AND seq > ? AND seq <= ?
+                GROUP BY row_id
+            ) AS changes
+            LEFT JOIN {self.table} AS t ON t.id = changes.row_id
+            ORDER BY changes.seq
+        '''
+
+
+EXPORTS = {
+    # password_hash is deliberately never exported, and rehashing it is not a change
+    'users': ExportSpec('users', ('id', 'email', 'name', 'role', 'location', 'phone', 'created_at',
+                                  'last_login', 'is_active'),
+                        tracked=('email', 'name', 'role', 'location', 'phone', 'last_login', 'is_active')),
+    # last_accessed is rewritten on every read, so it is exported but not tracked
+    'weather_cache': ExportSpec('weather_cache', ('id', 'latitude', 'longitude', 'cached_at', 'expires_at',
+                                                  'last_modified', 'last_accessed', 'weather_data', 'summary'),
+                                raw_json={'weather_data': decode_payload, 'summary': bytes},
+                                tracked=('latitude', 'longitude', 'weather_data', 'cached_at', 'expires_at',
+                                         'last_modified', 'summary')),
+    'analytics': ExportSpec('analytics', ('id', 'metric_name', 'metric_value', 'recorded_at'),
+                            tracked=('metric_name', 'metric_value', 'recorded_at')),
+    'analytics_rollups': ExportSpec('analytics_rollups', ('metric_name', 'resolution', 'bucket_start',
+                                                          'sample_count', 'value_sum', 'value_min', 'value_max',
+                                                          'last_value', 'last_at'),
+                                    order_by='metric_name, resolution, bucket_start'),
+}
+
+
+def create_schema(cursor: sqlite3.Cursor, tracked: Dict[str, Sequence[str]]) -> None:
+    """Create change_log and its triggers for the given {table: tracked columns}.
+    Callers pass the tables explicitly rather than EXPORTS, so a migration keeps
+    creating what it shipped with. Rows that predate the log are picked up by a
+    full export."""
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        );
+        CREATE INDEX IF NOT EXISTS idx_change_log_table ON change_log (table_name, seq, row_id);
+    ''')
+    for table, columns in tracked.items():
+        create_change_triggers(cursor, table, columns)
+
+
+def create_change_triggers(cursor: sqlite3.Cursor, table: str, columns: Sequence[str]) -> None:
+    """Triggers appending to change_log when a row of table is inserted, deleted, or
+    has one of columns changed. A table gaining change capture (a new tracked entry
+    in EXPORTS) needs a migration that calls this."""
+    changed = ' OR '.join(f'old.{name} IS NOT new.{name}' for name in columns)
+    cursor.executescript(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_change_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO change_log (table_name, row_id) VALUES ('{table}', new.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS {table}_change_update
+        AFTER UPDATE OF {', '.join(columns)} ON {table}
+        WHEN {changed} BEGIN
+            INSERT INTO change_log (table_name, row_id) VALUES ('{table}', new.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS {table}_change_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO change_log (table_name, row_id) VALUES ('{table}', old.id);
+        END;
+    ''')
+
+
+def current_cursor(conn: sqlite3.Connection) -> int:
+    """Cursor covering every change logged so far"""
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+
+
+def oldest_cursor(conn: sqlite3.Connection) -> int:
+    """Lowest since value whose changes have not been pruned from the log"""
+    oldest = conn.execute('SELECT MIN(seq) FROM change_log').fetchone()[0]
+    if oldest is not None:
+        return oldest - 1
+    # Empty log: everything up to the last sequence number handed out is gone
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row is not None else 0
+
+
+class ChangeLog:
+    """Retention for change_log. Consumers whose cursor falls behind the retained
+    window are told to re-run a full export."""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.retention_days = 7
+        self.pruner: Optional[PeriodicTask] = None
+        self.counters = Counters('pruned')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Prune entries older than CHANGE_LOG_RETENTION_DAYS every CHANGE_LOG_PRUNE_INTERVAL seconds"""
+        app.config.setdefault('CHANGE_LOG_RETENTION_DAYS', 7)
+        app.config.setdefault('CHANGE_LOG_PRUNE_INTERVAL', 3600)
+        self.retention_days = app.config['CHANGE_LOG_RETENTION_DAYS']
+        self.pruner = PeriodicTask('change-log-prune', app.config['CHANGE_LOG_PRUNE_INTERVAL'],
+                                   lambda: self.prune(get_db()), app=app)
+
+    def prune(self, conn: sqlite3.Connection, now: Optional[float] = None) -> int:
+        """Delete expired entries; returns how many went"""
+        cutoff = int((now if now is not None else time.time()) - self.retention_days * 86400)
+        pruned = conn.execute('DELETE FROM change_log WHERE changed_at < ?', (cutoff,)).rowcount
+        conn.commit()
+        self.counters.incr('pruned', pruned)
+        return pruned
+
+    def start(self) -> None:
+        if self.pruner is not None:
+            self.pruner.start()
+
+    def stop(self) -> None:
+        if self.pruner is not None:
+            self.pruner.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        """Entries pruned and the pruning task's state"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['retention_days'] = self.retention_days
+        if self.pruner is not None:
+            stats['pruner'] = self.pruner.stats()
+        return stats
+
+
+Batches = Iterator[List[tuple]]
+
+
+def _query(conn: sqlite3.Connection, sql: str, params: Sequence[Any],
+           chunk_rows: int) -> Tuple[List[str], Batches]:
+    """Column names and an iterator over fetchmany batches"""
+    cursor = conn.execute(sql, params)
+    columns = [description[0] for description in cursor.description]
+    return columns, iter(lambda: cursor.fetchmany(chunk_rows), [])
+
+
+def _json_rows(columns: Sequence[str], rows: Sequence[tuple],
+               raw_json: Dict[str, Callable[[Any], bytes]]) -> Iterator[bytes]:
+    raw = [(index, name, raw_json[name]) for index, name in enumerate(columns) if name in raw_json]
+    for row in rows:
+        encoded = json.dumps({name: value for name, value in zip(columns, row)
+                              if name not in raw_json}).encode('utf-8')
+        for index, name, decode in raw:
+            value = row[index]
+            encoded = (encoded[:-1] + b', "' + name.encode() + b'": '
+                       + (decode(value) if value is not None else b'null') + b'}')
+        yield encoded
+
+
+def ndjson_chunks(columns: Sequence[str], batches: Batches,
+                  raw_json: Dict[str, Callable[[Any], bytes]]) -> Iterator[bytes]:
+    """One JSON object per line"""
+    for rows in batches:
+        yield b''.join(line + b'\n' for line in _json_rows(columns, rows, raw_json))
+
+
+def json_chunks(columns: Sequence[str], batches: Batches, raw_json: Dict[str, Callable[[Any], bytes]],
+                header: Dict[str, Any]) -> Iterator[bytes]:
+    """The original {"type", "exported_at", "data": [...]} document, written incrementally"""
+    yield json.dumps(header).encode('utf-8')[:-1] + b', "data": ['
+    first = True
+    for rows in batches:
+        chunk = b', '.join(_json_rows(columns, rows, raw_json))
+        yield chunk if first else b', ' + chunk
+        first = False
+    yield b']}'
+
+
+def csv_chunks(columns: Sequence[str], batches: Batches,
+               raw_json: Dict[str, Callable[[Any], bytes]]) -> Iterator[bytes]:
+    """Header row, then one row per record; JSON columns are written as JSON text"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    raw = {index: raw_json[name] for index, name in enumerate(columns) if name in raw_json}
+    for rows in batches:
+        for row in rows:
+            if raw:
+                row = [raw[index](value).decode('utf-8') if index in raw and value is not None else value
+                       for index, value in enumerate(row)]
+            writer.writerow(row)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks: Iterator[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compress a chunk stream into a single gzip member as it is produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(open_conn: Callable[[], sqlite3.Connection], data_type: str, fmt: str,
+                    request_headers: Any, chunk_rows: int = 500, cursor: Optional[int] = None,
+                    since: Optional[int] = None) -> Response:
+    """Streamed export of one table: rows are read chunk_rows at a time and never
+    held all at once. Gzip is applied on the fly when the client accepts it.
+    open_conn must return a connection of the stream's own (not a pooled one);
+    it is closed when the download finishes or the client goes away.
+
+    cursor is the change_log position the export is consistent up to; with since
+    only rows changed in (since, cursor] are sent, including tombstones."""
+    spec = EXPORTS[data_type]
+    if since is not None:
+        sql, params = spec.changes_sql(), (spec.table, since, cursor)
+    else:
+        sql, params = spec.select_sql(), ()
+    header: Dict[str, Any] = {'type': data_type, 'exported_at': datetime.datetime.now().isoformat()}
+    if cursor is not None:
+        header['cursor'] = cursor
+    if since is not None:
+        header['since'] = since
+
+    def generate() -> Iterator[bytes]:
+        # A slow client holds this connection and its read transaction for the whole
+        # download, so it is never one of the pool's
+        conn = open_conn()
+        try:
+            columns, batches = _query(conn, sql, params, chunk_rows)
+            if fmt == 'ndjson':
+                chunks = ndjson_chunks(columns, batches, spec.raw_json)
+            elif fmt == 'csv':
+                chunks = csv_chunks(columns, batches, spec.raw_json)
+            else:
+                chunks = json_chunks(columns, batches, spec.raw_json, header)
+            if compress:
+                chunks = gzip_chunks(chunks)
+            yield from chunks
+        finally:
+            conn.close()
+
+    compress = 'gzip' in request_headers.get('Accept-Encoding', '')
+    response = Response(generate(), mimetype=FORMATS[fmt])
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    if cursor is not None:
+        response.headers['X-Export-Cursor'] = str(cursor)
+    if fmt != 'json':
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        name = f'{data_type}-changes' if since is not None else data_type
+        response.headers['Content-Disposition'] = f'attachment; filename="harvestnet-{name}-{stamp}.{fmt}"'
+    return response
@@ -0,0 +1,259 @@
+import socket
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, Optional
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from cache import Counters
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+
+class LatencyBudgetExceeded(requests.Timeout):
+    """Raised when a response takes longer than the per-request latency budget"""
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker with a rolling outcome window and half-open probing.
+
+    closed: calls flow; the breaker trips once at least min_calls of the last
+    window_size calls were recorded and the failure rate reaches failure_rate.
+    open: calls are rejected until reset_timeout has elapsed.
+    half_open: a single probe call is let through; success closes the circuit,
+    failure re-opens it for another reset_timeout."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, window_size: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 reset_timeout: float = 30.0):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes: deque = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may proceed now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                self._probe_in_flight = False
+            self._outcomes.append(True)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trip()
+                return
+            self._outcomes.append(False)
+            if self.state == self.CLOSED and len(self._outcomes) >= self.min_calls:
+                if self._outcomes.count(False) / len(self._outcomes) >= self.failure_rate:
+                    self._trip()
+
+    def _trip(self) -> None:
+        self.state = self.OPEN
+        self.trips += 1
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """State, trip count and current window failure rate"""
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = self._outcomes.count(False)
+            stats: Dict[str, Any] = {
+                'state': self.state,
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'window_calls': calls,
+                'window_failure_rate': round(failures / calls, 3) if calls else 0.0,
+            }
+            if self.state == self.OPEN:
+                stats['retry_in_seconds'] = round(
+                    max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+            return stats
+
+
+class MetResponse:
+    """Outcome of one locationforecast request"""
+
+    __slots__ = ('status_code', 'body', 'headers', 'bytes_received', 'latency_ms')
+
+    def __init__(self, status_code: int, body: Optional[bytes], headers: Any,
+                 bytes_received: int, latency_ms: float):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        self.bytes_received = bytes_received
+        self.latency_ms = latency_ms
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status_code == 304
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.headers.get('Last-Modified')
+
+
+def _response_socket(response: requests.Response) -> Optional[socket.socket]:
+    """The socket a streamed response body is read from, or None if it cannot be found.
+    A keep-alive connection still holds it; otherwise http.client has handed it to
+    the response's file object."""
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is None:
+        fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    return sock
+
+
+class MetClient:
+    """Pooled keep-alive HTTP client for api.met.no with conditional GET support,
+    guarded by a circuit breaker and a per-request latency budget (timeout seconds,
+    covering connect and the whole body read)"""
+
+    def __init__(self, url: str, user_agent: str, timeout: float = 5, pool_size: int = 10,
+                 connect_timeout: float = 2, breaker: Optional[CircuitBreaker] = None):
+        self.url = url
+        self.timeout = timeout
+        self.connect_timeout = min(connect_timeout, timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.counters = Counters('requests', 'ok', 'not_modified', 'errors', 'bytes_received')
+        self._latency_lock = threading.Lock()
+        self._latency_total_ms = 0.0
+        self._latency_max_ms = 0.0
+        self._latency_last_ms = 0.0
+
+    def fetch(self, lat: float, lon: float, last_modified: Optional[str] = None) -> MetResponse:
+        """GET the compact forecast, sending If-Modified-Since when a validator is known"""
+        if not self.breaker.allow():
+            raise CircuitOpenError('met.no circuit breaker is open')
+
+        headers = {'If-Modified-Since': last_modified} if last_modified else {}
+        self.counters.incr('requests')
+        started = time.perf_counter()
+        healthy = False
+        try:
+            body, response = self._get(lat, lon, headers, deadline=time.monotonic() + self.timeout)
+            # Server errors and throttling count against the breaker; client errors do not
+            healthy = response.status_code < 500 and response.status_code != 429
+        except Exception:
+            self.counters.incr('errors')
+            raise
+        finally:
+            latency_ms = self._record_latency(started)
+            # Every outcome is recorded, whatever was raised, so a half-open probe always settles
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+        # Content-Length is the on-the-wire (possibly gzipped) size
+        wire_bytes = int(response.headers.get('Content-Length') or len(body))
+        self.counters.incr('bytes_received', wire_bytes)
+
+        if response.status_code == 200:
+            self.counters.incr('ok')
+        elif response.status_code == 304:
+            self.counters.incr('not_modified')
+        else:
+            self.counters.incr('errors')
+        return MetResponse(response.status_code, body if response.status_code == 200 else None,
+                           response.headers, wire_bytes, latency_ms)
+
+    def _get(self, lat: float, lon: float, headers: Dict[str, str], deadline: float):
+        """Stream the response body, giving up once the latency budget is spent"""
+        # total caps connect plus the wait for headers at the budget
+        timeout = urllib3.Timeout(connect=self.connect_timeout, read=self.timeout, total=self.timeout)
+        response = self.session.get(self.url, params={'lat': lat, 'lon': lon}, headers=headers,
+                                    timeout=timeout, stream=True)
+        # read1 (urllib3 2.x) returns whatever has arrived; with the socket timeout
+        # cut to the budget left before every read, neither a trickling nor a
+        # stalled body can hold the request past the deadline
+        read = getattr(response.raw, 'read1', None) or response.raw.read
+        sock = _response_socket(response)
+        chunks = []
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LatencyBudgetExceeded(
+                        f'met.no response exceeded the {self.timeout}s latency budget')
+                if sock is not None:
+                    sock.settimeout(remaining)
+                chunk = read(64 * 1024, decode_content=True)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except requests.RequestException:
+            raise
+        # Reading the raw stream bypasses requests' exception wrapping; a stalled or
+        # reset body surfaces as urllib3/socket errors, so translate them here
+        except (urllib3.exceptions.ReadTimeoutError, TimeoutError) as e:
+            if time.monotonic() >= deadline:
+                raise LatencyBudgetExceeded(
+                    f'met.no response exceeded the {self.timeout}s latency budget') from e
+            raise requests.ReadTimeout(f'met.no response body timed out: {e}') from e
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            raise requests.ConnectionError(f'met.no response body failed: {e}') from e
+        finally:
+            response.close()
+        return b''.join(chunks), response
+
+    def _record_latency(self, started: float) -> float:
+        latency_ms = (time.perf_counter() - started) * 1000
+        with self._latency_lock:
+            self._latency_total_ms += latency_ms
+            self._latency_max_ms = max(self._latency_max_ms, latency_ms)
+            self._latency_last_ms = latency_ms
+        return latency_ms
+
+    def close(self) -> None:
+        self.session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Request, bandwidth and latency metrics"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        with self._latency_lock:
+            requests_made = stats['requests']
+            stats['latency_ms'] = {
+                'avg': round(self._latency_total_ms / requests_made, 2) if requests_made else 0.0,
+                'max': round(self._latency_max_ms, 2),
+                'last': round(self._latency_last_ms, 2),
+            }
+        stats['circuit_breaker'] = self.breaker.stats()
+        return stats
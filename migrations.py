@@ -0,0 +1,60 @@
+import logging
+import sqlite3
+from typing import Callable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class Migration:
+    """One numbered schema change. apply must be idempotent: DDL run through
+    executescript commits as it goes, so a migration interrupted part way is
+    simply run again on the next start."""
+
+    __slots__ = ('version', 'name', 'apply')
+
+    def __init__(self, version: int, name: str, apply: Callable[[sqlite3.Connection], None]):
+        self.version = version
+        self.name = name
+        self.apply = apply
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """Highest migration applied to this database; 0 before the first"""
+    try:
+        return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def migrate(conn: sqlite3.Connection, migrations: Sequence[Migration],
+            target: Optional[int] = None) -> List[int]:
+    """Apply, in order, every migration newer than the database (up to target) and
+    record each in schema_version; returns the versions applied. A database that is
+    already current costs a single SELECT."""
+    versions = [migration.version for migration in migrations]
+    if versions != sorted(set(versions)):
+        raise ValueError('Migration versions must be unique and in ascending order')
+    if target is None:
+        target = versions[-1] if versions else 0
+
+    version = current_version(conn)
+    if version >= target:
+        return []
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    applied = []
+    for migration in migrations:
+        if version < migration.version <= target:
+            logger.info('Applying schema migration %d: %s', migration.version, migration.name)
+            migration.apply(conn)
+            conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)',
+                         (migration.version, migration.name))
+            conn.commit()
+            applied.append(migration.version)
+    return applied
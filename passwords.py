@@ -0,0 +1,287 @@
+import abc
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from flask import Flask
+
+from cache import Counters
+
+
+class PasswordServiceBusy(Exception):
+    """Raised when the verification pool is saturated, too slow or has broken"""
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher(abc.ABC):
+    """A KDF with tunable cost that encodes its parameters into the stored hash:
+    '<algorithm>$<params>$<salt>$<hash>'"""
+
+    algorithm = ''
+
+    @abc.abstractmethod
+    def encode(self, password: str) -> str:
+        """New hash of password, with a fresh salt"""
+
+    @abc.abstractmethod
+    def verify(self, password: str, encoded: str) -> bool:
+        """True if password matches encoded"""
+
+    @abc.abstractmethod
+    def params(self) -> Dict[str, int]:
+        """Cost parameters, as passed back to the constructor"""
+
+    @abc.abstractmethod
+    def encode_prefix(self) -> str:
+        """Leading '<algorithm>$<params>$' part shared by every hash made with these settings"""
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """True if encoded was made by another algorithm or with other cost parameters"""
+        return not encoded.startswith(self.encode_prefix())
+
+
+class ScryptHasher(PasswordHasher):
+    """hashlib.scrypt; memory use is about 128 * n * r bytes per hash"""
+
+    algorithm = 'scrypt'
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1):
+        self.n, self.r, self.p = n, r, p
+
+    def params(self) -> Dict[str, int]:
+        return {'n': self.n, 'r': self.r, 'p': self.p}
+
+    def encode_prefix(self) -> str:
+        return f'scrypt$n={self.n},r={self.r},p={self.p}$'
+
+    def _derive(self, password: str, salt: bytes) -> bytes:
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=self.n, r=self.r, p=self.p,
+                              maxmem=256 * self.n * self.r * max(self.p, 1), dklen=32)
+
+    def encode(self, password: str) -> str:
+        salt = os.urandom(16)
+        return self.encode_prefix() + _b64encode(salt) + '$' + _b64encode(self._derive(password, salt))
+
+    @classmethod
+    def from_encoded(cls, encoded: str) -> 'ScryptHasher':
+        params = dict(item.split('=') for item in encoded.split('$')[1].split(','))
+        return cls(n=int(params['n']), r=int(params['r']), p=int(params['p']))
+
+    def verify(self, password: str, encoded: str) -> bool:
+        _algorithm, _params, salt, expected = encoded.split('$')
+        return hmac.compare_digest(self._derive(password, _b64decode(salt)), _b64decode(expected))
+
+
+class Pbkdf2Hasher(PasswordHasher):
+    """hashlib.pbkdf2_hmac with SHA-256"""
+
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations: int = 600000):
+        self.iterations = iterations
+
+    def params(self) -> Dict[str, int]:
+        return {'iterations': self.iterations}
+
+    def encode_prefix(self) -> str:
+        return f'pbkdf2_sha256${self.iterations}$'
+
+    def _derive(self, password: str, salt: bytes) -> bytes:
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, self.iterations)
+
+    def encode(self, password: str) -> str:
+        salt = os.urandom(16)
+        return self.encode_prefix() + _b64encode(salt) + '$' + _b64encode(self._derive(password, salt))
+
+    @classmethod
+    def from_encoded(cls, encoded: str) -> 'Pbkdf2Hasher':
+        return cls(iterations=int(encoded.split('$')[1]))
+
+    def verify(self, password: str, encoded: str) -> bool:
+        _algorithm, _iterations, salt, expected = encoded.split('$')
+        return hmac.compare_digest(self._derive(password, _b64decode(salt)), _b64decode(expected))
+
+
+class LegacySha256Hasher(PasswordHasher):
+    """Unsalted hex SHA-256 written by earlier releases; verify-only, always rehashed"""
+
+    algorithm = 'sha256'
+
+    def params(self) -> Dict[str, int]:
+        return {}
+
+    def encode_prefix(self) -> str:
+        return ''
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return True
+
+    def encode(self, password: str) -> str:
+        raise ValueError('sha256 password hashes are no longer written')
+
+    def verify(self, password: str, encoded: str) -> bool:
+        return hmac.compare_digest(hashlib.sha256(password.encode('utf-8')).hexdigest(), encoded)
+
+
+HASHERS = {hasher.algorithm: hasher for hasher in (ScryptHasher, Pbkdf2Hasher)}
+
+
+def identify(encoded: str) -> PasswordHasher:
+    """The hasher, with the parameters it was made with, for a stored hash"""
+    algorithm = encoded.split('$', 1)[0]
+    if algorithm in HASHERS:
+        return HASHERS[algorithm].from_encoded(encoded)
+    if len(encoded) == 64 and '$' not in encoded:
+        return LegacySha256Hasher()
+    raise ValueError('Unrecognised password hash format')
+
+
+def check_password(password: str, encoded: str, algorithm: str,
+                   params: Dict[str, int]) -> Tuple[bool, Optional[str]]:
+    """Verify password against encoded and, when it matches but was made with another
+    algorithm or cost, return a replacement hash made with the current settings.
+    A stored hash in no format we know simply fails to match. Top-level so it can
+    run in a worker process."""
+    try:
+        if not identify(encoded).verify(password, encoded):
+            return False, None
+    except (ValueError, KeyError):
+        return False, None
+    current = HASHERS[algorithm](**params)
+    return True, current.encode(password) if current.needs_rehash(encoded) else None
+
+
+def hash_password(password: str, algorithm: str, params: Dict[str, int]) -> str:
+    """Hash with the given settings (top-level for the same reason)"""
+    return HASHERS[algorithm](**params).encode(password)
+
+
+class PasswordService:
+    """Hashes and verifies passwords with the configured KDF, off the request thread.
+
+    Work runs on a bounded process pool so the CPU-heavy KDF does not hold the GIL
+    for other requests; at most max_pending calls may wait for it at once."""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.hasher: PasswordHasher = ScryptHasher()
+        self.workers = 0
+        self.max_pending = 8
+        self.timeout = 10.0
+        self.counters = Counters('verifications', 'hashes', 'rehashes', 'rejected_busy', 'timeouts',
+                                 'pool_restarts')
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._dummy_hash: Optional[str] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Read the KDF choice, its cost and the pool size from the app config"""
+        app.config.setdefault('PASSWORD_HASHER', 'scrypt')
+        app.config.setdefault('PASSWORD_SCRYPT_N', 2 ** 14)
+        app.config.setdefault('PASSWORD_SCRYPT_R', 8)
+        app.config.setdefault('PASSWORD_SCRYPT_P', 1)
+        app.config.setdefault('PASSWORD_PBKDF2_ITERATIONS', 600000)
+        # Worker processes for KDF work; 0 runs it inline on the request thread
+        app.config.setdefault('PASSWORD_WORKERS', os.cpu_count() or 1)
+        # Calls allowed to wait on the pool before logins are turned away with 503
+        app.config.setdefault('PASSWORD_MAX_PENDING', 8 * (os.cpu_count() or 1))
+        app.config.setdefault('PASSWORD_TIMEOUT', 10)
+
+        if app.config['PASSWORD_HASHER'] == 'scrypt':
+            self.hasher = ScryptHasher(n=app.config['PASSWORD_SCRYPT_N'], r=app.config['PASSWORD_SCRYPT_R'],
+                                       p=app.config['PASSWORD_SCRYPT_P'])
+        elif app.config['PASSWORD_HASHER'] == 'pbkdf2_sha256':
+            self.hasher = Pbkdf2Hasher(iterations=app.config['PASSWORD_PBKDF2_ITERATIONS'])
+        else:
+            raise ValueError(f"Unknown PASSWORD_HASHER: {app.config['PASSWORD_HASHER']}")
+        self.workers = app.config['PASSWORD_WORKERS']
+        self.max_pending = app.config['PASSWORD_MAX_PENDING']
+        self.timeout = app.config['PASSWORD_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._dummy_hash = None
+
+    def hash(self, password: str) -> str:
+        """Hash a new password with the current settings"""
+        self.counters.incr('hashes')
+        return self._run(hash_password, password, self.hasher.algorithm, self.hasher.params())
+
+    def check(self, password: str, encoded: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """(matches, replacement hash or None). With no stored hash a dummy one is
+        checked so unknown accounts take as long as known ones."""
+        self.counters.incr('verifications')
+        if encoded is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hasher.encode(os.urandom(16).hex())
+            self._run(check_password, password, self._dummy_hash, self.hasher.algorithm,
+                      self.hasher.params())
+            return False, None
+        matches, new_hash = self._run(check_password, password, encoded, self.hasher.algorithm,
+                                      self.hasher.params())
+        if new_hash is not None:
+            self.counters.incr('rehashes')
+        return matches, new_hash
+
+    def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self.counters.incr('rejected_busy')
+            raise PasswordServiceBusy('Password verification pool is saturated')
+        try:
+            if not self.workers:
+                return fn(*args)
+            executor = self._pool()
+            try:
+                return executor.submit(fn, *args).result(timeout=self.timeout)
+            except FutureTimeoutError:
+                self.counters.incr('timeouts')
+                raise PasswordServiceBusy('Password verification timed out')
+            except BrokenProcessPool:
+                # A worker died; the executor is unusable, so the next call starts a new one
+                self._discard(executor)
+                raise PasswordServiceBusy('Password verification pool failed')
+        finally:
+            self._slots.release()
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        self.counters.incr('pool_restarts')
+        executor.shutdown(wait=False)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a threaded server process is not safe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def stop(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Call counts, current algorithm and pool sizing"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['algorithm'] = self.hasher.algorithm
+        stats['workers'] = self.workers
+        stats['max_pending'] = self.max_pending
+        return stats
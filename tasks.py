@@ -0,0 +1,72 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from flask import Flask
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Run a callable every interval seconds on a daemon thread"""
+
+    def __init__(self, name: str, interval: float, fn: Callable[[], Any],
+                 app: Optional[Flask] = None):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.app = app
+        self.runs = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> Any:
+        """Run the task now on the calling thread, inside an app context if one was given"""
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    result = self.fn()
+            else:
+                result = self.fn()
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.exception('Background task %s failed', self.name)
+            return None
+        self.runs += 1
+        return result
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self) -> None:
+        """Start the background thread (no-op if already running)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=f'task-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Signal the thread to exit and wait for it"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self) -> Dict[str, Any]:
+        """Run and failure counts for status endpoints"""
+        return {
+            'running': self.running,
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
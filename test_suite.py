@@ -1,10 +1,53 @@
 import unittest
+import jwt
 import requests
+import gzip
+import hashlib
+import csv
+import io
 import json
 import sqlite3
 import os
+import tempfile
 import time
-from app import app, init_db
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from app import (ANALYTICS_SEEDS, MIGRATIONS, analytics_rollups, app, change_log, init_db, last_logins,
+                 migrate_db, password_service, token_verifier, user_access, user_counter, weather_service)
+import database
+import migrations
+import user_counts
+import users
+from data_validation import DUMMY_NAME_TERMS, DataValidator
+from analytics import AnalyticsBuffer
+from cache import LRUCache, SingleFlight
+from passwords import (LegacySha256Hasher, PasswordHasher, PasswordService, PasswordServiceBusy, Pbkdf2Hasher,
+                       ScryptHasher, check_password, identify)
+from met_client import CircuitBreaker, CircuitOpenError, LatencyBudgetExceeded, MetClient, MetResponse
+from export import EXPORTS
+from weather import (WeatherEntry, WeatherUnavailable, expiry_from_headers, quantize,
+                     summarize_forecast)
+
+SAMPLE_FORECAST = {
+    'type': 'Feature',
+    'geometry': {'type': 'Point', 'coordinates': [36.8219, -1.2921, 1661]},
+    'properties': {
+        'meta': {'updated_at': '2024-01-01T00:00:00Z'},
+        'timeseries': [
+            {'time': '2024-01-01T00:00:00Z',
+             'data': {'instant': {'details': {'air_temperature': 18.2, 'wind_speed': 2.1}}}}
+        ]
+    }
+}
+
+SAMPLE_BODY = json.dumps(SAMPLE_FORECAST).encode('utf-8')
+
+def fake_fetch(lat, lon, previous=None):
+    """Stand-in for the met.no call that returns SAMPLE_FORECAST"""
+    return WeatherEntry(lat, lon, SAMPLE_BODY, expires_at=time.time() + 3600)
 
 class HarvestNetTestSuite(unittest.TestCase):
     """Comprehensive test suite for HarvestNet platform"""
@@ -22,6 +65,7 @@ class HarvestNetTestSuite(unittest.TestCase):
         # Create test app
         app.config['TESTING'] = True
         app.config['DATABASE'] = cls.test_db
+        app.config['BACKGROUND_TASKS'] = False
         cls.client = app.test_client()
         
         # Initialize database
@@ -41,8 +85,10 @@ class HarvestNetTestSuite(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         """Clean up test environment"""
-        if os.path.exists(cls.test_db):
-            os.remove(cls.test_db)
+        database.close_pools()
+        for path in (cls.test_db, cls.test_db + '-wal', cls.test_db + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
     
     def test_01_api_health_check(self):
         """Test API health endpoint"""
@@ -288,6 +334,1324 @@ class HarvestNetTestSuite(unittest.TestCase):
                                   data='invalid json',
                                   content_type='application/json')
         self.assertIn(response.status_code, [400, 500])
+    
+    def test_16_connection_pool(self):
+        """Test pooled connections are reused, tuned and released on teardown"""
+        for _ in range(5):
+            response = self.client.get('/api/health')
+            self.assertEqual(response.status_code, 200)
+        
+        pool = database.get_pool(app)
+        self.assertEqual(pool.db_path, self.test_db)
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['open'], stats['max_size'])
+        
+        with pool.connection() as conn:
+            journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            busy_timeout = conn.execute('PRAGMA busy_timeout').fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+        self.assertGreater(busy_timeout, 0)
+    
+    def test_17_connection_pool_bounded(self):
+        """Test the pool refuses to grow past its size limit"""
+        pool = database.ConnectionPool(self.test_db, max_size=1, timeout=0.05)
+        conn = pool.acquire()
+        with self.assertRaises(database.PoolExhausted):
+            pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        pool.release(conn)
+        pool.close_all()
+    
+    def _auth_headers(self):
+        """Log in as admin and return an Authorization header"""
+        login_response = self.client.post('/api/auth/login',
+                                        data=json.dumps(self.admin_credentials),
+                                        content_type='application/json')
+        token = json.loads(login_response.data)['token']
+        return {'Authorization': f'Bearer {token}'}
+    
+    def test_18_lru_cache_eviction_and_ttl(self):
+        """Test the in-process LRU evicts least recently used and expired entries"""
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)  # evicts 'b', the least recently used
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', 4, ttl=0)
+        self.assertIsNone(cache.get('d'))
+        
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['expirations'], 1)
+    
+    def test_19_weather_two_tier_cache(self):
+        """Test weather is served from memory, then the table, before going upstream"""
+        headers = self._auth_headers()
+        url = '/api/weather?lat=-0.4167&lon=36.95'
+        with mock.patch.object(weather_service, '_fetch', side_effect=fake_fetch) as fetch:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Cache'], 'upstream')
+            self.assertEqual(json.loads(response.data), SAMPLE_FORECAST)
+            
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'memory')
+            
+            # Simulate a restart: the table tier refills the memory tier
+            weather_service.memory.clear()
+            with app.app_context():
+                self.assertGreaterEqual(weather_service.warm(database.get_db()), 1)
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'memory')
+            
+            weather_service.memory.clear()
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'database')
+            self.assertEqual(fetch.call_count, 1)
+        
+        response = self.client.get('/api/weather/cache', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.data)
+        self.assertIn('hit_rate', stats['memory'])
+        self.assertGreaterEqual(stats['db_hits'], 1)
+    
+    def test_20_weather_coordinate_quantization(self):
+        """Test nearby farms snap to the same cell and share one upstream fetch"""
+        self.assertEqual(quantize(-1.2921, 36.8219, 0.01).key, '-1.29,36.82')
+        self.assertEqual(quantize(-1.2921, 36.8219, geohash_precision=5).key, 'kzf0t')
+        with self.assertRaises(ValueError):
+            quantize(91.0, 0.0)
+        
+        headers = self._auth_headers()
+        with mock.patch.object(weather_service, '_fetch', side_effect=fake_fetch) as fetch:
+            first = self.client.get('/api/weather?lat=0.51234&lon=35.26981', headers=headers)
+            second = self.client.get('/api/weather?lat=0.51401&lon=35.27102', headers=headers)
+        
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.headers['X-Cache'], 'memory')
+        self.assertEqual(first.headers['X-Weather-Cell'], '0.51,35.27')
+        self.assertEqual(second.headers['X-Weather-Cell'], '0.51,35.27')
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(fetch.call_args[0], (0.51, 35.27))
+        
+        response = self.client.get('/api/weather?lat=123&lon=0', headers=headers)
+        self.assertEqual(response.status_code, 400)
+    
+    def test_21_single_flight_coalescing(self):
+        """Test concurrent callers for one key share a single execution and its error"""
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        
+        def slow_fetch():
+            calls.append(1)
+            release.wait(5)
+            return SAMPLE_FORECAST
+        
+        results = []
+        def worker():
+            results.append(flights.do('-1.29,36.82', slow_fetch))
+        
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.counters.get('coalesced') < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(sorted(shared for _, shared in results), [False] + [True] * 4)
+        self.assertEqual(flights.stats()['in_flight'], 0)
+        
+        def failing_fetch():
+            raise RuntimeError('upstream down')
+        with self.assertRaises(RuntimeError):
+            flights.do('-1.29,36.82', failing_fetch)
+    
+    def test_22_weather_stale_while_revalidate(self):
+        """Test expired forecasts are served immediately and refreshed in the background"""
+        now = time.time()
+        self.assertEqual(expiry_from_headers({'Expires': 'Thu, 01 Jan 2099 00:00:00 GMT'}, now, 60),
+                         4070908800.0)
+        self.assertEqual(expiry_from_headers({}, now, 60), now + 60)
+        
+        headers = self._auth_headers()
+        cell = weather_service.cell_for(-3.3869, 36.683)
+        expired = WeatherEntry(cell.latitude, cell.longitude, SAMPLE_BODY,
+                               cached_at=now - 7200, expires_at=now - 60)
+        weather_service.memory.set(cell.key, expired, ttl=600)
+        
+        with mock.patch.object(weather_service, '_fetch', side_effect=fake_fetch) as fetch:
+            response = self.client.get('/api/weather?lat=-3.3869&lon=36.683', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Cache'], 'stale')
+            
+            deadline = time.time() + 5
+            while weather_service.memory.peek(cell.key) is expired and time.time() < deadline:
+                time.sleep(0.01)
+            response = self.client.get('/api/weather?lat=-3.3869&lon=36.683', headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'memory')
+            self.assertEqual(fetch.call_count, 1)
+    
+    def test_23_weather_hot_region_prefetch(self):
+        """Test the prefetch scheduler warms hot regions that are missing or about to expire"""
+        regions = [('Nyeri', -0.4201, 36.9476), ('Machakos', -1.5177, 37.2634)]
+        fresh = weather_service.cell_for(-0.4201, 36.9476)
+        weather_service.memory.set(fresh.key, fake_fetch(fresh.latitude, fresh.longitude), ttl=3600)
+        
+        with mock.patch.object(weather_service, 'hot_regions', regions), \
+             mock.patch.object(weather_service, '_fetch', side_effect=fake_fetch) as fetch:
+            with app.app_context():
+                scheduled = weather_service.prefetch_hot_regions()
+            self.assertEqual(scheduled, 1)
+            deadline = time.time() + 5
+            while fetch.call_count < 1 and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            self.assertEqual(fetch.call_count, 1)
+            self.assertEqual(fetch.call_args[0], (-1.52, 37.26))
+    
+    def test_24_weather_conditional_revalidation(self):
+        """Test refreshes send If-Modified-Since and a 304 only extends the cached entry"""
+        last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        cell = weather_service.cell_for(-0.0917, 34.768)
+        previous = WeatherEntry(cell.latitude, cell.longitude, SAMPLE_BODY,
+                                cached_at=time.time() - 7200, expires_at=time.time() - 60,
+                                last_modified=last_modified)
+        not_modified = MetResponse(304, None, {'Expires': 'Thu, 01 Jan 2099 00:00:00 GMT'}, 0, 12.5)
+        
+        before = weather_service.stats()['revalidated']
+        with mock.patch.object(weather_service.client, 'fetch', return_value=not_modified) as fetch:
+            with app.app_context():
+                weather_service._store(database.get_db(), previous)
+                entry, source = weather_service._fetch_and_store(cell, previous=previous)
+                row = database.get_db().execute(
+                    'SELECT COUNT(*), MAX(expires_at) FROM weather_cache WHERE latitude = ? AND longitude = ?',
+                    (cell.latitude, cell.longitude)).fetchone()
+        
+        fetch.assert_called_once_with(cell.latitude, cell.longitude, last_modified=last_modified)
+        self.assertIs(entry.body, previous.body)
+        self.assertTrue(entry.is_fresh())
+        self.assertEqual(row, (1, 4070908800))
+        self.assertEqual(weather_service.stats()['revalidated'], before + 1)
+        self.assertIn('latency_ms', weather_service.stats()['upstream'])
+    
+    def test_25_weather_preserialized_response(self):
+        """Test cache hits are served from stored bytes with ETag, gzip and 304 support"""
+        headers = self._auth_headers()
+        url = '/api/weather?lat=-0.7167&lon=36.4333'
+        big_forecast = dict(SAMPLE_FORECAST, properties={
+            'timeseries': SAMPLE_FORECAST['properties']['timeseries'] * 50})
+        big_body = json.dumps(big_forecast).encode('utf-8')
+        
+        def fetch_big(lat, lon, previous=None):
+            return WeatherEntry(lat, lon, big_body, expires_at=time.time() + 3600)
+        
+        with mock.patch.object(weather_service, '_fetch', side_effect=fetch_big):
+            self.client.get(url, headers=headers)
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'memory')
+            self.assertEqual(response.data, big_body)
+            self.assertEqual(response.headers['Content-Type'], 'application/json')
+            self.assertEqual(int(response.headers['Content-Length']), len(big_body))
+            etag = response.headers['ETag']
+            
+            compressed = self.client.get(url, headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+            self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(compressed.data), big_body)
+            gzip_etag = compressed.headers['ETag']
+            self.assertEqual(gzip_etag, etag[:-1] + '-gz"')
+            
+            not_modified = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.data, b'')
+            self.assertEqual(not_modified.headers['Vary'], 'Accept-Encoding')
+            
+            # Each validator only matches the encoding it was issued for
+            not_modified = self.client.get(url, headers=dict(headers, **{'If-None-Match': gzip_etag,
+                                                                         'Accept-Encoding': 'gzip'}))
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.headers['ETag'], gzip_etag)
+            self.assertEqual(not_modified.headers['Vary'], 'Accept-Encoding')
+            identity = self.client.get(url, headers=dict(headers, **{'If-None-Match': gzip_etag}))
+            self.assertEqual(identity.status_code, 200)
+            self.assertEqual(identity.data, big_body)
+    
+    def test_26_weather_compressed_storage(self):
+        """Test forecasts are stored as gzip blobs and legacy JSON text rows still load"""
+        with app.app_context():
+            conn = database.get_db()
+            weather_service._store(conn, fake_fetch(-2.0, 37.5))
+            stored = conn.execute('''SELECT weather_data FROM weather_cache
+                                     WHERE latitude = -2.0 AND longitude = 37.5''').fetchone()[0]
+            self.assertIsInstance(stored, bytes)
+            self.assertEqual(gzip.decompress(stored), SAMPLE_BODY)
+            
+            conn.execute('''INSERT INTO weather_cache (latitude, longitude, weather_data, expires_at)
+                            VALUES (?, ?, ?, ?)''', (-2.1, 37.5, SAMPLE_BODY.decode('utf-8'),
+                                                     int(time.time()) + 3600))
+            conn.commit()
+            legacy = weather_service._load(conn, -2.1, 37.5)
+            self.assertEqual(legacy.data, SAMPLE_FORECAST)
+            self.assertEqual(gzip.decompress(legacy.gzip_body), SAMPLE_BODY)
+    
+    def test_27_weather_table_upsert_and_maintenance(self):
+        """Test one row per cell, expiry cleanup and least-recently-used eviction"""
+        now = time.time()
+        with app.app_context():
+            conn = database.get_db()
+            for _ in range(3):
+                weather_service._store(conn, fake_fetch(-3.0, 38.0))
+            count = conn.execute('''SELECT COUNT(*) FROM weather_cache
+                                    WHERE latitude = -3.0 AND longitude = 38.0''').fetchone()[0]
+            self.assertEqual(count, 1)
+            
+            dead = WeatherEntry(-3.1, 38.0, SAMPLE_BODY, cached_at=now - 86400,
+                                expires_at=now - weather_service.stale_ttl - 60)
+            weather_service._store(conn, dead)
+            for i in range(4):
+                entry = fake_fetch(-3.2 - i * 0.01, 38.0)
+                entry.cached_at = now - 10 ** 6 + i  # least recently used first
+                weather_service._store(conn, entry)
+            
+            rows = conn.execute('SELECT COUNT(*) FROM weather_cache').fetchone()[0]
+            with mock.patch.object(weather_service, 'max_rows', rows - 3):
+                result = weather_service.maintain(conn)
+            
+            self.assertEqual(result['expired'], 1)
+            self.assertEqual(result['evicted'], 2)
+            self.assertIsNone(weather_service._load(conn, -3.1, 38.0))
+            self.assertIsNone(weather_service._load(conn, -3.2, 38.0))
+            self.assertIsNotNone(weather_service._load(conn, -3.23, 38.0))
+            
+            table = weather_service.table_stats(conn)
+            self.assertEqual(table['rows'], rows - 3)
+            self.assertGreaterEqual(table['evictions'], 2)
+    
+    def test_28_weather_batch(self):
+        """Test batch lookups return per-item status and partial results"""
+        headers = self._auth_headers()
+        with app.app_context():
+            weather_service._store(database.get_db(), fake_fetch(-4.5, 39.5))  # table hit
+        release = threading.Event()
+        
+        def upstream(lat, lon, previous=None):
+            if lat == -4.7:
+                raise WeatherUnavailable('met.no returned HTTP 500')
+            if lat == -4.8:
+                release.wait(5)  # slower than the batch deadline
+            return fake_fetch(lat, lon)
+        
+        locations = [{'lat': -4.5, 'lon': 39.5}, {'lat': -4.6, 'lon': 39.5},
+                     {'lat': -4.601, 'lon': 39.499}, {'lat': -4.7, 'lon': 39.5},
+                     {'lat': -4.8, 'lon': 39.5}, {'lat': 95, 'lon': 39.5}]
+        with mock.patch.object(weather_service, '_fetch', side_effect=upstream), \
+             mock.patch.dict(app.config, {'WEATHER_BATCH_TIMEOUT': 0.5}):
+            response = self.client.post('/api/weather/batch', headers=headers,
+                                        data=json.dumps({'locations': locations}),
+                                        content_type='application/json')
+            release.set()
+        
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['count'], 6)
+        statuses = [item['status'] for item in data['results']]
+        self.assertEqual(statuses, ['ok', 'ok', 'ok', 'error', 'timeout', 'invalid'])
+        self.assertEqual(data['results'][0]['source'], 'database')
+        self.assertEqual(data['results'][1]['forecast'], SAMPLE_FORECAST)
+        self.assertEqual(data['results'][1]['cell'], data['results'][2]['cell'])
+        self.assertNotIn('forecast', data['results'][3])
+        self.assertEqual(data['statuses'], {'ok': 3, 'error': 1, 'timeout': 1, 'invalid': 1})
+        
+        response = self.client.post('/api/weather/batch', headers=headers,
+                                    data=json.dumps({'locations': [{'lat': 'x'}]}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        
+        # Unparseable bodies and non-finite coordinates are client errors too
+        for body, content_type in (('not json', 'application/json'),
+                                   ('{"locations": [{"lat": 1, "lon": 2}]}', 'text/plain'),
+                                   ('{"locations": [{"lat": NaN, "lon": 36.8}]}', 'application/json'),
+                                   ('{"locations": [{"lat": -1.3, "lon": 1e999}]}', 'application/json')):
+            response = self.client.post('/api/weather/batch', headers=headers, data=body,
+                                        content_type=content_type)
+            self.assertEqual(response.status_code, 400, body)
+    
+    def test_29_circuit_breaker_states(self):
+        """Test the breaker trips on failure rate, fails fast, then probes half-open"""
+        breaker = CircuitBreaker(window_size=4, min_calls=4, failure_rate=0.5, reset_timeout=0.05)
+        for outcome in (True, False, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record_success() if outcome else breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())   # the half-open probe
+        self.assertFalse(breaker.allow())  # only one probe at a time
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()['trips'], 2)
+        
+        # Unreachable upstream: failures trip the breaker and later calls never connect
+        client = MetClient('http://127.0.0.1:9/', 'HarvestNet tests', timeout=0.5,
+                           breaker=CircuitBreaker(min_calls=2, reset_timeout=60))
+        for _ in range(2):
+            with self.assertRaises(requests.RequestException):
+                client.fetch(-1.29, 36.82)
+        with self.assertRaises(CircuitOpenError):
+            client.fetch(-1.29, 36.82)
+        self.assertEqual(client.stats()['requests'], 2)
+    
+    def test_30_weather_fallback_when_upstream_down(self):
+        """Test the last known forecast is served when the breaker is open"""
+        headers = self._auth_headers()
+        cell = weather_service.cell_for(-1.0, 37.0)
+        old = WeatherEntry(cell.latitude, cell.longitude, SAMPLE_BODY, cached_at=time.time() - 86400,
+                           expires_at=time.time() - weather_service.stale_ttl - 60)
+        with app.app_context():
+            weather_service._store(database.get_db(), old)
+        
+        with mock.patch.object(weather_service.client, 'fetch',
+                               side_effect=CircuitOpenError('met.no circuit breaker is open')):
+            response = self.client.get('/api/weather?lat=-1.0&lon=37.0', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Cache'], 'stale')
+            self.assertEqual(json.loads(response.data), SAMPLE_FORECAST)
+            
+            response = self.client.get('/api/weather?lat=-1.5&lon=37.5', headers=headers)
+            self.assertEqual(response.status_code, 503)
+        
+        health = json.loads(self.client.get('/api/health').data)
+        self.assertIn(health['weather_upstream']['state'], ['closed', 'open', 'half_open'])
+        self.assertIn('trips', health['weather_upstream'])
+
+    def test_31_weather_summary_view(self):
+        """Test daily summaries are computed at fetch time and served by view=summary"""
+        def step(time_, temp, wind, rain_1h=None, rain_6h=None):
+            data = {'instant': {'details': {'air_temperature': temp, 'wind_speed': wind}}}
+            if rain_1h is not None:
+                data['next_1_hours'] = {'details': {'precipitation_amount': rain_1h}}
+            if rain_6h is not None:
+                data['next_6_hours'] = {'details': {'precipitation_amount': rain_6h}}
+            return {'time': time_, 'data': data}
+        
+        # 20:00Z is 23:00 in Nairobi; hourly steps give way to 6-hourly ones
+        forecast = {'properties': {'meta': {'updated_at': '2024-01-01T00:00:00Z'}, 'timeseries': [
+            step('2024-01-01T20:00:00Z', 17.0, 1.0, rain_1h=0.0, rain_6h=9.0),
+            step('2024-01-01T21:00:00Z', 16.0, 2.0, rain_1h=0.5, rain_6h=9.0),
+            step('2024-01-01T22:00:00Z', 15.0, 6.5, rain_6h=6.0),
+            step('2024-01-02T04:00:00Z', 24.0, 3.0, rain_6h=3.0),
+        ]}}
+        days = summarize_forecast(forecast)['days']
+        self.assertEqual([day['date'] for day in days], ['2024-01-01', '2024-01-02'])
+        self.assertEqual((days[0]['temp_min'], days[0]['temp_max'], days[0]['rain_mm']), (17.0, 17.0, 0.0))
+        self.assertTrue(days[0]['spraying'])
+        self.assertEqual((days[1]['rain_mm'], days[1]['wind_max']), (9.5, 6.5))
+        self.assertTrue(days[1]['planting'])
+        self.assertFalse(days[1]['spraying'])
+        
+        headers = self._auth_headers()
+        body = json.dumps(forecast).encode('utf-8')
+        upstream = MetResponse(200, body, {}, len(body), 10.0)
+        with mock.patch.object(weather_service.client, 'fetch', return_value=upstream), \
+                mock.patch('weather.summarize_forecast', wraps=summarize_forecast) as summarize:
+            response = self.client.get('/api/weather?lat=-0.8&lon=36.4&view=summary', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['days'], days)
+            self.assertTrue(response.headers['ETag'].endswith('-summary"'))
+            self.client.get('/api/weather?lat=-0.8&lon=36.4&view=summary', headers=headers)
+            self.assertEqual(summarize.call_count, 1)
+        
+        cell = weather_service.cell_for(-0.8, 36.4)
+        with app.app_context():
+            stored = database.get_db().execute(
+                'SELECT summary FROM weather_cache WHERE latitude = ? AND longitude = ?',
+                (cell.latitude, cell.longitude)).fetchone()[0]
+        self.assertEqual(bytes(stored), response.data)
+        
+        response = self.client.get('/api/weather?lat=-0.8&lon=36.4&view=raw', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_32_weather_nearest_cached_forecast(self):
+        """Test a miss is served from a fresh forecast cached within the radius"""
+        headers = self._auth_headers()
+        cell = weather_service.cell_for(0.9, 35.0)
+        with app.app_context():
+            conn = database.get_db()
+            weather_service._store(conn, WeatherEntry(cell.latitude, cell.longitude, SAMPLE_BODY,
+                                                      expires_at=time.time() + 3600))
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM weather_cache_rtree').fetchone()[0],
+                             conn.execute('SELECT COUNT(*) FROM weather_cache').fetchone()[0])
+        
+        with mock.patch.object(weather_service.client, 'fetch',
+                               side_effect=CircuitOpenError('met.no circuit breaker is open')) as fetch:
+            # ~2.2 km north: served from the neighbouring cell without going upstream
+            response = self.client.get('/api/weather?lat=0.92&lon=35.0', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Cache'], 'nearby')
+            self.assertEqual(response.headers['X-Weather-Forecast-Location'],
+                             f'{cell.latitude},{cell.longitude}')
+            self.assertEqual(json.loads(response.data), SAMPLE_FORECAST)
+            self.assertEqual(fetch.call_count, 0)
+            
+            # ~22 km away is outside the radius
+            response = self.client.get('/api/weather?lat=1.1&lon=35.0', headers=headers)
+            self.assertEqual(response.status_code, 503)
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute('DELETE FROM weather_cache WHERE latitude = ? AND longitude = ?',
+                         (cell.latitude, cell.longitude))
+            conn.commit()
+            self.assertIsNone(weather_service._nearest(conn, 0.93, 35.0))
+
+    def test_33_user_counts_maintained_by_triggers(self):
+        """Test dashboard counters follow user writes and reconcile corrects drift"""
+        def scanned(conn):
+            return {
+                'total_users': conn.execute('SELECT COUNT(*) FROM users WHERE is_active = 1').fetchone()[0],
+                'active_farmers': conn.execute(
+                    "SELECT COUNT(*) FROM users WHERE role = 'farmer' AND is_active = 1").fetchone()[0],
+                'data_ambassadors': conn.execute(
+                    "SELECT COUNT(*) FROM users WHERE role = 'data_ambassador' AND is_active = 1").fetchone()[0],
+            }
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.executemany('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                             [(f'counts{i}@example.com', 'x', f'Counts {i}', role)
+                              for i, role in enumerate(['farmer', 'farmer', 'data_ambassador', 'buyer'])])
+            conn.execute("UPDATE users SET role = 'data_ambassador' WHERE email = 'counts0@example.com'")
+            conn.execute("UPDATE users SET is_active = 0 WHERE email = 'counts1@example.com'")
+            conn.execute("DELETE FROM users WHERE email = 'counts3@example.com'")
+            conn.commit()
+            self.assertEqual(user_counts.dashboard_counts(conn), scanned(conn))
+            self.assertEqual(user_counter.reconcile(conn), [])
+            
+            conn.execute("UPDATE user_counts SET count = count + 7 WHERE role = 'farmer' AND is_active = 1")
+            conn.commit()
+            drift = user_counter.reconcile(conn)
+            self.assertEqual([(d['role'], d['actual'] - d['stored']) for d in drift], [('farmer', -7)])
+            self.assertEqual(user_counts.dashboard_counts(conn), scanned(conn))
+        
+        response = self.client.get('/api/analytics/dashboard', headers=self._auth_headers())
+        with app.app_context():
+            self.assertEqual({key: json.loads(response.data)[key] for key in scanned(database.get_db())},
+                             scanned(database.get_db()))
+
+    def test_34_analytics_rollups_growth(self):
+        """Test snapshots roll up into buckets that drive real growth figures"""
+        now = time.time()
+        with app.app_context():
+            conn = database.get_db()
+            analytics_rollups.record(conn, [('rollup_test', 80)], now - 45 * 86400)
+            analytics_rollups.record(conn, [('rollup_test', 100)], now - 31 * 86400)
+            analytics_rollups.record(conn, [('rollup_test', 110)], now - 2 * 3600)
+            self.assertEqual(analytics_rollups.value_at(conn, 'rollup_test', now - 30 * 86400), 100)
+            self.assertEqual(analytics_rollups.growth(conn, 'rollup_test', 125, now), 25.0)
+            
+            pruned = analytics_rollups.prune(conn, now)
+            self.assertGreaterEqual(pruned['hour'], 2)
+            resolutions = {row[0] for row in conn.execute(
+                'SELECT resolution FROM analytics_rollups WHERE metric_name = ? AND bucket_start < ?',
+                ('rollup_test', now - 30 * 86400))}
+            self.assertEqual(resolutions, {'day', 'month'})
+            self.assertEqual(analytics_rollups.growth(conn, 'rollup_test', 125, now), 25.0)
+            
+            metrics = analytics_rollups.snapshot(conn, now=now - 31 * 86400)
+        
+        response = self.client.get('/api/analytics/dashboard', headers=self._auth_headers())
+        data = json.loads(response.data)
+        expected = round((data['total_users'] - metrics['total_users']) / metrics['total_users'] * 100, 1)
+        self.assertEqual(data['growth_percent']['users_growth'], expected)
+        self.assertEqual(data['growth_metrics']['users_growth'], f'{expected:+.0f}% from last month')
+
+    def test_35_analytics_event_buffer(self):
+        """Test analytics events are coalesced, bounded and flushed in batches"""
+        with mock.patch.dict(app.config, {'ANALYTICS_BUFFER_SIZE': 3, 'ANALYTICS_FLUSH_BATCH': 2,
+                                          'ANALYTICS_FLUSH_INTERVAL': 60}):
+            events = AnalyticsBuffer(analytics_rollups, app)
+        
+        self.assertTrue(events.incr('buffer_test'))
+        self.assertTrue(events.incr('buffer_test', 4))
+        self.assertTrue(events.gauge('buffer_gauge', 7))
+        self.assertFalse(events.incr('buffer_test'))
+        self.assertEqual(events.stats()['dropped'], 1)
+        
+        with app.app_context():
+            conn = database.get_db()
+            self.assertEqual(events.flush(conn), 3)
+            rows = dict(conn.execute("SELECT metric_name, metric_value FROM analytics "
+                                     "WHERE metric_name IN ('buffer_test', 'buffer_gauge')"))
+        self.assertEqual(rows, {'buffer_test': 5, 'buffer_gauge': 7})
+        
+        # Reaching the batch size wakes the flush thread well before the interval
+        events.start()
+        try:
+            events.incr('buffer_test')
+            events.incr('buffer_test')
+            deadline = time.time() + 5
+            while events.stats()['flushes'] < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(events.stats()['flushed_events'], 5)
+        finally:
+            events.stop()
+
+    def test_36_last_login_write_behind(self):
+        """Test logins buffer last_login and a batched flush writes it"""
+        with app.app_context():
+            conn = database.get_db()
+            last_logins.flush(conn)
+            conn.execute("UPDATE users SET last_login = NULL WHERE email = 'farmer@harvestnet.com'")
+            conn.commit()
+        
+        response = self.client.post('/api/auth/login', data=json.dumps(self.farmer_credentials),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        farmer_id = json.loads(response.data)['user']['id']
+        
+        with app.app_context():
+            conn = database.get_db()
+            stored = conn.execute('SELECT last_login FROM users WHERE id = ?', (farmer_id,)).fetchone()[0]
+            self.assertIsNone(stored)
+            
+            # Reads see the pending login before it is flushed
+            users = json.loads(self.client.get('/api/users', headers=self._auth_headers()).data)['users']
+            listed = next(user for user in users if user['id'] == farmer_id)['last_login']
+            self.assertIsNotNone(listed)
+            
+            self.assertGreaterEqual(last_logins.flush(conn), 1)
+            stored = conn.execute('SELECT last_login FROM users WHERE id = ?', (farmer_id,)).fetchone()[0]
+            self.assertEqual(stored, listed)
+            self.assertEqual(last_logins.pending(), 0)
+
+    def test_37_password_hashing_and_rehash(self):
+        """Test KDF hash formats, and that logins upgrade legacy or outdated hashes"""
+        scrypt = ScryptHasher(n=2 ** 10, r=8, p=1)
+        encoded = scrypt.encode('s3cret')
+        self.assertTrue(encoded.startswith('scrypt$n=1024,r=8,p=1$'))
+        self.assertTrue(identify(encoded).verify('s3cret', encoded))
+        self.assertFalse(identify(encoded).verify('wrong', encoded))
+        self.assertEqual(check_password('s3cret', encoded, 'scrypt', scrypt.params()), (True, None))
+        
+        matches, upgraded = check_password('s3cret', encoded, 'pbkdf2_sha256', {'iterations': 1000})
+        self.assertTrue(matches)
+        self.assertTrue(upgraded.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(Pbkdf2Hasher(1000).verify('s3cret', upgraded))
+        
+        legacy = hashlib.sha256(b'legacy-pass').hexdigest()
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                         ('legacy@harvestnet.com', legacy, 'Legacy User', 'farmer'))
+            conn.commit()
+        
+        credentials = {'email': 'legacy@harvestnet.com', 'password': 'legacy-pass'}
+        response = self.client.post('/api/auth/login', data=json.dumps(credentials),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            stored = database.get_db().execute(
+                "SELECT password_hash FROM users WHERE email = 'legacy@harvestnet.com'").fetchone()[0]
+        self.assertTrue(stored.startswith(password_service.hasher.encode_prefix()))
+        
+        # The upgraded hash keeps working and wrong passwords are still refused
+        response = self.client.post('/api/auth/login', data=json.dumps(credentials),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        credentials['password'] = 'wrong'
+        response = self.client.post('/api/auth/login', data=json.dumps(credentials),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_38_jwt_verification_cache(self):
+        """Test verified tokens are cached until exp and dropped when the secret rotates"""
+        headers = self._auth_headers()
+        hits = token_verifier.stats()['hits']
+        for _ in range(3):
+            self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 200)
+        self.assertGreaterEqual(token_verifier.stats()['hits'], hits + 2)
+        
+        # A cached token stops working once its exp claim passes
+        now = time.time()
+        token = jwt.encode({'user_id': 1, 'exp': int(now) + 60}, app.config['SECRET_KEY'], algorithm='HS256')
+        self.assertEqual(token_verifier.decode(token)['user_id'], 1)
+        with mock.patch('auth.time.time', return_value=now + 120):
+            with self.assertRaises(jwt.ExpiredSignatureError):
+                token_verifier.decode(token)
+        
+        secret = app.config['SECRET_KEY']
+        try:
+            token_verifier.rotate_secret('rotated-secret')
+            self.assertEqual(len(token_verifier.cache), 0)
+            self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 401)
+        finally:
+            token_verifier.rotate_secret(secret)
+        self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 200)
+
+    def test_39_deactivated_users_and_revoked_tokens(self):
+        """Test token_required rejects deactivated accounts and logged-out tokens"""
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                         ('access@harvestnet.com', password_service.hasher.encode('access-pass'),
+                          'Access User', 'farmer'))
+            conn.commit()
+        credentials = {'email': 'access@harvestnet.com', 'password': 'access-pass'}
+        
+        def login():
+            response = self.client.post('/api/auth/login', data=json.dumps(credentials),
+                                        content_type='application/json')
+            return {'Authorization': f"Bearer {json.loads(response.data)['token']}"}
+        
+        headers = login()
+        self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 200)
+        
+        # Logging out revokes just that token
+        other = login()
+        self.assertEqual(self.client.post('/api/auth/logout', headers=headers).status_code, 200)
+        response = self.client.get('/api/users', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.data)['message'], 'Token has been revoked')
+        self.assertEqual(self.client.get('/api/users', headers=other).status_code, 200)
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute("UPDATE users SET is_active = 0 WHERE email = 'access@harvestnet.com'")
+            conn.commit()
+            self.assertGreaterEqual(user_access.sync(conn), 1)
+            
+            # A fresh load from the table sees the same state, revocation included
+            user_access.load(conn)
+        response = self.client.get('/api/users', headers=other)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.data)['message'], 'Account is inactive')
+        self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 401)
+        self.assertEqual(self.client.get('/api/users', headers=self._auth_headers()).status_code, 200)
+
+    def test_40_streaming_export(self):
+        """Test NDJSON/CSV/JSON exports stream in chunks, gzip on request and cover all tables"""
+        headers = self._auth_headers()
+        cell = weather_service.cell_for(-2.5, 38.0)
+        with app.app_context():
+            weather_service._store(database.get_db(), WeatherEntry(
+                cell.latitude, cell.longitude, SAMPLE_BODY, expires_at=time.time() + 3600))
+            user_total = database.get_db().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        
+        with mock.patch.dict(app.config, {'EXPORT_CHUNK_ROWS': 2}):
+            response = self.client.get('/api/data/export?type=weather_cache&format=ndjson',
+                                       headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            rows = [json.loads(line) for line in gzip.decompress(response.data).splitlines()]
+            exported = next(row for row in rows
+                            if (row['latitude'], row['longitude']) == (cell.latitude, cell.longitude))
+            self.assertEqual(exported['weather_data'], SAMPLE_FORECAST)
+            
+            response = self.client.get('/api/data/export?type=users&format=csv', headers=headers)
+            table = list(csv.reader(io.StringIO(response.data.decode('utf-8'))))
+            self.assertNotIn('password_hash', table[0])
+            self.assertEqual(len(table) - 1, user_total)
+            
+            data = json.loads(self.client.get('/api/data/export?type=users', headers=headers).data)
+            self.assertEqual(len(data['data']), user_total)
+            
+            response = self.client.get('/api/data/export?type=analytics&format=ndjson', headers=headers)
+            self.assertEqual(response.status_code, 200)
+        
+        response = self.client.get('/api/data/export?type=passwords', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_41_incremental_export_cursor(self):
+        """Test since= exports return only rows changed after the cursor, with tombstones"""
+        headers = self._auth_headers()
+        with app.app_context():
+            conn = database.get_db()
+            conn.executemany('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                             [('cdc-edit@harvestnet.com', 'x' * 64, 'Before', 'farmer'),
+                              ('cdc-gone@harvestnet.com', 'x' * 64, 'Gone', 'farmer'),
+                              ('cdc-keep@harvestnet.com', 'x' * 64, 'Keep', 'farmer')])
+            conn.commit()
+        
+        response = self.client.get('/api/data/export?type=users', headers=headers)
+        cursor = json.loads(response.data)['cursor']
+        self.assertEqual(response.headers['X-Export-Cursor'], str(cursor))
+        
+        with app.app_context():
+            conn = database.get_db()
+            gone_id = conn.execute("SELECT id FROM users WHERE email = 'cdc-gone@harvestnet.com'").fetchone()[0]
+            conn.execute("UPDATE users SET name = 'After' WHERE email = 'cdc-edit@harvestnet.com'")
+            conn.execute("DELETE FROM users WHERE email = 'cdc-gone@harvestnet.com'")
+            conn.execute("INSERT INTO users (email, password_hash, name, role) "
+                         "VALUES ('cdc-new@harvestnet.com', 'x', 'New', 'farmer')")
+            # Rehashes and no-op writes are not changes
+            conn.execute("UPDATE users SET password_hash = 'y' WHERE email = 'cdc-keep@harvestnet.com'")
+            conn.execute("UPDATE users SET role = role")
+            conn.commit()
+        
+        response = self.client.get(f'/api/data/export?type=users&format=ndjson&since={cursor}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([(row['email'], row['name'], row['deleted']) for row in rows],
+                         [('cdc-edit@harvestnet.com', 'After', 0), (None, None, 1),
+                          ('cdc-new@harvestnet.com', 'New', 0)])
+        self.assertEqual(rows[1]['id'], gone_id)
+        self.assertNotIn('password_hash', rows[0])
+        
+        # The new cursor picks up where this one stopped
+        next_cursor = int(response.headers['X-Export-Cursor'])
+        self.assertEqual(next_cursor, max(row['change_seq'] for row in rows))
+        response = self.client.get(f'/api/data/export?type=users&since={next_cursor}', headers=headers)
+        self.assertEqual(json.loads(response.data)['data'], [])
+        
+        self.assertEqual(self.client.get('/api/data/export?type=analytics_rollups&since=0',
+                                         headers=headers).status_code, 400)
+        self.assertEqual(self.client.get('/api/data/export?type=users&since=-1',
+                                         headers=headers).status_code, 400)
+        
+        # Once its changes are pruned the old cursor can no longer be served
+        with app.app_context():
+            self.assertGreater(change_log.prune(database.get_db(), now=time.time() + 30 * 86400), 0)
+        response = self.client.get(f'/api/data/export?type=users&since={cursor}', headers=headers)
+        self.assertEqual(response.status_code, 410)
+        response = self.client.get(f'/api/data/export?type=users&since={next_cursor}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_42_users_keyset_pagination(self):
+        """Test /api/users pages by cursor, filters server-side and projects fields"""
+        headers = self._auth_headers()
+        with app.app_context():
+            conn = database.get_db()
+            # Several users share a created_at, so ties must be broken by id
+            conn.executemany('''INSERT INTO users (email, password_hash, name, role, location, created_at)
+                                VALUES (?, 'x', ?, ?, 'Kisumu', ?)''',
+                             [(f'page{i}@harvestnet.com', f'Page {i}', 'data_ambassador' if i % 2 else 'farmer',
+                               f'2020-01-0{1 + i // 3} 00:00:00') for i in range(7)])
+            conn.commit()
+        
+        seen, cursor = [], None
+        while True:
+            url = '/api/users?location=Kisumu&limit=3&fields=name,created_at'
+            response = self.client.get(url + (f'&cursor={cursor}' if cursor else ''), headers=headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertLessEqual(len(data['users']), 3)
+            for user in data['users']:
+                self.assertEqual(set(user), {'name', 'created_at'})
+            seen.extend(user['name'] for user in data['users'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f'Page {i}' for i in (6, 5, 4, 3, 2, 1, 0)])
+        
+        response = self.client.get('/api/users?location=Kisumu&role=data_ambassador&is_active=true',
+                                   headers=headers)
+        self.assertEqual([user['email'] for user in json.loads(response.data)['users']],
+                         ['page5@harvestnet.com', 'page3@harvestnet.com', 'page1@harvestnet.com'])
+        
+        for query in ('fields=password_hash', 'cursor=bogus', 'is_active=maybe', 'limit=ten'):
+            self.assertEqual(self.client.get(f'/api/users?{query}', headers=headers).status_code, 400)
+        
+        with app.app_context():
+            plan = database.get_db().execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM users WHERE role = ? AND (created_at, id) < (?, ?) '
+                'ORDER BY created_at DESC, id DESC LIMIT 10', ('farmer', '2020-01-02', 5)).fetchall()
+            self.assertNotIn('TEMP B-TREE', ' '.join(row[-1] for row in plan))
+            plan = database.get_db().execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM users WHERE role = ? AND is_active = ? '
+                'ORDER BY created_at DESC, id DESC LIMIT 10', ('farmer', 1)).fetchall()
+            self.assertNotIn('TEMP B-TREE', ' '.join(row[-1] for row in plan))
+
+    def test_43_user_full_text_search(self):
+        """Test /api/users/search ranks substring matches from the trigger-synced index"""
+        headers = self._auth_headers()
+        with app.app_context():
+            conn = database.get_db()
+            conn.executemany('''INSERT INTO users (email, password_hash, name, role, location)
+                                VALUES (?, 'x', ?, 'farmer', ?)''',
+                             [('wanjiru@harvestnet.com', 'Wanjiru Kamau', 'Nakuru'),
+                              ('kamau.otieno@harvestnet.com', 'Otieno Kamau', 'Kamaunet'),
+                              ('grower@harvestnet.com', 'Sample Grower', 'Eldoret'),
+                              ('qa@harvestnet.com', 'QA Tester', 'Eldoret')])
+            conn.commit()
+        
+        def search(query):
+            response = self.client.get(f'/api/users/search?{query}', headers=headers)
+            return response.status_code, json.loads(response.data)
+        
+        status, data = search('q=anjir&fields=email,name')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['users'], [{'email': 'wanjiru@harvestnet.com', 'name': 'Wanjiru Kamau'}])
+        
+        # Matched in name, email and location, so it outranks a name-only match
+        status, data = search('q=KAMAU&limit=1&fields=email')
+        self.assertEqual(data['users'], [{'email': 'kamau.otieno@harvestnet.com'}])
+        self.assertEqual(data['next_offset'], 1)
+        status, data = search('q=kamau&limit=1&offset=1&fields=email')
+        self.assertEqual(data['users'], [{'email': 'wanjiru@harvestnet.com'}])
+        self.assertIsNone(data['next_offset'])
+        self.assertEqual(search('q=ka')[0], 400)
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute("UPDATE users SET name = 'Wanjiru Njeri' WHERE email = 'wanjiru@harvestnet.com'")
+            conn.commit()
+        self.assertEqual([user['email'] for user in search('q=njeri')[1]['users']], ['wanjiru@harvestnet.com'])
+        self.assertEqual([user['email'] for user in search('q=kamau')[1]['users']],
+                         ['kamau.otieno@harvestnet.com'])
+        
+        # Dummy-account cleanup matches through the same index, with the same results as LIKE
+        with app.app_context():
+            conn = database.get_db()
+            condition, params = users.match_condition(conn, DUMMY_NAME_TERMS, columns=('name',))
+            self.assertIn('users_fts', condition)
+            indexed = conn.execute(f'SELECT id FROM users WHERE {condition} ORDER BY id', params).fetchall()
+            with mock.patch('users.has_search_index', return_value=False):
+                condition, params = users.match_condition(conn, DUMMY_NAME_TERMS, columns=('name',))
+            self.assertIn('LIKE', condition)
+            self.assertEqual(conn.execute(f'SELECT id FROM users WHERE {condition} ORDER BY id',
+                                          params).fetchall(), indexed)
+        
+        DataValidator(self.test_db).clean_dummy_data()
+        with app.app_context():
+            emails = {row[0] for row in database.get_db().execute('SELECT email FROM users')}
+        self.assertNotIn('grower@harvestnet.com', emails)
+        self.assertNotIn('qa@harvestnet.com', emails)
+        self.assertIn('kamau.otieno@harvestnet.com', emails)
+        self.assertEqual(search('q=Eldoret')[1]['users'], [])
+
+    def test_44_versioned_migrations(self):
+        """Test migrations run once, are recorded, skip a current database and adopt old ones"""
+        with app.app_context():
+            seeds = database.get_db().execute(
+                'SELECT metric_name, COUNT(*) FROM analytics WHERE metric_value IN (1247, 892, 45) '
+                'GROUP BY metric_name').fetchall()
+        details = self.client.get('/api/health/details', headers=self._auth_headers())
+        self.assertEqual(json.loads(details.data)['schema_version'],
+                         MIGRATIONS[-1].version)
+        
+        # Restarting against a current database does no schema work and adds no seed rows
+        with mock.patch('app._create_schema') as create_schema:
+            init_db()
+        create_schema.assert_not_called()
+        with app.app_context():
+            self.assertEqual(database.get_db().execute(
+                'SELECT metric_name, COUNT(*) FROM analytics WHERE metric_value IN (1247, 892, 45) '
+                'GROUP BY metric_name').fetchall(), seeds)
+        
+        # A database from before schema_version, restarted a few times, is adopted and cleaned up
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, 'old.db'))
+            self.assertEqual(migrations.migrate(conn, MIGRATIONS, target=1), [1])
+            conn.execute('DROP TABLE schema_version')
+            conn.executemany('INSERT INTO analytics (metric_name, metric_value) VALUES (?, ?)',
+                             ANALYTICS_SEEDS * 3)
+            conn.commit()
+            self.assertEqual(migrations.current_version(conn), 0)
+            
+            self.assertEqual(migrate_db(conn), [migration.version for migration in MIGRATIONS])
+            self.assertEqual(conn.execute('SELECT metric_name, COUNT(*) FROM analytics GROUP BY 1').fetchall(),
+                             [('active_farmers', 1), ('data_ambassadors', 1), ('total_users', 1)])
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            for name in ('idx_users_role_created_at', 'idx_users_created_at', 'idx_weather_cache_cached_at',
+                         'idx_analytics_metric_recorded'):
+                self.assertIn(name, indexes)
+            self.assertNotIn('idx_users_role_active', indexes)
+            self.assertEqual(migrate_db(conn), [])
+            conn.close()
+        
+        with self.assertRaises(ValueError):
+            migrations.migrate(sqlite3.connect(':memory:'), list(reversed(MIGRATIONS)))
+
+    def test_45_met_client_body_stall(self):
+        """Test a body that stalls mid-read fails as a requests error and settles the breaker"""
+        class StallingHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '1000')
+                self.end_headers()
+                self.wfile.write(b'{"type": "Feature", ')
+                self.wfile.flush()
+                time.sleep(1.5)
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StallingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            breaker = CircuitBreaker(min_calls=1, reset_timeout=0.05)
+            client = MetClient(f'http://127.0.0.1:{server.server_address[1]}/', 'HarvestNet tests',
+                               timeout=0.3, breaker=breaker)
+            with self.assertRaises(requests.Timeout):
+                client.fetch(-1.29, 36.82)
+            self.assertEqual(client.stats()['errors'], 1)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            
+            # A stalled half-open probe re-opens the circuit rather than wedging it half-open
+            time.sleep(0.06)
+            with self.assertRaises(requests.Timeout):
+                client.fetch(-1.29, 36.82)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            time.sleep(0.06)
+            self.assertTrue(breaker.allow())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_46_pool_exhaustion_and_shutdown(self):
+        """Test an exhausted pool answers 503, requests do not pin connections and closed pools drain"""
+        headers = self._auth_headers()
+        pool = database.get_pool(app)
+        
+        # token_required hands the request's connection back before the handler runs
+        in_use = []
+        
+        def slow_upstream(lat, lon):
+            in_use.append(pool.stats()['in_use'])
+            raise WeatherUnavailable('met.no request failed')
+        
+        with mock.patch.object(weather_service, 'get_forecast', side_effect=slow_upstream):
+            self.client.get('/api/weather?lat=-1.0&lon=37.0', headers=headers)
+        self.assertEqual(in_use, [0])
+        
+        held = []
+        with mock.patch.object(pool, 'timeout', 0.05):
+            try:
+                while True:
+                    held.append(pool.acquire())
+            except database.PoolExhausted:
+                pass
+            try:
+                response = self.client.get('/api/health')
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'], '1')
+                self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 503)
+            finally:
+                for conn in held:
+                    pool.release(conn)
+        health = json.loads(self.client.get('/api/health').data)
+        self.assertNotIn('path', health['pool'])
+        
+        # Connections checked out when the pool is closed are closed on release, not leaked
+        other = database.ConnectionPool(self.test_db, max_size=2)
+        conn = other.acquire()
+        other.close_all()
+        other.release(conn)
+        self.assertEqual(other.stats()['idle'], 0)
+        self.assertEqual(other.stats()['open'], 0)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+    def test_47_weather_fetch_holds_no_connection(self):
+        """Test no pooled connection is checked out while met.no is being called"""
+        headers = self._auth_headers()
+        pool = database.get_pool(app)
+        in_use = []
+        
+        def fetch(lat, lon, previous=None):
+            in_use.append(pool.stats()['in_use'])
+            return WeatherEntry(lat, lon, SAMPLE_BODY, expires_at=time.time() + 3600)
+        
+        with mock.patch.object(weather_service, '_fetch', side_effect=fetch):
+            response = self.client.get('/api/weather?lat=3.11&lon=35.61', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post('/api/weather/batch', headers=headers,
+                                        data=json.dumps({'locations': [{'lat': 3.41, 'lon': 35.91}]}),
+                                        content_type='application/json')
+            self.assertEqual(json.loads(response.data)['results'][0]['status'], 'ok')
+        self.assertEqual(in_use, [0, 0])
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_48_export_streams_from_dedicated_connection(self):
+        """Test a streamed export holds no pooled connection and closes its own at the end"""
+        headers = self._auth_headers()
+        pool = database.get_pool(app)
+        opened = []
+        
+        def open_dedicated():
+            opened.append(database.ConnectionPool.open_dedicated(pool))
+            return opened[-1]
+        
+        with mock.patch.dict(app.config, {'EXPORT_CHUNK_ROWS': 1}), \
+                mock.patch.object(pool, 'open_dedicated', side_effect=open_dedicated):
+            response = self.client.get('/api/data/export?type=users&format=ndjson', headers=headers)
+            chunks = iter(response.response)
+            first = next(chunks)
+            self.assertEqual(pool.stats()['in_use'], 0)
+            rest = b''.join(chunks)
+        self.assertEqual(len(opened), 1)
+        self.assertIn(b'"email"', first + rest)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            opened[0].execute('SELECT 1')
+
+    def test_49_cleanup_keeps_analytics_history(self):
+        """Test clean_dummy_data appends current totals instead of rewriting past samples"""
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute("INSERT INTO analytics (metric_name, metric_value, recorded_at) "
+                         "VALUES ('total_users', 7, '2020-01-01 00:00:00')")
+            conn.commit()
+            before = conn.execute("SELECT id, metric_value FROM analytics WHERE metric_name = 'total_users' "
+                                  "ORDER BY id").fetchall()
+        
+        DataValidator(self.test_db).clean_dummy_data()
+        with app.app_context():
+            conn = database.get_db()
+            after = conn.execute("SELECT id, metric_value FROM analytics WHERE metric_name = 'total_users' "
+                                 "ORDER BY id").fetchall()
+            total = user_counts.dashboard_counts(conn)['total_users']
+        self.assertEqual(after[:len(before)], before)
+        self.assertEqual(after[len(before):][-1][1], total)
+
+    def test_50_background_tasks_start_with_first_request(self):
+        """Test the background workers start once, with the first request, however the app is served"""
+        with mock.patch.dict(app.config, {'BACKGROUND_TASKS': True}), \
+                mock.patch('app._background_started', False), \
+                mock.patch('app.start_background_tasks') as start, \
+                mock.patch.object(weather_service, 'warm') as warm, \
+                mock.patch.object(user_access, 'load') as load, \
+                mock.patch('atexit.register') as register:
+            self.client.get('/api/health')
+            self.client.get('/api/health')
+        start.assert_called_once_with()
+        # The memory tier and access bitsets are warmed however the app is served
+        warm.assert_called_once()
+        load.assert_called_once()
+        register.assert_called_once()
+        self.assertEqual(register.call_args[0][0].__name__, 'stop_background_tasks')
+        
+        with mock.patch('app.start_background_tasks') as start:
+            self.client.get('/api/health')
+        start.assert_not_called()
+        
+        # A failed warm-up leaves the cache cold but still starts the workers
+        with mock.patch.dict(app.config, {'BACKGROUND_TASKS': True}), \
+                mock.patch('app._background_started', False), \
+                mock.patch('app.start_background_tasks') as start, \
+                mock.patch.object(weather_service, 'warm', side_effect=sqlite3.OperationalError('locked')), \
+                mock.patch('atexit.register'), self.assertLogs('app', 'ERROR'):
+            self.assertEqual(self.client.get('/api/health').status_code, 200)
+        start.assert_called_once_with()
+
+    def test_51_user_access_catches_up_without_syncer(self):
+        """Test a deactivated user loses access once the in-memory view is stale, with no syncer running"""
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                         ('stale@harvestnet.com', password_service.hasher.encode('stale-pass'),
+                          'Stale User', 'farmer'))
+            conn.commit()
+        response = self.client.post('/api/auth/login',
+                                    data=json.dumps({'email': 'stale@harvestnet.com', 'password': 'stale-pass'}),
+                                    content_type='application/json')
+        headers = {'Authorization': f"Bearer {json.loads(response.data)['token']}"}
+        self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 200)
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute("UPDATE users SET is_active = 0 WHERE email = 'stale@harvestnet.com'")
+            conn.commit()
+        
+        # Within the staleness bound the cached state is still trusted
+        with mock.patch.object(user_access, 'max_staleness', 3600):
+            self.assertEqual(self.client.get('/api/users', headers=headers).status_code, 200)
+        
+        inline_syncs = user_access.counters.get('inline_syncs')
+        with mock.patch.object(user_access, 'synced_at', user_access.synced_at - user_access.max_staleness - 1):
+            response = self.client.get('/api/users', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.data)['message'], 'Account is inactive')
+        self.assertEqual(user_access.counters.get('inline_syncs'), inline_syncs + 1)
+
+    def test_52_password_service_failures(self):
+        """Test unknown hash formats fail the login and pool failures surface as busy"""
+        with self.assertRaises(TypeError):
+            PasswordHasher()
+        self.assertEqual(LegacySha256Hasher().params(), {})
+        self.assertTrue(LegacySha256Hasher().needs_rehash(hashlib.sha256(b'x').hexdigest()))
+        self.assertNotIn('params', password_service.stats())
+        self.assertEqual(check_password('pw', 'bcrypt$2b$12$abc', 'scrypt', {'n': 1024}), (False, None))
+        
+        with app.app_context():
+            conn = database.get_db()
+            conn.execute('INSERT INTO users (email, password_hash, name, role) VALUES (?, ?, ?, ?)',
+                         ('foreign@harvestnet.com', '$2b$12$notahashwecanread', 'Foreign User', 'farmer'))
+            conn.commit()
+        response = self.client.post('/api/auth/login',
+                                    data=json.dumps({'email': 'foreign@harvestnet.com', 'password': 'pw'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        
+        service = PasswordService()
+        service.workers = 1
+        for error, counter in ((concurrent.futures.TimeoutError(), 'timeouts'),
+                               (BrokenProcessPool(), 'pool_restarts')):
+            executor = mock.Mock()
+            executor.submit.return_value.result.side_effect = error
+            service._executor = executor
+            with self.assertRaises(PasswordServiceBusy):
+                service.hash('pw')
+            self.assertEqual(service.counters.get(counter), 1)
+        # Only the broken pool is thrown away; the next call starts a fresh one
+        self.assertIsNone(service._executor)
+        executor.shutdown.assert_called_once_with(wait=False)
+
+    def test_53_met_client_latency_budget_is_hard(self):
+        """Test slow headers followed by a dripping body cannot outlast the latency budget"""
+        class DrippingHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(0.7)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '1000')
+                self.end_headers()
+                try:
+                    # Each gap is inside the read timeout but past the budget left
+                    for _ in range(5):
+                        self.wfile.write(b' ')
+                        self.wfile.flush()
+                        time.sleep(0.8)
+                except OSError:
+                    pass
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), DrippingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client = MetClient(f'http://127.0.0.1:{server.server_address[1]}/', 'HarvestNet tests',
+                               timeout=1.0, connect_timeout=0.5)
+            started = time.monotonic()
+            with self.assertRaises(LatencyBudgetExceeded):
+                client.fetch(-1.29, 36.82)
+            self.assertLessEqual(time.monotonic() - started, client.timeout + 0.1)
+            
+            # Headers alone slower than the budget are cut off at the budget too
+            client = MetClient(f'http://127.0.0.1:{server.server_address[1]}/', 'HarvestNet tests',
+                               timeout=0.3, connect_timeout=0.5)
+            started = time.monotonic()
+            with self.assertRaises(requests.Timeout):
+                client.fetch(-1.29, 36.82)
+            self.assertLessEqual(time.monotonic() - started, client.timeout + 0.1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_54_user_access_check_borrows_only_when_needed(self):
+        """Test token checks answered from memory never ask for a database connection"""
+        headers = self._auth_headers()
+        self.client.get('/api/users', headers=headers)
+        claims = token_verifier.decode(headers['Authorization'][7:])
+        get_conn = mock.Mock(side_effect=database.PoolExhausted('pool is busy'))
+        with mock.patch.object(user_access, 'max_staleness', 3600):
+            self.assertIsNone(user_access.check(get_conn, claims))
+        get_conn.assert_not_called()
+        
+        # An id not seen yet still needs its one lookup
+        with app.app_context():
+            conn = database.get_db()
+            unseen_id = conn.execute('SELECT MAX(id) FROM users').fetchone()[0] + 10000
+            get_conn = mock.Mock(return_value=conn)
+            with mock.patch.object(user_access, 'max_staleness', 3600):
+                self.assertEqual(user_access.check(get_conn, dict(claims, user_id=unseen_id)),
+                                 'Account is inactive')
+        get_conn.assert_called_once_with()
+
+    def test_55_health_exposes_internals_only_to_authenticated_callers(self):
+        """Test /api/health reports status, breaker and pool only; details need a token"""
+        health = json.loads(self.client.get('/api/health').data)
+        self.assertEqual(set(health), {'status', 'database', 'pool', 'weather_upstream', 'timestamp', 'version'})
+        
+        self.assertEqual(self.client.get('/api/health/details').status_code, 401)
+        response = self.client.get('/api/health/details', headers=self._auth_headers())
+        self.assertEqual(response.status_code, 200)
+        details = json.loads(response.data)
+        for name in ('user_counts', 'passwords', 'jwt_cache', 'user_access', 'change_log'):
+            self.assertIn(name, details)
+
+    def test_56_tracked_exports_have_migrated_triggers(self):
+        """Test every change-captured export has triggers created by some migration"""
+        with app.app_context():
+            triggers = {row[0] for row in database.get_db().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        for spec in EXPORTS.values():
+            if spec.tracked:
+                for event in ('insert', 'update', 'delete'):
+                    self.assertIn(f'{spec.table}_change_{event}', triggers)
+
+    def test_57_weather_access_times_share_a_lock_with_maintain(self):
+        """Test request threads and maintain's swap of pending access times take the same lock"""
+        with app.app_context():
+            weather_service.maintain(database.get_db())
+        
+        def maintain():
+            with app.app_context():
+                flushed.append(weather_service.maintain(database.get_db())['accessed_flushed'])
+        
+        flushed = []
+        with weather_service._accessed_lock:
+            writer = threading.Thread(target=weather_service._note_access, args=(81.0, 1.0))
+            sweeper = threading.Thread(target=maintain)
+            writer.start()
+            sweeper.start()
+            writer.join(0.2)
+            sweeper.join(0.2)
+            # Neither can touch the dict while another thread holds it
+            self.assertTrue(writer.is_alive())
+            self.assertTrue(sweeper.is_alive())
+        writer.join()
+        sweeper.join()
+        with app.app_context():
+            flushed.append(weather_service.maintain(database.get_db())['accessed_flushed'])
+        # The access is flushed exactly once, by whichever pass ran after it
+        self.assertEqual(sum(flushed), 1)
+
+    def test_58_users_pagination_reaches_null_created_at(self):
+        """Test users with no created_at are paged after the dated ones instead of being skipped"""
+        headers = self._auth_headers()
+        with app.app_context():
+            conn = database.get_db()
+            conn.executemany('''INSERT INTO users (email, password_hash, name, role, location, created_at)
+                                VALUES (?, 'x', ?, 'farmer', 'Eldoret', ?)''',
+                             [(f'undated{i}@harvestnet.com', f'Undated {i}',
+                               None if i % 2 else f'2021-03-0{1 + i} 00:00:00') for i in range(5)])
+            conn.commit()
+        
+        for limit in (1, 2, 3):
+            seen, cursor = [], None
+            while True:
+                url = f'/api/users?location=Eldoret&limit={limit}&fields=name'
+                data = json.loads(self.client.get(url + (f'&cursor={cursor}' if cursor else ''),
+                                                  headers=headers).data)
+                seen.extend(user['name'] for user in data['users'])
+                cursor = data['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(seen, [f'Undated {i}' for i in (4, 2, 0, 3, 1)])
+        
+        with app.app_context():
+            plan = database.get_db().execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM users WHERE role = ? AND created_at IS NULL AND id < ? '
+                'ORDER BY created_at DESC, id DESC LIMIT 10', ('farmer', 5)).fetchall()
+            self.assertNotIn('TEMP B-TREE', ' '.join(row[-1] for row in plan))
 
 class FrontendIntegrationTest(unittest.TestCase):
     """Test frontend-backend integration"""
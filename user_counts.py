@@ -0,0 +1,130 @@
+import logging
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+from flask import Flask
+
+from cache import Counters
+from database import get_db
+from tasks import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+def create_schema(cursor: sqlite3.Cursor) -> None:
+    """Create the user_counts table and the triggers that keep it in step with users.
+    is_active is stored as 0 for NULL so it can be part of the key."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_counts'")
+    exists = cursor.fetchone() is not None
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS user_counts (
+            role TEXT NOT NULL,
+            is_active INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (role, is_active)
+        ) WITHOUT ROWID;
+
+        CREATE TRIGGER IF NOT EXISTS user_counts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO user_counts (role, is_active, count)
+            VALUES (new.role, IFNULL(new.is_active, 0), 1)
+            ON CONFLICT (role, is_active) DO UPDATE SET count = count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS user_counts_delete AFTER DELETE ON users BEGIN
+            UPDATE user_counts SET count = count - 1
+            WHERE role = old.role AND is_active = IFNULL(old.is_active, 0);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS user_counts_update AFTER UPDATE OF role, is_active ON users
+        WHEN old.role IS NOT new.role OR old.is_active IS NOT new.is_active BEGIN
+            UPDATE user_counts SET count = count - 1
+            WHERE role = old.role AND is_active = IFNULL(old.is_active, 0);
+            INSERT INTO user_counts (role, is_active, count)
+            VALUES (new.role, IFNULL(new.is_active, 0), 1)
+            ON CONFLICT (role, is_active) DO UPDATE SET count = count + 1;
+        END;
+    ''')
+    if not exists:
+        # Seed from the rows that predate the triggers
+        cursor.execute('''
+            INSERT INTO user_counts (role, is_active, count)
+            SELECT role, IFNULL(is_active, 0), COUNT(*) FROM users GROUP BY 1, 2
+        ''')
+
+
+def dashboard_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Active user totals for the dashboard, read from the handful of counter rows"""
+    active = dict(conn.execute('SELECT role, count FROM user_counts WHERE is_active = 1'))
+    return {
+        'total_users': sum(active.values()),
+        'active_farmers': active.get('farmer', 0),
+        'data_ambassadors': active.get('data_ambassador', 0),
+    }
+
+
+def reconcile(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """Recount users in one GROUP BY pass, overwrite any counter that drifted and
+    return the differences found"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        actual = {(role, is_active): count for role, is_active, count in conn.execute(
+            'SELECT role, IFNULL(is_active, 0), COUNT(*) FROM users GROUP BY 1, 2')}
+        stored = {(role, is_active): count for role, is_active, count in conn.execute(
+            'SELECT role, is_active, count FROM user_counts')}
+        drift = [{'role': role, 'is_active': is_active,
+                  'stored': stored.get((role, is_active), 0), 'actual': actual.get((role, is_active), 0)}
+                 for role, is_active in sorted(set(actual) | set(stored))
+                 if stored.get((role, is_active), 0) != actual.get((role, is_active), 0)]
+        if drift:
+            conn.execute('DELETE FROM user_counts')
+            conn.executemany('INSERT INTO user_counts (role, is_active, count) VALUES (?, ?, ?)',
+                             [(role, is_active, count) for (role, is_active), count in actual.items()])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return drift
+
+
+class UserCounts:
+    """Trigger-maintained user counters plus the periodic job that reconciles them"""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.reconciler: Optional[PeriodicTask] = None
+        self.counters = Counters('reconciles', 'drifted_groups')
+        self.last_drift: List[Dict[str, Any]] = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Schedule reconciliation every USER_COUNTS_RECONCILE_INTERVAL seconds"""
+        app.config.setdefault('USER_COUNTS_RECONCILE_INTERVAL', 3600)
+        self.reconciler = PeriodicTask('user-counts-reconcile',
+                                       app.config['USER_COUNTS_RECONCILE_INTERVAL'],
+                                       lambda: self.reconcile(get_db()), app=app)
+
+    def reconcile(self, conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+        """Run reconcile() and record what drifted"""
+        drift = reconcile(conn)
+        self.counters.incr('reconciles')
+        self.counters.incr('drifted_groups', len(drift))
+        self.last_drift = drift
+        if drift:
+            logger.warning('user_counts drifted from users and was corrected: %s', drift)
+        return drift
+
+    def start(self) -> None:
+        if self.reconciler is not None:
+            self.reconciler.start()
+
+    def stop(self) -> None:
+        if self.reconciler is not None:
+            self.reconciler.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        """Reconcile runs, drift found and the last run's corrections"""
+        stats: Dict[str, Any] = self.counters.snapshot()
+        stats['last_drift'] = self.last_drift
+        if self.reconciler is not None:
+            stats['reconciler'] = self.reconciler.stats()
+        return stats
@@ -0,0 +1,182 @@
+import base64
+import json
+import re
+import sqlite3
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+USER_FIELDS = ('id', 'email', 'name', 'role', 'location', 'phone', 'created_at', 'last_login', 'is_active')
+
+# Columns covered by the users_fts full-text index
+SEARCH_COLUMNS = ('name', 'email', 'location')
+
+# The trigram tokenizer indexes 3-character windows, so shorter terms cannot use it
+MIN_SEARCH_LENGTH = 3
+
+# Equality filters accepted by list_users, and how each query string value is read
+USER_FILTERS = {
+    'role': str,
+    'location': str,
+    'is_active': lambda value: {'1': 1, 'true': 1, '0': 0, 'false': 0}[value.lower()],
+}
+
+
+def create_indexes(cursor: sqlite3.Cursor) -> None:
+    """Indexes that let each page of list_users start at its cursor instead of
+    sorting the whole table; id rides along in every index as the rowid"""
+    cursor.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);
+        CREATE INDEX IF NOT EXISTS idx_users_role_created_at ON users (role, created_at);
+        CREATE INDEX IF NOT EXISTS idx_users_location_created_at ON users (location, created_at);
+    ''')
+
+
+def create_search_index(cursor: sqlite3.Cursor) -> None:
+    """Trigram FTS5 index over SEARCH_COLUMNS, kept in step with users by triggers.
+    Trigrams give case-insensitive substring matches, the same as LIKE '%term%'.
+    Skipped on SQLite builds without FTS5 or its trigram tokenizer (before 3.34)."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")
+    if cursor.fetchone() is not None:
+        return
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE users_fts USING fts5(
+                {', '.join(SEARCH_COLUMNS)}, content='users', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return
+    columns = ', '.join(SEARCH_COLUMNS)
+    old_values = ', '.join(f'old.{name}' for name in SEARCH_COLUMNS)
+    new_values = ', '.join(f'new.{name}' for name in SEARCH_COLUMNS)
+    cursor.executescript(f'''
+        CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END;
+        CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END;
+        CREATE TRIGGER users_fts_update AFTER UPDATE OF {columns} ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO users_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END;
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+def has_search_index(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'").fetchone() is not None
+
+
+def _fts_query(terms: Sequence[str], columns: Sequence[str]) -> str:
+    """MATCH expression for any of terms, each as a quoted substring, in any of columns"""
+    phrases = ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+    return f"{{{' '.join(columns)}}} : ({phrases})"
+
+
+def match_condition(conn: sqlite3.Connection, terms: Sequence[str],
+                    columns: Sequence[str] = SEARCH_COLUMNS) -> Tuple[str, List[Any]]:
+    """SQL condition on users.id for rows where any of columns contains any of terms,
+    ignoring case. Uses users_fts when it can, otherwise a LIKE scan."""
+    if has_search_index(conn) and all(len(term) >= MIN_SEARCH_LENGTH for term in terms):
+        return 'id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)', [_fts_query(terms, columns)]
+    patterns = ['%' + re.sub(r'([\\%_])', r'\\\1', term) + '%' for term in terms]
+    conditions = [f"{column} LIKE ? ESCAPE '\\'" for _ in patterns for column in columns]
+    return '(' + ' OR '.join(conditions) + ')', [pattern for pattern in patterns for _ in columns]
+
+
+def search_users(conn: sqlite3.Connection, query: str, fields: Sequence[str], filters: Dict[str, Any],
+                 limit: int, offset: int = 0) -> Tuple[List[tuple], Optional[int]]:
+    """One page of users matching query, best match first (bm25), as (id, *fields)
+    rows plus the offset of the next page"""
+    conditions = [f'users.{name} = ?' for name in filters]
+    params: List[Any] = list(filters.values())
+    selected = ', '.join(f'users.{name}' for name in fields)
+    if has_search_index(conn):
+        where = ''.join(f' AND {condition}' for condition in conditions)
+        sql = f'''
+            SELECT users.id, {selected} FROM users_fts JOIN users ON users.id = users_fts.rowid
+            WHERE users_fts MATCH ?{where}
+            ORDER BY users_fts.rank, users.id LIMIT ? OFFSET ?
+        '''
+        params.insert(0, _fts_query([query], SEARCH_COLUMNS))
+    else:
+        condition, match_params = match_condition(conn, [query])
+        sql = f'''
+            SELECT users.id, {selected} FROM users WHERE {' AND '.join([condition] + conditions)}
+            ORDER BY users.created_at DESC, users.id DESC LIMIT ? OFFSET ?
+        '''
+        params = match_params + params
+    rows = conn.execute(sql, params + [limit + 1, offset]).fetchall()
+    return rows[:limit], offset + limit if len(rows) > limit else None
+
+
+def encode_cursor(created_at: Optional[str], user_id: int) -> str:
+    """Opaque page token for the position just after (created_at, id)"""
+    return base64.urlsafe_b64encode(json.dumps([created_at, user_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token: str) -> Tuple[Optional[str], int]:
+    """Inverse of encode_cursor; ValueError for anything it did not produce"""
+    try:
+        created_at, user_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(created_at, (str, type(None))) or not isinstance(user_id, int):
+        raise ValueError('Invalid cursor')
+    return created_at, user_id
+
+
+def parse_fields(value: Optional[str]) -> Tuple[str, ...]:
+    """Columns named by a fields= list, in USER_FIELDS order; all of them when absent"""
+    if not value:
+        return USER_FIELDS
+    requested = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = requested - set(USER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(name for name in USER_FIELDS if name in requested)
+
+
+def parse_filters(args: Any) -> Dict[str, Any]:
+    """Filters present in a request's query string"""
+    filters = {}
+    for name, convert in USER_FILTERS.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        try:
+            filters[name] = convert(value)
+        except KeyError:
+            raise ValueError(f'Invalid value for {name}: {value}')
+    return filters
+
+
+def list_users(conn: sqlite3.Connection, fields: Sequence[str], filters: Dict[str, Any],
+               limit: int, after: Optional[Tuple[Optional[str], int]] = None) -> Tuple[List[tuple], Optional[str]]:
+    """One page of users, newest first, as (id, *fields) rows plus the next page's cursor.
+
+    Keyset pagination on (created_at, id): each page is a range scan from the
+    cursor, so page cost stays flat however deep the client goes. Users with no
+    created_at sort last, by id; a row-value comparison never matches them, so
+    they are paged as a second range over created_at IS NULL."""
+    conditions = [f'{name} = ?' for name in filters]
+    params: List[Any] = list(filters.values())
+
+    def page(keyset: List[str], keyset_params: List[Any], count: int) -> List[tuple]:
+        where = ' AND '.join(conditions + keyset)
+        return conn.execute(f'''
+            SELECT created_at, id, {', '.join(fields)} FROM users {f'WHERE {where}' if where else ''}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', params + keyset_params + [count]).fetchall()
+
+    # One row past the page tells us whether another page follows
+    if after is None:
+        rows = page([], [], limit + 1)
+    elif after[0] is None:
+        rows = page(['created_at IS NULL', 'id < ?'], [after[1]], limit + 1)
+    else:
+        rows = page(['(created_at, id) < (?, ?)'], list(after), limit + 1)
+        if len(rows) <= limit:
+            rows += page(['created_at IS NULL'], [], limit + 1 - len(rows))
+    next_cursor = encode_cursor(*rows[limit - 1][:2]) if len(rows) > limit else None
+    return [row[1:] for row in rows[:limit]], next_cursor
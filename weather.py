@@ -0,0 +1,989 @@
+import gzip
+import hashlib
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import requests
+from flask import Flask, Response
+
+from cache import Counters, LRUCache, SingleFlight
+from database import connection, get_db
+from met_client import CircuitBreaker, CircuitOpenError, MetClient
+from tasks import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+# met.no asks clients to send at most 4 decimals; more only fragments its cache
+MET_MAX_DECIMALS = 4
+
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Farming regions kept pre-warmed by the prefetch scheduler: (name, lat, lon)
+DEFAULT_HOT_REGIONS = [
+    ('Nairobi', -1.2921, 36.8219),
+    ('Mombasa', -4.0435, 39.6682),
+    ('Kisumu', -0.0917, 34.7680),
+    ('Nakuru', -0.3031, 36.0800),
+    ('Uasin Gishu', 0.5143, 35.2698),
+    ('Kiambu', -1.1714, 36.8356),
+    ('Meru', 0.0463, 37.6559),
+    ('Kakamega', 0.2827, 34.7519),
+]
+
+# Forecast summaries group hours into local calendar days (East Africa Time, no DST)
+SUMMARY_UTC_OFFSET_HOURS = 3
+
+# Field-work suitability rules applied to each summarised day
+PLANTING_MIN_RAIN_MM = 5.0    # enough rain to wet the seedbed
+PLANTING_MAX_RAIN_MM = 40.0   # beyond this, seed and topsoil wash out
+PLANTING_MAX_TEMP_C = 35.0
+SPRAYING_MAX_WIND_MS = 4.0    # drift risk above ~4 m/s
+SPRAYING_MAX_RAIN_MM = 1.0    # rain washes chemicals off the leaf
+SPRAYING_MAX_TEMP_C = 30.0    # evaporation and volatilisation
+
+# Response shapes of the weather endpoints: the met.no document, or per-day summaries
+WEATHER_VIEWS = ('full', 'summary')
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+_PRECIPITATION_PERIODS = ((1, 'next_1_hours'), (6, 'next_6_hours'), (12, 'next_12_hours'))
+
+
+class WeatherUnavailable(Exception):
+    """Raised when the upstream forecast service cannot provide data"""
+
+
+class GridCell:
+    """A quantized forecast location shared by every point that snaps to it"""
+
+    __slots__ = ('key', 'latitude', 'longitude')
+
+    def __init__(self, key: str, latitude: float, longitude: float):
+        self.key = key
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __repr__(self) -> str:
+        return f'GridCell({self.key!r}, {self.latitude}, {self.longitude})'
+
+
+def geohash_encode(lat: float, lon: float, precision: int) -> str:
+    """Standard base32 geohash of a point"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def geohash_center(geohash: str) -> Tuple[float, float]:
+    """Centre point (lat, lon) of a geohash cell"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        index = _GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (index >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def quantize(lat: float, lon: float, step: Optional[float] = 0.01,
+             geohash_precision: Optional[int] = None) -> GridCell:
+    """Snap a point to its forecast cell (geohash if a precision is given, else a degree grid)"""
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError(f'Coordinates out of range: {lat}, {lon}')
+
+    if geohash_precision:
+        key = geohash_encode(lat, lon, geohash_precision)
+        center_lat, center_lon = geohash_center(key)
+        return GridCell(key, round(center_lat, MET_MAX_DECIMALS), round(center_lon, MET_MAX_DECIMALS))
+
+    if step:
+        lat = round(lat / step) * step
+        lon = round(lon / step) * step
+    lat, lon = round(lat, MET_MAX_DECIMALS), round(lon, MET_MAX_DECIMALS)
+    return GridCell(f'{lat:g},{lon:g}', lat, lon)
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi, d_lambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+
+def _precipitation(data: Dict[str, Any], gap_hours: Optional[float]) -> float:
+    """Rain falling between this timestep and the next, from the shortest met.no
+    period covering the gap (pro rata when the period overruns it)"""
+    for hours, key in _PRECIPITATION_PERIODS:
+        amount = data.get(key, {}).get('details', {}).get('precipitation_amount')
+        if amount is None:
+            continue
+        if gap_hours is None:
+            return amount
+        if hours >= gap_hours:
+            return amount * gap_hours / hours
+    return 0.0
+
+
+def summarize_forecast(document: Dict[str, Any],
+                       utc_offset_hours: float = SUMMARY_UTC_OFFSET_HOURS) -> Dict[str, Any]:
+    """Per-day temperature range, rain total, wind peak and planting/spraying
+    suitability from a met.no compact document"""
+    properties = document.get('properties', {})
+    offset = timedelta(hours=utc_offset_hours)
+    steps = [(_parse_time(step['time']), step.get('data', {}))
+             for step in properties.get('timeseries', [])]
+    steps.sort(key=lambda step: step[0])
+
+    days: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+    for index, (at, data) in enumerate(steps):
+        day = days.setdefault((at + offset).date().isoformat(),
+                              {'temps': [], 'winds': [], 'rain': 0.0})
+        details = data.get('instant', {}).get('details', {})
+        if 'air_temperature' in details:
+            day['temps'].append(details['air_temperature'])
+        if 'wind_speed' in details:
+            day['winds'].append(details['wind_speed'])
+        gap = ((steps[index + 1][0] - at).total_seconds() / 3600
+               if index + 1 < len(steps) else None)
+        day['rain'] += _precipitation(data, gap)
+
+    summary_days = []
+    for date, day in days.items():
+        temp_min = min(day['temps']) if day['temps'] else None
+        temp_max = max(day['temps']) if day['temps'] else None
+        wind_max = max(day['winds']) if day['winds'] else None
+        rain = round(day['rain'], 1)
+        summary_days.append({
+            'date': date,
+            'temp_min': temp_min,
+            'temp_max': temp_max,
+            'rain_mm': rain,
+            'wind_max': wind_max,
+            'planting': (PLANTING_MIN_RAIN_MM <= rain <= PLANTING_MAX_RAIN_MM
+                         and temp_max is not None and temp_max <= PLANTING_MAX_TEMP_C),
+            'spraying': (rain <= SPRAYING_MAX_RAIN_MM
+                         and wind_max is not None and wind_max <= SPRAYING_MAX_WIND_MS
+                         and temp_max is not None and temp_max <= SPRAYING_MAX_TEMP_C),
+        })
+    return {
+        'updated_at': properties.get('meta', {}).get('updated_at'),
+        'utc_offset_hours': utc_offset_hours,
+        'units': {'temperature': 'celsius', 'rain': 'mm', 'wind': 'm/s'},
+        'days': summary_days,
+    }
+
+
+def encode_summary(document: Dict[str, Any]) -> bytes:
+    """Compact JSON bytes of a forecast summary, as stored and served"""
+    return json.dumps(summarize_forecast(document), separators=(',', ':')).encode('utf-8')
+
+
+class WeatherEntry:
+    """A cached forecast held as ready-to-send JSON bytes, with its fetch and
+    expiry times (epoch seconds) and the Last-Modified validator used to revalidate it.
+
+    Either form of the payload may be supplied; the other is derived on first use.
+    Entries loaded from the table start gzip-only, so the memory tier holds the
+    compact form until a client without gzip support asks for it. The daily
+    summary is computed when the payload is fetched and stored alongside it."""
+
+    __slots__ = ('latitude', 'longitude', 'cached_at', 'expires_at', 'last_modified',
+                 '_body', '_gzip_body', '_etag', '_summary', '_gzip_summary')
+
+    def __init__(self, latitude: float, longitude: float, body: Optional[bytes],
+                 cached_at: Optional[float] = None, expires_at: Optional[float] = None,
+                 last_modified: Optional[str] = None, gzip_body: Optional[bytes] = None,
+                 summary: Optional[bytes] = None):
+        if body is None and gzip_body is None:
+            raise ValueError('WeatherEntry needs a body or a gzip_body')
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cached_at = time.time() if cached_at is None else cached_at
+        self.expires_at = expires_at
+        self.last_modified = last_modified
+        self._body = body
+        self._gzip_body = gzip_body
+        self._etag: Optional[str] = None
+        self._summary = summary
+        self._gzip_summary: Optional[bytes] = None
+
+    @property
+    def body(self) -> bytes:
+        """Uncompressed JSON bytes"""
+        if self._body is None:
+            self._body = gzip.decompress(self._gzip_body)
+        return self._body
+
+    @property
+    def gzip_body(self) -> bytes:
+        """Gzip-compressed body, compressed once and reused for every hit"""
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self._body, compresslevel=6, mtime=0)
+        return self._gzip_body
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        """Parsed forecast document (only for callers that need to inspect it)"""
+        return json.loads(self.body)
+
+    @property
+    def summary(self) -> bytes:
+        """Serialized daily summary (derived once for rows stored without one)"""
+        if self._summary is None:
+            self._summary = encode_summary(self.data)
+        return self._summary
+
+    @property
+    def gzip_summary(self) -> bytes:
+        """Gzip-compressed summary, compressed once like the body"""
+        if self._gzip_summary is None:
+            self._gzip_summary = gzip.compress(self.summary, compresslevel=6, mtime=0)
+        return self._gzip_summary
+
+    @property
+    def etag(self) -> str:
+        """Strong validator for the payload, computed once from the compact form"""
+        if self._etag is None:
+            self._etag = '"' + hashlib.blake2b(self.gzip_body, digest_size=16).hexdigest() + '"'
+        return self._etag
+
+    @property
+    def summary_etag(self) -> str:
+        """Validator for the summary view; the summary is a pure function of the payload"""
+        return self.etag[:-1] + '-summary"'
+
+    def revalidated(self, cached_at: float, expires_at: float,
+                    last_modified: Optional[str]) -> 'WeatherEntry':
+        """Copy sharing this payload with new timestamps, after a 304 from upstream"""
+        entry = WeatherEntry(self.latitude, self.longitude, self._body, cached_at=cached_at,
+                             expires_at=expires_at, last_modified=last_modified,
+                             gzip_body=self._gzip_body, summary=self._summary)
+        entry._etag = self._etag
+        return entry
+
+    def same_payload(self, other: 'WeatherEntry') -> bool:
+        """True when both entries share one stored payload (no new document was fetched)"""
+        return ((self._gzip_body is not None and self._gzip_body is other._gzip_body)
+                or (self._body is not None and self._body is other._body))
+
+    def age(self) -> float:
+        """Seconds since the forecast was fetched"""
+        return max(0.0, time.time() - self.cached_at)
+
+    def is_fresh(self) -> bool:
+        """True until the upstream expiry time has passed"""
+        return self.expires_at is None or time.time() < self.expires_at
+
+
+def expiry_from_headers(headers: Any, now: float, default_ttl: float) -> float:
+    """Expiry time from an HTTP Expires header, or now + default_ttl"""
+    value = headers.get('Expires') if headers else None
+    if value:
+        try:
+            expires = parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            expires = None
+        if expires is not None and expires > now:
+            return expires
+    return now + default_ttl
+
+
+def encode_payload(entry: WeatherEntry) -> bytes:
+    """Value stored in weather_cache.weather_data: the gzip member, as a BLOB"""
+    return entry.gzip_body
+
+
+def payload_kwargs(value: Any) -> Dict[str, bytes]:
+    """WeatherEntry payload arguments for a stored weather_data value.
+    Rows written before compression hold JSON text and are read as-is."""
+    if isinstance(value, str):
+        return {'body': value.encode('utf-8')}
+    return {'body': None, 'gzip_body': bytes(value)}
+
+
+def decode_payload(value: Any) -> bytes:
+    """JSON bytes of a stored weather_data value, whichever form it was written in"""
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return gzip.decompress(value)
+
+
+def batch_response(results: List[Tuple[Dict[str, Any], Optional[WeatherEntry]]],
+                   view: str = 'full') -> Response:
+    """JSON document for a batch, splicing each cached forecast's (or summary's)
+    stored bytes in unparsed"""
+    parts = []
+    for meta, entry in results:
+        encoded = json.dumps(meta).encode('utf-8')
+        if entry is not None:
+            if view == 'summary':
+                encoded = encoded[:-1] + b', "summary": ' + entry.summary + b'}'
+            else:
+                encoded = encoded[:-1] + b', "forecast": ' + entry.body + b'}'
+        parts.append(encoded)
+    counts: Dict[str, int] = {}
+    for meta, _entry in results:
+        counts[meta['status']] = counts.get(meta['status'], 0) + 1
+    body = (b'{"count": ' + str(len(parts)).encode() + b', "statuses": '
+            + json.dumps(counts).encode('utf-8') + b', "results": [' + b', '.join(parts) + b']}')
+    return Response(body, mimetype='application/json')
+
+
+def forecast_response(entry: WeatherEntry, request_headers: Any,
+                      gzip_min_bytes: int = 1024, view: str = 'full') -> Response:
+    """Build the HTTP response for a cached entry straight from its stored bytes.
+    The gzip representation carries its own ETag ('-gz' suffix), so a validator is
+    only ever matched against the encoding this request would be sent."""
+    body = entry.summary if view == 'summary' else entry.body
+    etag = entry.summary_etag if view == 'summary' else entry.etag
+    compress = len(body) >= gzip_min_bytes and 'gzip' in request_headers.get('Accept-Encoding', '')
+    if compress:
+        etag = etag[:-1] + '-gz"'
+
+    if etag in request_headers.get('If-None-Match', ''):
+        response = Response(status=304)
+    else:
+        response = Response(mimetype='application/json')
+        if compress:
+            body = entry.gzip_summary if view == 'summary' else entry.gzip_body
+            response.headers['Content-Encoding'] = 'gzip'
+        response.set_data(body)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['ETag'] = etag
+    return response
+
+
+class WeatherService:
+    """Two-tier forecast cache: in-process LRU in front of the weather_cache table"""
+
+    def __init__(self, app: Optional[Flask] = None):
+        self.app = None
+        self.ttl = 3600
+        self.stale_ttl = 6 * 3600
+        self.stale_while_revalidate = True
+        self.grid_step = 0.01
+        self.geohash_precision = None
+        self.hot_regions: List[Tuple[str, float, float]] = list(DEFAULT_HOT_REGIONS)
+        self.prefetch_lead = 600
+        self.memory = LRUCache()
+        self.flights = SingleFlight()
+        self.prefetcher: Optional[PeriodicTask] = None
+        self.maintainer: Optional[PeriodicTask] = None
+        self.max_rows = 10000
+        self.max_bytes = 256 * 1024 * 1024
+        self.nearest_radius_km = 5.0
+        self._rtree_available = True
+        self._accessed: Dict[Tuple[float, float], int] = {}
+        self._accessed_lock = threading.Lock()
+        self.client: Optional[MetClient] = None
+        self.counters = Counters('db_hits', 'db_misses', 'upstream_fetches', 'revalidated',
+                                 'warmed', 'stale_served', 'refreshes', 'refresh_failures',
+                                 'prefetch_scheduled', 'table_expired', 'table_evictions',
+                                 'fallback_served', 'nearby_hits')
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._refresh_workers = 2
+        self._batch_executor: Optional[ThreadPoolExecutor] = None
+        self._batch_workers = 4
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Read cache sizing and upstream settings from the app config"""
+        app.config.setdefault('WEATHER_CACHE_SIZE', 512)
+        # Freshness used when met.no sends no Expires header
+        app.config.setdefault('WEATHER_CACHE_TTL', 3600)
+        # How long past expiry an entry may still be served while it is refreshed
+        app.config.setdefault('WEATHER_STALE_TTL', 6 * 3600)
+        app.config.setdefault('WEATHER_STALE_WHILE_REVALIDATE', True)
+        app.config.setdefault('WEATHER_REFRESH_WORKERS', 2)
+        # Batch endpoint: parallel upstream fetches shared by all batch requests
+        app.config.setdefault('WEATHER_BATCH_WORKERS', 4)
+        app.config.setdefault('WEATHER_BATCH_MAX_LOCATIONS', 100)
+        app.config.setdefault('WEATHER_BATCH_TIMEOUT', 8)
+        app.config.setdefault('WEATHER_HOT_REGIONS', list(DEFAULT_HOT_REGIONS))
+        app.config.setdefault('WEATHER_PREFETCH_INTERVAL', 300)
+        app.config.setdefault('WEATHER_PREFETCH_LEAD', 600)
+        # Budget for the weather_cache table, enforced least-recently-used first
+        app.config.setdefault('WEATHER_TABLE_MAX_ROWS', 10000)
+        app.config.setdefault('WEATHER_TABLE_MAX_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('WEATHER_MAINTENANCE_INTERVAL', 600)
+        app.config.setdefault('MET_API_URL',
+                              'https://api.met.no/weatherapi/locationforecast/2.0/compact')
+        app.config.setdefault('MET_USER_AGENT', 'HarvestNet/1.0 (contact@harvestnet.com)')
+        # Latency budget for one upstream call (connect + full body), kept well under
+        # the worker timeout so a slow met.no cannot pin request workers
+        app.config.setdefault('MET_TIMEOUT', 5)
+        app.config.setdefault('MET_CONNECT_TIMEOUT', 2)
+        app.config.setdefault('MET_POOL_SIZE', 10)
+        app.config.setdefault('MET_BREAKER_WINDOW', 20)
+        app.config.setdefault('MET_BREAKER_MIN_CALLS', 5)
+        app.config.setdefault('MET_BREAKER_FAILURE_RATE', 0.5)
+        app.config.setdefault('MET_BREAKER_RESET_TIMEOUT', 30)
+        # Coordinate snapping: a degree grid step, or a geohash precision which takes priority
+        app.config.setdefault('WEATHER_GRID_STEP', 0.01)
+        # Bodies smaller than this are sent uncompressed even to gzip-capable clients
+        app.config.setdefault('WEATHER_GZIP_MIN_BYTES', 1024)
+        app.config.setdefault('WEATHER_GEOHASH_PRECISION', None)
+        # A fresh forecast cached within this distance serves a miss instead of met.no (0 disables)
+        app.config.setdefault('WEATHER_NEAREST_RADIUS_KM', 5.0)
+
+        self.app = app
+        self.ttl = app.config['WEATHER_CACHE_TTL']
+        self.stale_ttl = app.config['WEATHER_STALE_TTL']
+        self.stale_while_revalidate = app.config['WEATHER_STALE_WHILE_REVALIDATE']
+        self.grid_step = app.config['WEATHER_GRID_STEP']
+        self.geohash_precision = app.config['WEATHER_GEOHASH_PRECISION']
+        self.hot_regions = list(app.config['WEATHER_HOT_REGIONS'])
+        self.prefetch_lead = app.config['WEATHER_PREFETCH_LEAD']
+        self._refresh_workers = app.config['WEATHER_REFRESH_WORKERS']
+        self._batch_workers = app.config['WEATHER_BATCH_WORKERS']
+        self.max_rows = app.config['WEATHER_TABLE_MAX_ROWS']
+        self.max_bytes = app.config['WEATHER_TABLE_MAX_BYTES']
+        self.nearest_radius_km = app.config['WEATHER_NEAREST_RADIUS_KM']
+        self.memory = LRUCache(max_size=app.config['WEATHER_CACHE_SIZE'], ttl=self.ttl)
+        breaker = CircuitBreaker(window_size=app.config['MET_BREAKER_WINDOW'],
+                                 min_calls=app.config['MET_BREAKER_MIN_CALLS'],
+                                 failure_rate=app.config['MET_BREAKER_FAILURE_RATE'],
+                                 reset_timeout=app.config['MET_BREAKER_RESET_TIMEOUT'])
+        self.client = MetClient(app.config['MET_API_URL'], app.config['MET_USER_AGENT'],
+                                timeout=app.config['MET_TIMEOUT'],
+                                pool_size=app.config['MET_POOL_SIZE'],
+                                connect_timeout=app.config['MET_CONNECT_TIMEOUT'],
+                                breaker=breaker)
+        self.prefetcher = PeriodicTask('weather-prefetch', app.config['WEATHER_PREFETCH_INTERVAL'],
+                                       self.prefetch_hot_regions, app=app)
+        self.maintainer = PeriodicTask('weather-maintenance',
+                                       app.config['WEATHER_MAINTENANCE_INTERVAL'],
+                                       lambda: self.maintain(get_db()), app=app)
+
+    def cell_for(self, lat: float, lon: float) -> GridCell:
+        """The cache cell a requested point is served from"""
+        return quantize(lat, lon, self.grid_step, self.geohash_precision)
+
+    def get_forecast(self, lat: float, lon: float) -> Tuple[WeatherEntry, GridCell, str]:
+        """Return the forecast for a location, the cell it came from and which tier served it"""
+        cell = self.cell_for(lat, lon)
+        served = self._from_memory(cell)
+        if served is not None:
+            return served[0], cell, served[1]
+
+        # Concurrent misses for the same cell share one table lookup and fetch
+        (entry, source), shared = self.flights.do(cell.key, self._resolve_miss, cell)
+        return entry, cell, 'coalesced' if shared else source
+
+    def get_forecasts(self, points: Iterable[Tuple[float, float]],
+                      timeout: float) -> List[Tuple[Dict[str, Any], Optional[WeatherEntry]]]:
+        """Resolve many points at once: hits from memory and a single table query,
+        misses fetched in parallel on the bounded batch pool until the deadline.
+        Returns (metadata, entry) per point, in request order; entry is None unless
+        the point's status is ok or stale."""
+        deadline = time.monotonic() + timeout
+        items: List[Tuple[Dict[str, Any], Optional[GridCell]]] = []
+        cells: Dict[str, GridCell] = {}
+        for lat, lon in points:
+            meta: Dict[str, Any] = {'lat': lat, 'lon': lon}
+            try:
+                cell = self.cell_for(lat, lon)
+            except ValueError as e:
+                meta.update(status='invalid', error=str(e))
+                items.append((meta, None))
+                continue
+            meta['cell'] = cell.key
+            cells[cell.key] = cell
+            items.append((meta, cell))
+
+        resolved: Dict[str, Tuple[WeatherEntry, str]] = {}
+        pending: Dict[str, GridCell] = {}
+        for key, cell in cells.items():
+            served = self._from_memory(cell)
+            if served is not None:
+                resolved[key] = served
+            else:
+                pending[key] = cell
+
+        rows: Dict[str, WeatherEntry] = {}
+        misses: List[str] = []
+        if pending:
+            # Borrowed for the table reads only, not while upstream fetches run
+            with connection(self.app) as conn:
+                rows = self._load_many(conn, pending.values())
+                for key, cell in pending.items():
+                    served = self._from_table(cell, rows.get(key)) or self._from_nearby(conn, cell)
+                    if served is not None:
+                        resolved[key] = served
+                    else:
+                        misses.append(key)
+        futures = {}
+        for key in misses:
+            self.counters.incr('db_misses')
+            future = self._batch_pool().submit(self._fetch_in_context, pending[key], rows.get(key))
+            futures[future] = key
+
+        errors: Dict[str, str] = {}
+        if futures:
+            done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+            for future in done:
+                try:
+                    resolved[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = str(e)
+
+        results = []
+        for meta, cell in items:
+            if cell is None:
+                results.append((meta, None))
+            elif cell.key in resolved:
+                entry, source = resolved[cell.key]
+                meta.update(status='stale' if source == 'stale' else 'ok', source=source)
+                if (entry.latitude, entry.longitude) != (cell.latitude, cell.longitude):
+                    meta['forecast_location'] = [entry.latitude, entry.longitude]
+                results.append((meta, entry))
+            elif cell.key in errors:
+                meta.update(status='error', error=errors[cell.key])
+                results.append((meta, None))
+            else:
+                # The fetch keeps running and will land in the cache for the next call
+                meta['status'] = 'timeout'
+                results.append((meta, None))
+        return results
+
+    def _batch_pool(self) -> ThreadPoolExecutor:
+        with self._refresh_lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self._batch_workers,
+                                                          thread_name_prefix='weather-batch')
+            return self._batch_executor
+
+    def _fetch_in_context(self, cell: GridCell,
+                          previous: Optional[WeatherEntry]) -> Tuple[WeatherEntry, str]:
+        try:
+            with self.app.app_context():
+                (entry, source), shared = self.flights.do(cell.key, self._fetch_and_store, cell,
+                                                          previous=previous)
+        except WeatherUnavailable:
+            if previous is None:
+                raise
+            self.counters.incr('fallback_served')
+            return previous, 'stale'
+        return entry, 'coalesced' if shared else source
+
+    def _from_memory(self, cell: GridCell) -> Optional[Tuple[WeatherEntry, str]]:
+        """Serve a cell from the memory tier if it holds a fresh or (with SWR) stale entry"""
+        entry = self.memory.get(cell.key)
+        if entry is None:
+            return None
+        # Table LRU order is maintained from these in batches, off the request path
+        self._note_access(entry.latitude, entry.longitude)
+        if entry.is_fresh():
+            return entry, 'memory'
+        if self.stale_while_revalidate:
+            return self._serve_stale(cell, entry), 'stale'
+        return None
+
+    def _from_table(self, cell: GridCell,
+                    entry: Optional[WeatherEntry]) -> Optional[Tuple[WeatherEntry, str]]:
+        """Serve a row loaded from the table tier if it is still usable"""
+        if entry is None or not self._servable(entry):
+            return None
+        self._note_access(cell.latitude, cell.longitude)
+        self._remember(cell, entry)
+        if entry.is_fresh():
+            self.counters.incr('db_hits')
+            return entry, 'database'
+        if self.stale_while_revalidate:
+            self.counters.incr('db_hits')
+            return self._serve_stale(cell, entry), 'stale'
+        return None
+
+    def _from_nearby(self, conn: sqlite3.Connection,
+                     cell: GridCell) -> Optional[Tuple[WeatherEntry, str]]:
+        """Serve a cell from the nearest fresh forecast cached within the radius"""
+        entry = self._nearest(conn, cell.latitude, cell.longitude)
+        if entry is None:
+            return None
+        self.counters.incr('nearby_hits')
+        self._note_access(entry.latitude, entry.longitude)
+        # Borrowed only while fresh; once it expires the cell fetches its own forecast
+        self.memory.set(cell.key, entry, ttl=entry.expires_at - time.time())
+        return entry, 'nearby'
+
+    def _resolve_miss(self, cell: GridCell) -> Tuple[WeatherEntry, str]:
+        """Load a cell from the table tier, falling back to met.no"""
+        # The connection goes back to the pool before any upstream call
+        with connection(self.app) as conn:
+            entry = self._load(conn, cell.latitude, cell.longitude)
+            served = self._from_table(cell, entry) or self._from_nearby(conn, cell)
+        if served is not None:
+            return served
+        self.counters.incr('db_misses')
+        # Even a row past the stale window still carries a usable validator
+        try:
+            return self._fetch_and_store(cell, previous=entry)
+        except WeatherUnavailable:
+            if entry is None:
+                raise
+            # Upstream is down or the breaker is open: the last known forecast beats an error
+            self.counters.incr('fallback_served')
+            return entry, 'stale'
+
+    def _fetch_and_store(self, cell: GridCell,
+                         previous: Optional[WeatherEntry] = None) -> Tuple[WeatherEntry, str]:
+        """Fetch (or revalidate) a cell from met.no and write it through both tiers"""
+        if previous is not None and (previous.latitude, previous.longitude) != (cell.latitude,
+                                                                              cell.longitude):
+            # A neighbour's forecast borrowed by this cell is no validator for it
+            previous = None
+        entry = self._fetch(cell.latitude, cell.longitude, previous=previous)
+        with connection(self.app) as conn:
+            if previous is not None and entry.same_payload(previous):
+                # 304 Not Modified: only the timestamps move
+                self._touch(conn, entry)
+            else:
+                self._store(conn, entry)
+        self._remember(cell, entry)
+        return entry, 'upstream'
+
+    def _servable(self, entry: WeatherEntry) -> bool:
+        """Fresh, or expired but still inside the stale window"""
+        return entry.expires_at + self.stale_ttl > time.time()
+
+    def _remember(self, cell: GridCell, entry: WeatherEntry) -> None:
+        """Keep an entry in memory until it falls out of the stale window"""
+        if entry.expires_at is None:
+            entry.expires_at = entry.cached_at + self.ttl
+        remaining = entry.expires_at + self.stale_ttl - time.time()
+        if remaining > 0:
+            self.memory.set(cell.key, entry, ttl=remaining)
+
+    def _serve_stale(self, cell: GridCell, entry: WeatherEntry) -> WeatherEntry:
+        """Hand back an expired entry and queue its revalidation"""
+        self.counters.incr('stale_served')
+        self.schedule_refresh(cell)
+        return entry
+
+    def schedule_refresh(self, cell: GridCell) -> bool:
+        """Queue a background refresh of a cell unless one is already pending"""
+        with self._refresh_lock:
+            if cell.key in self._refreshing:
+                return False
+            self._refreshing.add(cell.key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._refresh_workers,
+                                                    thread_name_prefix='weather-refresh')
+            executor = self._executor
+        executor.submit(self._background_refresh, cell)
+        return True
+
+    def _background_refresh(self, cell: GridCell) -> None:
+        try:
+            with self.app.app_context():
+                self.flights.do(cell.key, self._fetch_and_store, cell,
+                                previous=self.memory.peek(cell.key))
+            self.counters.incr('refreshes')
+        except Exception:
+            self.counters.incr('refresh_failures')
+            logger.exception('Background refresh of weather cell %s failed', cell.key)
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(cell.key)
+
+    def prefetch_hot_regions(self) -> int:
+        """Refresh hot regions that are missing or will expire within the prefetch lead time"""
+        scheduled = 0
+        deadline = time.time() + self.prefetch_lead
+        for _name, lat, lon in self.hot_regions:
+            cell = self.cell_for(lat, lon)
+            entry = self.memory.peek(cell.key)
+            if entry is None:
+                entry = self._load(get_db(), cell.latitude, cell.longitude)
+                if entry is not None and self._servable(entry):
+                    self._remember(cell, entry)
+            if entry is None or entry.expires_at < deadline:
+                if self.schedule_refresh(cell):
+                    scheduled += 1
+        self.counters.incr('prefetch_scheduled', scheduled)
+        return scheduled
+
+    def _note_access(self, lat: float, lon: float) -> None:
+        """Remember when a cell was last served, for maintain to persist"""
+        with self._accessed_lock:
+            self._accessed[(lat, lon)] = int(time.time())
+
+    def maintain(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        """Persist access times, drop unservable rows, enforce the table budget
+        least-recently-used first and return freed pages to the filesystem"""
+        # Swapped under the lock writers take, so no request still holds the old dict
+        with self._accessed_lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            conn.executemany('UPDATE weather_cache SET last_accessed = ? WHERE latitude = ? AND longitude = ?',
+                             [(at, lat, lon) for (lat, lon), at in accessed.items()])
+
+        expired = conn.execute('''
+            DELETE FROM weather_cache
+            WHERE COALESCE(expires_at, CAST(strftime('%s', cached_at) AS INTEGER) + ?) < ?
+        ''', (self.ttl, int(time.time() - self.stale_ttl))).rowcount
+
+        rows, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(length(weather_data)), 0) FROM weather_cache').fetchone()
+        victims = []
+        if rows > self.max_rows or size > self.max_bytes:
+            candidates = conn.execute('''
+                SELECT id, length(weather_data) FROM weather_cache
+                ORDER BY COALESCE(last_accessed, CAST(strftime('%s', cached_at) AS INTEGER)), id
+            ''')
+            for row_id, row_bytes in candidates:
+                if rows <= self.max_rows and size <= self.max_bytes:
+                    break
+                victims.append((row_id,))
+                rows -= 1
+                size -= row_bytes
+            conn.executemany('DELETE FROM weather_cache WHERE id = ?', victims)
+        conn.commit()
+
+        freed_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if freed_pages:
+            conn.execute(f'PRAGMA incremental_vacuum({freed_pages})').fetchall()
+
+        self.counters.incr('table_expired', expired)
+        self.counters.incr('table_evictions', len(victims))
+        return {'expired': expired, 'evicted': len(victims), 'accessed_flushed': len(accessed),
+                'pages_vacuumed': freed_pages}
+
+    def table_stats(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Row count and size of the weather_cache table against its budget"""
+        rows, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(length(weather_data)), 0) FROM weather_cache').fetchone()
+        return {
+            'rows': rows,
+            'payload_bytes': size,
+            'max_rows': self.max_rows,
+            'max_bytes': self.max_bytes,
+            'expired_deleted': self.counters.get('table_expired'),
+            'evictions': self.counters.get('table_evictions'),
+        }
+
+    def start(self) -> None:
+        """Start the hot-region prefetch scheduler and table maintenance"""
+        for task in (self.prefetcher, self.maintainer):
+            if task is not None:
+                task.start()
+
+    def stop(self) -> None:
+        """Stop the schedulers and wait for queued refreshes"""
+        for task in (self.prefetcher, self.maintainer):
+            if task is not None:
+                task.stop()
+        with self._refresh_lock:
+            executors = [self._executor, self._batch_executor]
+            self._executor = self._batch_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        if self.client is not None:
+            self.client.close()
+
+    def _entry_from_row(self, lat: float, lon: float, weather_data: Any, cached_epoch: int,
+                        expires_at: Optional[int], last_modified: Optional[str],
+                        summary: Optional[bytes]) -> WeatherEntry:
+        if expires_at is None:
+            expires_at = cached_epoch + self.ttl
+        return WeatherEntry(lat, lon, cached_at=cached_epoch, expires_at=expires_at,
+                            last_modified=last_modified,
+                            summary=bytes(summary) if summary is not None else None,
+                            **payload_kwargs(weather_data))
+
+    def _load(self, conn: sqlite3.Connection, lat: float, lon: float) -> Optional[WeatherEntry]:
+        """Newest row for the location, servable or not"""
+        row = conn.execute('''
+            SELECT weather_data, CAST(strftime('%s', cached_at) AS INTEGER),
+                   expires_at, last_modified, summary
+            FROM weather_cache
+            WHERE latitude = ? AND longitude = ?
+        ''', (lat, lon)).fetchone()
+        if row is None:
+            return None
+        return self._entry_from_row(lat, lon, *row)
+
+    def _load_many(self, conn: sqlite3.Connection,
+                   cells: Iterable[GridCell]) -> Dict[str, WeatherEntry]:
+        """Rows for many cells in one query, keyed by cell key"""
+        by_location = {(cell.latitude, cell.longitude): cell.key for cell in cells}
+        values = ', '.join(['(?, ?)'] * len(by_location))
+        params = [coordinate for location in by_location for coordinate in location]
+        rows = conn.execute(f'''
+            SELECT latitude, longitude, weather_data, CAST(strftime('%s', cached_at) AS INTEGER),
+                   expires_at, last_modified, summary
+            FROM weather_cache
+            WHERE (latitude, longitude) IN (VALUES {values})
+        ''', params).fetchall()
+        return {by_location[(row[0], row[1])]: self._entry_from_row(*row) for row in rows}
+
+    def _nearest(self, conn: sqlite3.Connection, lat: float, lon: float) -> Optional[WeatherEntry]:
+        """Closest fresh cached forecast within nearest_radius_km, via the R*Tree"""
+        if not self.nearest_radius_km or not self._rtree_available:
+            return None
+        d_lat = self.nearest_radius_km / KM_PER_DEGREE_LAT
+        d_lon = self.nearest_radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+        try:
+            candidates = conn.execute('''
+                SELECT w.latitude, w.longitude
+                FROM weather_cache_rtree AS r JOIN weather_cache AS w ON w.id = r.id
+                WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+                  AND COALESCE(w.expires_at, CAST(strftime('%s', w.cached_at) AS INTEGER) + ?) > ?
+            ''', (lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon,
+                  self.ttl, int(time.time()))).fetchall()
+        except sqlite3.OperationalError:
+            # Database created without R*Tree support
+            self._rtree_available = False
+            return None
+
+        best = None
+        for candidate_lat, candidate_lon in candidates:
+            distance = haversine_km(lat, lon, candidate_lat, candidate_lon)
+            if distance <= self.nearest_radius_km and (best is None or distance < best[0]):
+                best = (distance, candidate_lat, candidate_lon)
+        if best is None:
+            return None
+        entry = self._load(conn, best[1], best[2])
+        return entry if entry is not None and entry.is_fresh() else None
+
+    def _store(self, conn: sqlite3.Connection, entry: WeatherEntry) -> None:
+        """Write a freshly fetched forecast to the table tier, replacing the cell's row"""
+        conn.execute('''
+            INSERT INTO weather_cache (latitude, longitude, weather_data, expires_at,
+                                       last_modified, last_accessed, summary)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (latitude, longitude) DO UPDATE SET
+                weather_data = excluded.weather_data,
+                cached_at = CURRENT_TIMESTAMP,
+                expires_at = excluded.expires_at,
+                last_modified = excluded.last_modified,
+                last_accessed = excluded.last_accessed,
+                summary = excluded.summary
+        ''', (entry.latitude, entry.longitude, encode_payload(entry),
+              int(entry.expires_at), entry.last_modified, int(entry.cached_at), entry.summary))
+        conn.commit()
+
+    def _touch(self, conn: sqlite3.Connection, entry: WeatherEntry) -> None:
+        """Extend a location's row after a 304 revalidation"""
+        conn.execute('''
+            UPDATE weather_cache
+            SET cached_at = CURRENT_TIMESTAMP, expires_at = ?, last_modified = ?
+            WHERE latitude = ? AND longitude = ?
+        ''', (int(entry.expires_at), entry.last_modified, entry.latitude, entry.longitude))
+        conn.commit()
+
+    def _fetch(self, lat: float, lon: float,
+               previous: Optional[WeatherEntry] = None) -> WeatherEntry:
+        """Fetch a compact forecast from the Norwegian Meteorological Institute API,
+        revalidating previous with If-Modified-Since when it has a validator"""
+        self.counters.incr('upstream_fetches')
+        validator = previous.last_modified if previous is not None else None
+        try:
+            response = self.client.fetch(lat, lon, last_modified=validator)
+        except CircuitOpenError as e:
+            raise WeatherUnavailable(str(e)) from e
+        except requests.RequestException as e:
+            raise WeatherUnavailable(f'met.no request failed: {e}') from e
+
+        now = time.time()
+        expires_at = expiry_from_headers(response.headers, now, self.ttl)
+        if response.not_modified and previous is not None:
+            self.counters.incr('revalidated')
+            return previous.revalidated(now, expires_at,
+                                        response.last_modified or previous.last_modified)
+        if response.status_code != 200:
+            raise WeatherUnavailable(f'met.no returned HTTP {response.status_code}')
+        try:
+            document = json.loads(response.body)
+            # Summarised once here, so summary requests never touch the full document
+            summary = encode_summary(document)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            raise WeatherUnavailable(f'met.no returned an unreadable document: {e}') from e
+        return WeatherEntry(lat, lon, response.body, cached_at=now, expires_at=expires_at,
+                            last_modified=response.last_modified, summary=summary)
+
+    def warm(self, conn: sqlite3.Connection) -> int:
+        """Fill the memory tier from servable table rows, newest last (most recent)"""
+        now = time.time()
+        rows = conn.execute('''
+            SELECT latitude, longitude, weather_data, cached_epoch, expires_at, last_modified, summary
+            FROM (
+                SELECT id, latitude, longitude, weather_data, expires_at, last_modified, summary,
+                       CAST(strftime('%s', cached_at) AS INTEGER) AS cached_epoch
+                FROM weather_cache
+            )
+            WHERE COALESCE(expires_at, cached_epoch + ?) > ?
+            ORDER BY cached_epoch DESC, id DESC
+            LIMIT ?
+        ''', (self.ttl, now - self.stale_ttl, self.memory.max_size)).fetchall()
+
+        loaded = 0
+        for lat, lon, weather_data, cached_epoch, expires_at, last_modified, summary in reversed(rows):
+            # Rows written before quantization was enabled (or under another
+            # grid setting) only warm the cell whose centre they sit on
+            cell = self.cell_for(lat, lon)
+            if (cell.latitude, cell.longitude) != (lat, lon):
+                continue
+            self._remember(cell, self._entry_from_row(lat, lon, weather_data, cached_epoch,
+                                                      expires_at, last_modified, summary))
+            loaded += 1
+        self.counters.incr('warmed', loaded)
+        return loaded
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for both cache tiers and the upstream"""
+        stats: Dict[str, Any] = {'memory': self.memory.stats(),
+                                 'single_flight': self.flights.stats()}
+        stats.update(self.counters.snapshot())
+        stats['ttl_seconds'] = self.ttl
+        stats['stale_ttl_seconds'] = self.stale_ttl
+        stats['grid'] = ({'geohash_precision': self.geohash_precision}
+                         if self.geohash_precision else {'step_degrees': self.grid_step})
+        stats['nearest_radius_km'] = self.nearest_radius_km if self._rtree_available else 0
+        if self.client is not None:
+            stats['upstream'] = self.client.stats()
+        if self.prefetcher is not None:
+            stats['prefetch'] = self.prefetcher.stats()
+        if self.maintainer is not None:
+            stats['maintenance'] = self.maintainer.stats()
+        return stats